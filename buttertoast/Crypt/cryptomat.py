@@ -19,23 +19,32 @@
 # Author: Fabian Kozlowski
 # Date: November 22, 2024
 # The Cryptomat is used for encryption and decryption during the process of creating a polyglot file.
-# Currently, it only supports AES-XTS with SHA512.
+# It supports TrueCrypt and VeraCrypt headers with all PRFs and (cascaded) ciphers provided by OpenSSL/cryptography,
+# the combination used by a volume is detected (see volume_formats).
 # Note: Only the header is encrypted and decrypted.
-# INPUT: Encrypted TrueCrypt volume (binary data/bytecode), password, encrypted TrueCrypt polyglot (binary data/bytecode)
+# INPUT: Encrypted TrueCrypt/VeraCrypt volume (binary data/bytecode), password, encrypted TrueCrypt polyglot (binary data/bytecode)
 
 # OUTPUT: Re-encrypted TrueCrypt volume (binary data/bytecode) or a String with an Error-Message if the password was wrong
 
 
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+import os
+import zlib
+
+from buttertoast.Crypt import volume_formats
 
 # AES-XTS configuration
 AES_KEY_SIZE = 64
 SALT_SIZE = 64
 FULL_HEADER_SIZE = 512  # Header size of a TrueCrypt volume, including SALT_SIZE
 REAL_HEADER_SIZE = FULL_HEADER_SIZE - SALT_SIZE  # 448 bytes
-TWEAK = b"\x00" * 16  # The tweak for AES-XTS consists of 16 bytes, here set to zeros for simplicity, but can be randomized.
+SECTOR_SIZE = 512  # TrueCrypt volumes consist of whole 512 byte sectors
+MIN_HEADER_BYTE_VALUES = 64  # An encrypted header uses ~220 of the 256 byte values, plain data far less
+# Offsets in the decrypted header (without the salt)
+HEADER_CRC_OFFSET = 188  # CRC32 of the decrypted header bytes 0-187
+KEYS_CRC_OFFSET = 8  # CRC32 of the master keys area
+KEYS_OFFSET = 192  # Master keys area, up to the end of the header
+ENCRYPTED_AREA_OFFSET = 44  # Offset (8 bytes) and size (8 bytes) of the encrypted data area
+HEADER_GROUP_SIZE = 128 * 1024  # Header area at the start and backup header area at the end of a volume (TrueCrypt 6+)
 
 class Cryptomat:
     """
@@ -47,9 +56,17 @@ class Cryptomat:
     ----------
     ui : UI or None
         Optional UI instance to display messages. If None, no messages will be displayed.
+    pim : int or None
+        Personal iterations multiplier of a VeraCrypt volume.
+    header_parameters : HeaderParameters or None
+        Format, PRF, iterations and cipher of the last header decrypted by this instance.
+    encrypted_area : tuple or None
+        Offset and size of the encrypted data area of the last header decrypted by this instance.
+    progress : Progress or None
+        Progress of the job, the key derivation and the header encryption are reported as its stages.
     """
 
-    def __init__(self, ui=None):
+    def __init__(self, ui=None, pim=None, workers=None, progress=None):
         """
         Initialize the Cryptomat class.
 
@@ -60,9 +77,46 @@ class Cryptomat:
 
             Optional UI instance to display verbose messages during processing.
             If None, no messages will be displayed.
+
+        pim : int, not mandatory
+
+            Personal iterations multiplier of a VeraCrypt volume. Without it, the default iterations are used.
+
+        workers : int, not mandatory
+
+            Number of processes trying the expensive VeraCrypt combinations (default: number of CPUs).
+
+        progress : Progress, not mandatory
+
+            Progress of the job. It is checked between the key derivations, a cancelled job raises Cancelled.
         """
         self.ui = ui  # UI instance for displaying messages
+        self.pim = pim
+        self.workers = workers
+        self.progress = progress
+        self.header_parameters = None
+        self.encrypted_area = None
+
+    def display_message(self, message, message_type):
+        """
+        Forwards a message to the UI, if there is one.
+
+        Parameters:
+        message (str): The message to be displayed.
+        message_type (str): The type of the message (e.g., "info", "verbose", "error").
+        """
+        if self.ui:
+            self.ui.display_message(message, message_type)
 
+    def report_stage(self, name):
+        """
+        Starts a stage of the progress, if there is one.
+
+        Parameters:
+        name (str): Name of the stage.
+        """
+        if self.progress:
+            self.progress.stage(name)
 
     def cryptomator(self, encrypted_volume: bytes, encrypted_polyglot: bytes, passphrase: str) -> str | bytes:
 
@@ -84,36 +138,232 @@ class Cryptomat:
         bytes: The re-encrypted TrueCrypt volume (binary data), which includes the manipulated salt.
         """
         # Extract the salt from the polyglot file
-        self.ui.display_message(f"Extracting the SALT from the polyglot file...", "verbose")
+        self.display_message(f"Extracting the SALT from the polyglot file...", "verbose")
         salt_poly = self.__salty(encrypted_polyglot)  # 64 bytes
-        self.ui.display_message(f"SALT extracted.", "verbose")
+        self.display_message(f"SALT extracted.", "verbose")
 
-        # Decrypt the TrueCrypt volume
-        self.ui.display_message(f"Decrypting the given TrueCrypt-Volume...", "verbose")
-        decrypted_volume = self.__decrypt_volume(encrypted_volume, passphrase)
-        if decrypted_volume is None:  
-            self.ui.display_message(f"Decryption failed. Wrong password or invalid volume.", "error")
+        # Only the first 512 bytes of the volume are needed to build the new header
+        new_header = self.recrypt_header(encrypted_volume[:FULL_HEADER_SIZE], salt_poly, passphrase)
+        if new_header is None:
             return None
 
-        self.ui.display_message(f"TrueCrypt-Volume decrypted.", "verbose")
+        # Combine the re-encrypted header and the original data/host data to create the polyglot
+        self.display_message(f"Creating the buttertoast aka polyglot file...", "verbose")
+        encrypted_buttertoast = new_header + memoryview(encrypted_polyglot)[FULL_HEADER_SIZE:]
+        self.display_message(f"Buttertoast aka polyglot file created.", "verbose")
 
-        # Check if the decryption was a success, meaning we got a TRUE
-        # If it was not, the cryptomator returns a String with the error msg that the password was wrong or the TrueCrypt Volume is invalid
-        if isinstance(decrypted_volume, str):
-            # Return that string as the final result (error message)
-            return "Wrong password provided or invalid TrueCrypt-Volume!"
+        return encrypted_buttertoast
 
-        # Re-encrypt the volume using the salt from the polyglot host file
-        self.ui.display_message(f"Re-encrypting the given TrueCrypt-Volume...", "verbose")
-        re_encrypted_volume = self.__encrypt_volume(salt_poly, decrypted_volume, passphrase)
-        self.ui.display_message(f"TrueCrypt-Volume re-encrypted with the manipulated SALT.", "verbose")
+    def recrypt_header(self, volume_header: bytes, salt_poly: bytes, passphrase: str) -> bytes | None:
+        """
+        Decrypts the header of a TrueCrypt volume and re-encrypts it with the salt of the polyglot.
+        Only the 448 encrypted header bytes are processed, the data area of the volume is never touched.
 
-        # Combine the re-encrypted header and the original data/host data to create the polyglot
-        self.ui.display_message(f"Creating the buttertoast aka polyglot file...", "verbose")
-        encrypted_buttertoast = re_encrypted_volume[:512] + encrypted_polyglot[512:]
-        self.ui.display_message(f"Buttertoast aka polyglot file created.", "verbose")
+        Parameters:
+        volume_header (bytes): The first 512 bytes (salt + encrypted header) of the original volume.
+        salt_poly (bytes): The 64 byte salt dictated by the polyglot host file.
+        passphrase (str): The password for the TrueCrypt volume.
 
-        return encrypted_buttertoast
+        Returns:
+        bytes: The 512 byte replacement header (salt of the polyglot + re-encrypted header).
+        None: If the password was wrong or the volume is invalid.
+        """
+        if len(volume_header) < FULL_HEADER_SIZE:
+            self.display_message(f"The volume is smaller than a TrueCrypt header ({FULL_HEADER_SIZE} bytes).", "error")
+            return None
+
+        # Decrypt the header of the TrueCrypt volume
+        self.report_stage("Deriving the header key")
+        self.display_message(f"Decrypting the header of the given TrueCrypt-Volume...", "verbose")
+        decrypted_header = self.decrypt_header(bytes(volume_header[:FULL_HEADER_SIZE]), passphrase)
+        if decrypted_header is None:
+            self.display_message(f"Decryption failed. Wrong password or invalid volume.", "error")
+            return None
+        self.display_message(f"TrueCrypt-Header decrypted.", "verbose")
+
+        # Re-encrypt the header using the salt from the polyglot host file
+        self.report_stage("Encrypting the header")
+        self.display_message(f"Re-encrypting the header of the given TrueCrypt-Volume...", "verbose")
+        new_header = self.encrypt_header(bytes(salt_poly), decrypted_header, passphrase)
+        self.display_message(f"TrueCrypt-Header re-encrypted with the manipulated SALT.", "verbose")
+
+        return new_header
+
+    def rekey_header(self, volume_header: bytes, old_passphrase: str, new_passphrase: str) -> bytes | None:
+        """
+        Changes the password of a header: decrypts it with the old password and re-encrypts it with the new one,
+        keeping its salt (e.g. the salt dictated by the host of a polyglot), PRF, iterations and cipher.
+
+        Parameters:
+        volume_header (bytes): The first 512 bytes (salt + encrypted header) of the volume or polyglot.
+        old_passphrase (str): The current password.
+        new_passphrase (str): The new password.
+
+        Returns:
+        bytes: The re-encrypted 512 byte header with the same salt.
+        None: If the old password was wrong or the file is no volume.
+        """
+        if len(volume_header) < FULL_HEADER_SIZE:
+            self.display_message(f"The file is smaller than a TrueCrypt header ({FULL_HEADER_SIZE} bytes).", "error")
+            return None
+
+        decrypted_header = self.decrypt_header(bytes(volume_header[:FULL_HEADER_SIZE]), old_passphrase)
+        if decrypted_header is None:
+            self.display_message(f"Decryption failed. Wrong password or invalid volume.", "error")
+            return None
+
+        self.display_message(f"Re-encrypting the header with the new password...", "verbose")
+        return self.encrypt_header(bytes(volume_header[:SALT_SIZE]), decrypted_header, new_passphrase)
+
+    def rekey_backup_header(self, backup_header: bytes, old_passphrase: str, new_passphrase: str) -> bytes | None:
+        """
+        Changes the password of the backup header, keeping its salt. Must be called after rekey_header.
+
+        Parameters:
+        backup_header (bytes): The 512 bytes (salt + encrypted header) at the backup header offset.
+        old_passphrase (str): The current password.
+        new_passphrase (str): The new password.
+
+        Returns:
+        bytes: The re-encrypted 512 byte backup header with the same salt.
+        None: If there is no valid backup header.
+        """
+        decrypted_header = self.decrypt_backup_header(backup_header, old_passphrase)
+        if decrypted_header is None:
+            return None
+        return self.encrypt_header(bytes(backup_header[:SALT_SIZE]), decrypted_header, new_passphrase)
+
+    def volume_size(self) -> int | None:
+        """
+        Returns the size of the volume described by the last decrypted header: the header area, the
+        encrypted data area and the backup header area. Inside a polyglot, the volume starts at offset 0.
+
+        Returns:
+        int: The size of the volume in bytes.
+        None: If no header was decrypted yet.
+        """
+        if self.encrypted_area is None:
+            return None
+        return sum(self.encrypted_area) + HEADER_GROUP_SIZE
+
+    def backup_header_offset(self, volume_size: int) -> int | None:
+        """
+        Returns the offset of the backup header, which TrueCrypt 6+ and VeraCrypt keep at the start of the last 128 KiB.
+
+        Parameters:
+        volume_size (int): The size of the volume in bytes.
+
+        Returns:
+        int: The offset of the backup header.
+        None: If the volume is too small to have a header area and a backup header area.
+        """
+        if volume_size < 2 * HEADER_GROUP_SIZE:
+            return None
+        return volume_size - HEADER_GROUP_SIZE
+
+    def recrypt_backup_header(self, backup_header: bytes, passphrase: str) -> bytes | None:
+        """
+        Decrypts the backup header of a volume and re-encrypts it with a new random salt, so the polyglot
+        does not share its backup header bytes with the original volume.
+        Must be called after the header of the volume was decrypted, the backup header uses the same parameters.
+
+        Parameters:
+        backup_header (bytes): The 512 bytes (salt + encrypted header) at the backup header offset.
+        passphrase (str): The password for the volume.
+
+        Returns:
+        bytes: The re-encrypted 512 byte backup header, including the new salt.
+        None: If the volume has no valid backup header (e.g. TrueCrypt before 6.0).
+        """
+        decrypted_header = self.decrypt_backup_header(backup_header, passphrase)
+        if decrypted_header is None:
+            return None
+
+        self.display_message(f"Re-encrypting the backup header with a new SALT...", "verbose")
+        return self.encrypt_header(os.urandom(SALT_SIZE), decrypted_header, passphrase)
+
+    def decrypt_backup_header(self, backup_header: bytes, passphrase: str) -> bytes | None:
+        """
+        Decrypts the backup header of a volume with the parameters of its header, without trying other ones.
+
+        Parameters:
+        backup_header (bytes): The 512 bytes (salt + encrypted header) at the backup header offset.
+        passphrase (str): The password for the volume.
+
+        Returns:
+        bytes: The decrypted 448 byte backup header.
+        None: If the volume has no valid backup header or its header was not decrypted yet.
+        """
+        if self.header_parameters is None or len(backup_header) < FULL_HEADER_SIZE:
+            return None
+
+        self.display_message(f"Decrypting the backup header...", "verbose")
+        decrypted_header = volume_formats.decrypt_header(self.header_parameters, backup_header, passphrase.encode())
+        if decrypted_header is None:
+            self.display_message(f"The volume has no valid backup header, it is left unchanged.", "verbose")
+        return decrypted_header
+
+    def verify_header(self, volume_header: bytes, passphrase: str) -> bool:
+        """
+        Checks that a header can be mounted: derives the keys from its salt, decrypts it and
+        verifies the magic number 'TRUE' or 'VERA' and the CRC32 checksums of the header and of the master keys.
+
+        Parameters:
+        volume_header (bytes): The first 512 bytes (salt + encrypted header), e.g. of a written polyglot.
+        passphrase (str): The password for the TrueCrypt volume.
+
+        Returns:
+        bool: True if the header is valid, False otherwise.
+        """
+        if len(volume_header) < FULL_HEADER_SIZE:
+            self.display_message(f"The file is smaller than a TrueCrypt header ({FULL_HEADER_SIZE} bytes).", "error")
+            return False
+
+        decrypted_header = self.decrypt_header(bytes(volume_header[:FULL_HEADER_SIZE]), passphrase)
+        if decrypted_header is None:
+            self.display_message(f"The header cannot be decrypted, the magic number 'TRUE'/'VERA' is missing.", "error")
+            return False
+
+        header_crc = int.from_bytes(decrypted_header[HEADER_CRC_OFFSET:HEADER_CRC_OFFSET + 4], "big")
+        if zlib.crc32(decrypted_header[:HEADER_CRC_OFFSET]) != header_crc:
+            self.display_message(f"The CRC32 checksum of the header does not match.", "error")
+            return False
+
+        keys_crc = int.from_bytes(decrypted_header[KEYS_CRC_OFFSET:KEYS_CRC_OFFSET + 4], "big")
+        if zlib.crc32(decrypted_header[KEYS_OFFSET:]) != keys_crc:
+            self.display_message(f"The CRC32 checksum of the master keys does not match.", "error")
+            return False
+
+        self.display_message(f"Header decrypted, magic number and checksums are valid.", "verbose")
+        return True
+
+    def check_volume(self, volume_header: bytes, volume_size: int) -> bool:
+        """
+        Sanity check of a volume before any key derivation or large read, using only its size and its first 512 bytes.
+        Without the password, only the structure can be checked: the volume must consist of whole sectors
+        and its salt and encrypted header must look random.
+
+        Parameters:
+        volume_header (bytes): The first 512 bytes (salt + encrypted header) of the volume.
+        volume_size (int): The size of the volume in bytes.
+
+        Returns:
+        bool: True if the volume may be a TrueCrypt volume, False otherwise.
+        """
+        if volume_size < FULL_HEADER_SIZE or len(volume_header) < FULL_HEADER_SIZE:
+            self.display_message(f"The volume is smaller than a TrueCrypt header ({FULL_HEADER_SIZE} bytes).", "error")
+            return False
+
+        if volume_size % SECTOR_SIZE:
+            self.display_message(f"The size of the volume ({volume_size} bytes) is not a multiple of {SECTOR_SIZE} bytes, it is not a TrueCrypt volume.", "error")
+            return False
+
+        if len(set(volume_header[:FULL_HEADER_SIZE])) < MIN_HEADER_BYTE_VALUES:
+            self.display_message(f"The header of the volume is not encrypted, it is not a TrueCrypt volume.", "error")
+            return False
+
+        self.display_message(f"Volume header passed the sanity check.", "verbose")
+        return True
 
     def __salty(self, encrypted_volume) -> bytes:
         """
@@ -140,96 +390,53 @@ class Cryptomat:
             raise ValueError("SALT must be of type 'bytes'.")
         return so_salty
 
-    def __derive_aes_keys(self, salt: bytes, passphrase: str) -> tuple:
-        """
-        Derives AES-XTS encryption keys using the provided salt and passphrase.
-
-        Parameters:
-        salt (bytes): The salt used for key derivation.
-        passphrase (str): The passphrase used for encryption.
-
-        Returns:
-        tuple: A tuple containing two AES keys (32 bytes each).
+    def decrypt_header(self, volume_header: bytes, passphrase: str) -> bytes | None:
 
-        Raises:
-        TypeError: If the provided salt is not of type 'bytes'.
         """
-        if not isinstance(salt, bytes):
-            raise TypeError("SALT must be of type 'bytes' for key derivation.")
-
-        self.ui.display_message(f"Deriving AES-keys...", "verbose")
-        iterations = 1000
-        hash_algo = hashes.SHA512()
-        kdf = PBKDF2HMAC(
-            algorithm=hash_algo,
-            length=64,
-            salt=salt,
-            iterations=iterations,
-        )
-        key = kdf.derive(passphrase.encode())
-        aes_key1 = key[:32]
-        aes_key2 = key[32:]
-        self.ui.display_message(f"AES-keys derived.", "verbose")
-        return aes_key1, aes_key2
-
-
-    def __decrypt_volume(self, encrypted_volume: bytes, passphrase: str) -> str | bytes:
-
-        """
-        Decrypts the provided TrueCrypt volume using AES-XTS with the derived keys.
+        Decrypts the header of a TrueCrypt or VeraCrypt volume. The format, PRF and cipher are detected
+        and kept in `header_parameters`, so encrypt_header uses the same ones.
 
         Parameters:
-        encrypted_volume (bytes): The encrypted TrueCrypt volume.
+        volume_header (bytes): The first 512 bytes (salt + encrypted header) of the volume.
         passphrase (str): The passphrase for decryption.
 
         Returns:
-
-        str: The error message if the password was wrong.
-        bytes: The decrypted volume, including the salt.
+        bytes: The decrypted 448 byte header (without the salt).
+        None: If the password was wrong.
 
         """
-        # Extract the salt from the first 64 bytes
-        salt = encrypted_volume[:64]
-
-        # Derive the AES keys
-        aes_key1, aes_key2 = self.__derive_aes_keys(salt, passphrase)
-
-        # Initialize the AES-XTS cipher for decryption
-        cipher = Cipher(algorithms.AES(aes_key1 + aes_key2), modes.XTS(TWEAK))
-        decryptor = cipher.decryptor()
-
-        # Decrypt the volume (excluding the salt)
-        decrypted_data = decryptor.update(encrypted_volume[64:]) + decryptor.finalize()
-
-        # Verify the magic number 'TRUE' in the decrypted header
-        if decrypted_data[:4] != b"TRUE":
-            # Return an None Type
+        self.display_message(f"Deriving the header keys...", "verbose")
+        result = volume_formats.detect_header(volume_header, passphrase.encode(), self.pim, self.workers, self.progress)
+        if result is None:
             return None
 
-        # Return the decrypted data, including the salt
-        return salt + decrypted_data
+        self.header_parameters, decrypted_header = result
+        self.encrypted_area = (
+            int.from_bytes(decrypted_header[ENCRYPTED_AREA_OFFSET:ENCRYPTED_AREA_OFFSET + 8], "big"),
+            int.from_bytes(decrypted_header[ENCRYPTED_AREA_OFFSET + 8:ENCRYPTED_AREA_OFFSET + 16], "big"),
+        )
+        self.display_message(f"{self.header_parameters.format} header found ({self.header_parameters.prf}, "
+                             f"{self.header_parameters.iterations} iterations, {self.header_parameters.cipher}).", "verbose")
+        return decrypted_header
 
-    def __encrypt_volume(self, salty: bytes, decrypted_volume: bytes, passphrase: str) -> bytes:
+    def encrypt_header(self, salty: bytes, decrypted_header: bytes, passphrase: str,
+                       parameters: volume_formats.HeaderParameters | None = None) -> bytes:
         """
-        Encrypts the provided decrypted volume using AES-XTS with the given salt.
+        Encrypts the provided decrypted header with the given salt.
 
         Parameters:
         salty (bytes): The salt used for encryption.
-        decrypted_volume (bytes): The decrypted TrueCrypt volume data.
+        decrypted_header (bytes): The decrypted 448 byte TrueCrypt/VeraCrypt header.
         passphrase (str): The passphrase for encryption.
+        parameters (HeaderParameters): Format, PRF, iterations and cipher of the header. Defaults to the ones
+                                       found by the last decrypt_header, or TrueCrypt with SHA-512 and AES.
 
         Returns:
-        bytes: The encrypted volume, including the salt.
+        bytes: The encrypted 512 byte header, including the salt.
         """
-        # Derive the AES keys using the salt
-        aes_key1, aes_key2 = self.__derive_aes_keys(salty, passphrase)
-
-        # Initialize the AES-XTS cipher for encryption
-        cipher = Cipher(algorithms.AES(aes_key1 + aes_key2), modes.XTS(TWEAK))
-        encryptor = cipher.encryptor()
-
-        # Encrypt the volume (excluding the salt)
-        encrypted_data = encryptor.update(decrypted_volume[64:]) + encryptor.finalize()
+        if not isinstance(salty, bytes):
+            raise TypeError("SALT must be of type 'bytes' for key derivation.")
 
-        # Return the encrypted data, including the salt
-        return salty + encrypted_data
+        parameters = parameters or self.header_parameters or volume_formats.TRUECRYPT_DEFAULT
+        self.display_message(f"Deriving the header keys ({parameters.prf}, {parameters.iterations} iterations)...", "verbose")
+        return volume_formats.encrypt_header(parameters, salty, decrypted_header, passphrase.encode())
@@ -0,0 +1,159 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+
+# Opt-in, in-memory LRU cache of derived header keys. Processing the same volume again with the same password
+# (GUI, TUI, batch, and the round-trip check of every polyglot) derives the key for the same salt again,
+# which costs up to a second per derivation for VeraCrypt volumes.
+# Entries are found by an HMAC of the salt, password, PRF and iterations under a secret of the process, so neither
+# the password nor the salt is kept. PBKDF2 keys of different lengths share their prefix, so a cached key also
+# serves requests for shorter keys. Evicted keys are overwritten with zeros, and the cache is cleared when the
+# process exits.
+
+import atexit
+import hashlib
+import hmac
+import os
+import threading
+from collections import OrderedDict
+
+DEFAULT_SIZE = 32  # Number of keys kept
+
+
+class KeyCache:
+    """
+    Size-bounded LRU cache of derived keys with hit/miss counters. Disabled until enabled with configure.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.enabled = False
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.secret = os.urandom(32)
+        self.entries = OrderedDict()  # HMAC -> key material (bytearray)
+        self.lock = threading.Lock()
+
+    def configure(self, enabled, size=DEFAULT_SIZE):
+        """
+        Enables or disables the cache and sets its size. Disabling it clears all entries.
+
+        Args:
+            enabled (bool): Whether derived keys are cached.
+            size (int): Maximum number of keys kept.
+        """
+        with self.lock:
+            self.enabled = enabled
+            self.size = max(size, 0)
+            self.trim()
+        if not enabled:
+            self.clear()
+
+    def entry_id(self, salt, passphrase, prf, iterations):
+        """
+        Keyed hash identifying a derivation.
+
+        Returns:
+            bytes: HMAC-SHA256 of the length-prefixed fields under the secret of the process.
+        """
+        digest = hmac.new(self.secret, digestmod=hashlib.sha256)
+        for field in (bytes(salt), bytes(passphrase), prf.encode(), str(iterations).encode()):
+            digest.update(len(field).to_bytes(4, "big"))
+            digest.update(field)
+        return digest.digest()
+
+    def get(self, salt, passphrase, prf, iterations, length):
+        """
+        Returns a cached key and counts the hit or miss.
+
+        Returns:
+            bytes: The first `length` bytes of the key material, or None if no key of at least that length
+                   is cached (or the cache is disabled).
+        """
+        if not self.enabled:
+            return None
+        entry_id = self.entry_id(salt, passphrase, prf, iterations)
+        with self.lock:
+            key = self.entries.get(entry_id)
+            if key is None or len(key) < length:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(entry_id)
+            self.hits += 1
+            return bytes(key[:length])
+
+    def put(self, salt, passphrase, prf, iterations, key):
+        """
+        Caches a derived key, evicting the least recently used ones beyond the size of the cache.
+        A cached key is only replaced by a longer one.
+        """
+        if not self.enabled or not self.size:
+            return
+        entry_id = self.entry_id(salt, passphrase, prf, iterations)
+        with self.lock:
+            cached = self.entries.get(entry_id)
+            if cached is not None and len(cached) >= len(key):
+                self.entries.move_to_end(entry_id)
+                return
+            if cached is not None:
+                zeroize(cached)
+            self.entries[entry_id] = bytearray(key)
+            self.entries.move_to_end(entry_id)
+            self.trim()
+
+    def trim(self):
+        """
+        Evicts the least recently used keys beyond the size of the cache. The caller holds the lock.
+        """
+        while len(self.entries) > self.size:
+            _, key = self.entries.popitem(last=False)
+            zeroize(key)
+
+    def clear(self):
+        """
+        Overwrites all cached keys with zeros and removes them.
+        """
+        with self.lock:
+            while self.entries:
+                _, key = self.entries.popitem()
+                zeroize(key)
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+
+        Returns:
+            dict: enabled, size, entries, hits and misses.
+        """
+        with self.lock:
+            return {"enabled": self.enabled, "size": self.size, "entries": len(self.entries),
+                    "hits": self.hits, "misses": self.misses}
+
+
+def zeroize(buffer):
+    """
+    Overwrites a key with zeros. Copies handed out as bytes cannot be overwritten, so this is best effort.
+
+    Args:
+        buffer (bytearray): The key material.
+    """
+    buffer[:] = bytes(len(buffer))
+
+
+# Cache of the process
+key_cache = KeyCache()
+atexit.register(key_cache.clear)
@@ -0,0 +1,565 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+
+# Header formats of TrueCrypt and VeraCrypt volumes: the PRFs, iteration counts and (cascaded) ciphers a header
+# can be encrypted with, and the detection of the combination used by a volume.
+# Trying a combination means one PBKDF2 derivation; a VeraCrypt derivation is about 500 times as expensive as a
+# TrueCrypt one, so the VeraCrypt combinations are tried in parallel on a persistent process pool. A search that
+# found its match (or was cancelled) sets its flag in an array shared with the workers, which then skip the
+# remaining combinations of the search; a derivation that is already running ends by itself.
+# PRFs and ciphers that are not provided by the installed OpenSSL/cryptography build are skipped.
+
+import hashlib
+import multiprocessing
+import os
+import threading
+import zlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from buttertoast.Crypt.key_cache import key_cache
+
+SALT_SIZE = 64
+FULL_HEADER_SIZE = 512
+# Offsets in the decrypted header (without the salt)
+KEYS_CRC_OFFSET = 8  # CRC32 of the master keys area
+HEADER_CRC_OFFSET = 188  # CRC32 of the decrypted header bytes 0-187
+KEYS_OFFSET = 192  # Master keys area, up to the end of the header
+CIPHER_KEY_SIZE = 32  # Every cipher uses a 256 bit primary and a 256 bit secondary (XTS) key
+XTS_POLYNOMIAL = (1 << 128) | 0x87  # x^128 + x^7 + x^2 + x + 1, multiplying a tweak by alpha reduces with it
+CHEAP_ITERATIONS = 10000  # Combinations up to this iteration count are tried in the calling process
+CANCEL_POLL_INTERVAL = 0.1  # Interval in which a cancelled job is noticed while the pool derives keys (seconds)
+MAX_SEARCHES = 64  # Searches that may use the derivation pool at the same time, each has a flag in the shared array
+
+# PRF name -> OpenSSL digest name of PBKDF2-HMAC
+PRFS = {
+    "SHA-512": "sha512",
+    "SHA-256": "sha256",
+    "Whirlpool": "whirlpool",
+    "BLAKE2s-256": "blake2s256",
+    "Streebog": "streebog512",
+    "RIPEMD-160": "ripemd160",
+}
+
+# Cascade name -> ciphers in the order they are applied when encrypting. The key material holds the primary
+# keys of all ciphers in this order, followed by their secondary keys.
+CASCADES = {
+    "AES": ("AES",),
+    "Serpent": ("Serpent",),
+    "Twofish": ("Twofish",),
+    "Camellia": ("Camellia",),
+    "Kuznyechik": ("Kuznyechik",),
+    "AES-Twofish": ("Twofish", "AES"),
+    "AES-Twofish-Serpent": ("Serpent", "Twofish", "AES"),
+    "Serpent-AES": ("AES", "Serpent"),
+    "Serpent-Twofish-AES": ("AES", "Twofish", "Serpent"),
+    "Twofish-Serpent": ("Serpent", "Twofish"),
+    "Camellia-Kuznyechik": ("Kuznyechik", "Camellia"),
+    "Camellia-Serpent": ("Serpent", "Camellia"),
+    "Kuznyechik-AES": ("AES", "Kuznyechik"),
+    "Kuznyechik-Serpent-Camellia": ("Camellia", "Serpent", "Kuznyechik"),
+    "Kuznyechik-Twofish": ("Twofish", "Kuznyechik"),
+}
+
+TRUECRYPT_CASCADES = ("AES", "Serpent", "Twofish", "AES-Twofish", "AES-Twofish-Serpent",
+                      "Serpent-AES", "Serpent-Twofish-AES", "Twofish-Serpent")
+
+# Format name -> magic number of the decrypted header, default iterations per PRF and the cascades
+FORMATS = {
+    "TrueCrypt": {
+        "magic": b"TRUE",
+        "iterations": {"SHA-512": 1000, "Whirlpool": 1000, "RIPEMD-160": 2000},
+        "cascades": TRUECRYPT_CASCADES,
+    },
+    "VeraCrypt": {
+        "magic": b"VERA",
+        "iterations": {"SHA-512": 500000, "SHA-256": 500000, "Whirlpool": 500000, "BLAKE2s-256": 500000,
+                       "Streebog": 500000, "RIPEMD-160": 655331},
+        "cascades": tuple(CASCADES),
+    },
+}
+
+# Parameters a header is encrypted with. `cipher` is the name of the cascade.
+HeaderParameters = namedtuple("HeaderParameters", ["format", "prf", "iterations", "cipher"])
+TRUECRYPT_DEFAULT = HeaderParameters("TrueCrypt", "SHA-512", 1000, "AES")
+
+# Parameters of the headers found recently in this process, tried first by detect_header
+recent_parameters = []
+recent_parameters_lock = threading.Lock()
+MAX_RECENT_PARAMETERS = 8
+
+# Process pool of the expensive combinations, created on first use and kept for the following searches
+derivation_pool = None
+derivation_pool_pid = None  # Process that created the pool, a forked child creates its own
+derivation_flags = None  # Shared array, the flag of a search is set when the search was stopped
+free_search_slots = []  # Indexes of the flags that are not used by a search
+derivation_condition = threading.Condition()
+search_flags = None  # In a worker process: the flags of the pool
+
+
+def veracrypt_iterations(pim):
+    """
+    Iteration count of a VeraCrypt volume (not a system volume) with a PIM.
+
+    Args:
+        pim (int): The personal iterations multiplier, greater than 0.
+
+    Returns:
+        int: 15000 + PIM * 1000.
+    """
+    return 15000 + pim * 1000
+
+
+@lru_cache(maxsize=None)
+def prf_available(prf):
+    """
+    Checks whether OpenSSL provides the digest of a PRF, e.g. Whirlpool needs the legacy provider.
+
+    Args:
+        prf (str): Name of the PRF, see PRFS.
+
+    Returns:
+        bool: True if PBKDF2 can be computed with the PRF.
+    """
+    try:
+        hashlib.pbkdf2_hmac(PRFS[prf], b"", b"", 1, 1)
+        return True
+    except ValueError:
+        return False
+
+
+@lru_cache(maxsize=None)
+def block_ciphers():
+    """
+    Returns the block ciphers provided by the installed cryptography package.
+
+    Returns:
+        dict: Cipher name -> cryptography algorithm class. Serpent, Twofish and Kuznyechik are only
+              present if the package provides them.
+    """
+    try:
+        from cryptography.hazmat.decrepit.ciphers import algorithms as decrepit_algorithms
+    except ImportError:
+        decrepit_algorithms = None
+
+    ciphers = {}
+    for name in ("AES", "Serpent", "Twofish", "Camellia", "Kuznyechik"):
+        algorithm = getattr(decrepit_algorithms, name, None) or getattr(algorithms, name, None)
+        if algorithm is not None:
+            ciphers[name] = algorithm
+    return ciphers
+
+
+def cascade_available(cascade):
+    """
+    Checks whether all ciphers of a cascade are provided.
+
+    Args:
+        cascade (str): Name of the cascade, see CASCADES.
+
+    Returns:
+        bool: True if the cascade can be used.
+    """
+    return all(cipher in block_ciphers() for cipher in CASCADES[cascade])
+
+
+def key_length(cascade):
+    """
+    Length of the key material of a cascade: a primary and a secondary key per cipher.
+
+    Args:
+        cascade (str): Name of the cascade.
+
+    Returns:
+        int: The length in bytes.
+    """
+    return 2 * CIPHER_KEY_SIZE * len(CASCADES[cascade])
+
+
+def derive_header_key(prf, passphrase, salt, iterations, length):
+    """
+    Derives the header key material with PBKDF2, or takes it from the key cache if that is enabled.
+
+    Args:
+        prf (str): Name of the PRF.
+        passphrase (bytes): The password of the volume.
+        salt (bytes): The 64 byte salt of the header.
+        iterations (int): Iteration count.
+        length (int): Length of the key material in bytes.
+
+    Returns:
+        bytes: The key material.
+    """
+    key = key_cache.get(salt, passphrase, prf, iterations, length)
+    if key is None:
+        key = hashlib.pbkdf2_hmac(PRFS[prf], passphrase, salt, iterations, length)
+        key_cache.put(salt, passphrase, prf, iterations, key)
+    return key
+
+
+def crypt_header_unit(algorithm, key, data, encrypt):
+    """
+    Encrypts or decrypts the header bytes with one cipher in XTS mode, as data unit 0 (tweak 0).
+    cryptography only provides XTS for AES, the other ciphers multiply the encrypted tweak of the
+    28 blocks themselves and process the data in ECB mode.
+
+    Args:
+        algorithm (type): The 128 bit block cipher, a cryptography algorithm class.
+        key (bytes): The 64 byte XTS key (primary + secondary key).
+        data (bytes): The header bytes behind the salt, a multiple of 16 bytes.
+        encrypt (bool): True to encrypt, False to decrypt.
+
+    Returns:
+        bytes: The processed header bytes.
+    """
+    if algorithm is algorithms.AES:
+        cipher = Cipher(algorithms.AES(key), modes.XTS(bytes(16)))
+        context = cipher.encryptor() if encrypt else cipher.decryptor()
+        return context.update(data) + context.finalize()
+
+    tweak_encryptor = Cipher(algorithm(key[CIPHER_KEY_SIZE:]), modes.ECB()).encryptor()
+    tweak = int.from_bytes(tweak_encryptor.update(bytes(16)), "little")
+    tweaks = []
+    for _ in range(len(data) // 16):
+        tweaks.append(tweak.to_bytes(16, "little"))
+        tweak <<= 1
+        if tweak >> 128:
+            tweak ^= XTS_POLYNOMIAL
+    mask = int.from_bytes(b"".join(tweaks), "little")
+
+    cipher = Cipher(algorithm(key[:CIPHER_KEY_SIZE]), modes.ECB())
+    context = cipher.encryptor() if encrypt else cipher.decryptor()
+    blocks = context.update((int.from_bytes(data, "little") ^ mask).to_bytes(len(data), "little"))
+    return (int.from_bytes(blocks, "little") ^ mask).to_bytes(len(data), "little")
+
+
+def crypt_header(cascade, key, data, encrypt):
+    """
+    Encrypts or decrypts the 448 encrypted bytes of a header (data unit 0) with a cascade in XTS mode.
+
+    Args:
+        cascade (str): Name of the cascade.
+        key (bytes): The key material, at least key_length(cascade) bytes.
+        data (bytes): The header bytes behind the salt.
+        encrypt (bool): True to encrypt, False to decrypt.
+
+    Returns:
+        bytes: The processed header bytes.
+    """
+    ciphers = CASCADES[cascade]
+    count = len(ciphers)
+    order = range(count) if encrypt else reversed(range(count))
+    for index in order:
+        primary = key[index * CIPHER_KEY_SIZE:(index + 1) * CIPHER_KEY_SIZE]
+        secondary = key[(count + index) * CIPHER_KEY_SIZE:(count + index + 1) * CIPHER_KEY_SIZE]
+        data = crypt_header_unit(block_ciphers()[ciphers[index]], primary + secondary, data, encrypt)
+    return bytes(data)
+
+
+def header_valid(decrypted_header, magic):
+    """
+    Checks a decrypted header like TrueCrypt and VeraCrypt do: the magic number and the CRC32 checksums
+    of the master keys and of the header.
+
+    Args:
+        decrypted_header (bytes): The decrypted 448 byte header (without the salt).
+        magic (bytes): The expected magic number.
+
+    Returns:
+        bool: True if the header was decrypted with the right parameters.
+    """
+    if decrypted_header[:4] != magic:
+        return False
+    keys_crc = int.from_bytes(decrypted_header[KEYS_CRC_OFFSET:KEYS_CRC_OFFSET + 4], "big")
+    header_crc = int.from_bytes(decrypted_header[HEADER_CRC_OFFSET:HEADER_CRC_OFFSET + 4], "big")
+    return (zlib.crc32(decrypted_header[KEYS_OFFSET:]) == keys_crc
+            and zlib.crc32(decrypted_header[:HEADER_CRC_OFFSET]) == header_crc)
+
+
+def header_candidates(pim=None):
+    """
+    Lists the (format, PRF, iterations) combinations to try, the cheap TrueCrypt ones first.
+    With a PIM only VeraCrypt combinations are listed, TrueCrypt has no PIM.
+
+    Args:
+        pim (int): Optional personal iterations multiplier of a VeraCrypt volume.
+
+    Returns:
+        list: Tuples of format name, PRF name and iteration count, for PRFs that are available.
+    """
+    candidates = []
+    for format_name, header_format in FORMATS.items():
+        if pim and format_name == "TrueCrypt":
+            continue
+        for prf, iterations in header_format["iterations"].items():
+            if prf_available(prf):
+                candidates.append((format_name, prf, veracrypt_iterations(pim) if pim else iterations))
+    return candidates
+
+
+def init_derivation_worker(flags):
+    """
+    Initializes a worker process of the derivation pool with the shared flags of the searches.
+    """
+    global search_flags
+    search_flags = flags
+
+
+def search_stopped(slot):
+    """
+    Checks in a worker process whether the search of a combination was stopped.
+
+    Args:
+        slot (int): Index of the flag of the search, None if the combination is tried in the calling process.
+
+    Returns:
+        bool: True if the combination does not need to be tried any more.
+    """
+    return slot is not None and search_flags is not None and bool(search_flags[slot])
+
+
+def start_search():
+    """
+    Returns the derivation pool and a free flag of the shared array for a new search, creating the pool on
+    first use (or after it broke). Waits while MAX_SEARCHES searches use the pool.
+
+    Returns:
+        tuple: The ProcessPoolExecutor, the shared flags and the index of the flag of the search.
+    """
+    global derivation_pool, derivation_pool_pid, derivation_flags, free_search_slots
+    with derivation_condition:
+        if derivation_pool is None or derivation_pool_pid != os.getpid():
+            derivation_flags = multiprocessing.RawArray('b', MAX_SEARCHES)
+            free_search_slots = list(range(MAX_SEARCHES))
+            derivation_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                  initializer=init_derivation_worker, initargs=(derivation_flags,))
+            derivation_pool_pid = os.getpid()
+        while not free_search_slots:
+            derivation_condition.wait()
+        slot = free_search_slots.pop()
+        derivation_flags[slot] = 0
+        return derivation_pool, derivation_flags, slot
+
+
+def stop_search(pool, flags, slot, futures):
+    """
+    Stops a search: the workers skip its remaining combinations, queued ones are cancelled. The flag is
+    given back when the last combination of the search has left the pool, so a new search cannot reset
+    it while a worker of the old one still reads it.
+
+    Args:
+        pool (ProcessPoolExecutor): The derivation pool of the search.
+        flags (RawArray): The shared flags of the pool.
+        slot (int): Index of the flag of the search.
+        futures (set): The combinations of the search that may still be in the pool.
+    """
+    flags[slot] = 1
+    futures = list(futures)
+    remaining = [len(futures) + 1]  # The combinations and this call, which releases last if they are done
+
+    def release(_=None):
+        with derivation_condition:
+            remaining[0] -= 1
+            if remaining[0] == 0 and pool is derivation_pool:
+                free_search_slots.append(slot)
+                derivation_condition.notify()
+
+    for future in futures:
+        future.cancel()
+        future.add_done_callback(release)
+    release()
+
+
+def discard_derivation_pool(pool):
+    """
+    Drops a broken derivation pool, the next search creates a new one.
+    """
+    global derivation_pool
+    with derivation_condition:
+        if pool is derivation_pool:
+            derivation_pool = None
+            derivation_condition.notify_all()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def try_candidate(volume_header, passphrase, format_name, prf, iterations, slot=None):
+    """
+    Derives the key of one combination and tries to decrypt the header with every cascade of the format.
+    Runs in the calling process or in the worker processes of detect_header, where it gives up as soon as
+    the search was stopped.
+
+    Args:
+        volume_header (bytes): The first 512 bytes (salt + encrypted header) of the volume.
+        passphrase (bytes): The password of the volume.
+        format_name (str): Name of the format.
+        prf (str): Name of the PRF.
+        iterations (int): Iteration count.
+        slot (int): Index of the flag of the search in a worker process.
+
+    Returns:
+        tuple: The HeaderParameters, the decrypted 448 byte header and the derived key material,
+               or None if no cascade matches or the search was stopped.
+    """
+    header_format = FORMATS[format_name]
+    cascades = [cascade for cascade in header_format["cascades"] if cascade_available(cascade)]
+    if not cascades or search_stopped(slot):
+        return None
+
+    key = derive_header_key(prf, passphrase, volume_header[:SALT_SIZE], iterations,
+                            max(key_length(cascade) for cascade in cascades))
+    for cascade in cascades:
+        if search_stopped(slot):
+            return None
+        decrypted_header = crypt_header(cascade, key, volume_header[SALT_SIZE:FULL_HEADER_SIZE], False)
+        if header_valid(decrypted_header, header_format["magic"]):
+            return HeaderParameters(format_name, prf, iterations, cascade), decrypted_header, key
+    return None
+
+
+def remember_parameters(parameters):
+    """
+    Puts parameters at the front of the recently found ones.
+    """
+    with recent_parameters_lock:
+        if parameters in recent_parameters:
+            recent_parameters.remove(parameters)
+        recent_parameters.insert(0, parameters)
+        del recent_parameters[MAX_RECENT_PARAMETERS:]
+
+
+def detect_header(volume_header, passphrase, pim=None, workers=None, progress=None):
+    """
+    Finds the format, PRF and cascade of a header and decrypts it.
+    Combinations found recently in this process and the cheap TrueCrypt combinations are tried in the calling
+    process; the expensive ones are tried in parallel on the persistent derivation pool. At the first match the
+    search is stopped, so the workers skip its remaining combinations.
+
+    Args:
+        volume_header (bytes): The first 512 bytes (salt + encrypted header) of the volume.
+        passphrase (bytes): The password of the volume.
+        pim (int): Optional personal iterations multiplier of a VeraCrypt volume.
+        workers (int): Number of combinations derived at the same time (default: number of CPUs). 1 tries
+                       all combinations in the calling process.
+        progress (Progress): Optional progress of the job, checked between the combinations. Derivations
+                             already running in the pool are not waited for when the job is cancelled.
+
+    Returns:
+        tuple: The HeaderParameters and the decrypted 448 byte header, or None if the password is wrong
+               or the volume is not a TrueCrypt/VeraCrypt volume.
+
+    Raises:
+        Cancelled: If the job was cancelled.
+    """
+    volume_header = bytes(volume_header[:FULL_HEADER_SIZE])
+    candidates = header_candidates(pim)
+    with recent_parameters_lock:
+        recent = [parameters[:3] for parameters in recent_parameters]
+    candidates.sort(key=lambda candidate: (recent.index(candidate) if candidate in recent else len(recent),
+                                           candidate[2] > CHEAP_ITERATIONS))
+
+    workers = workers or os.cpu_count() or 1
+    serial = [candidate for candidate in candidates if candidate in recent or candidate[2] <= CHEAP_ITERATIONS]
+    parallel = [candidate for candidate in candidates if candidate not in serial]
+    if workers == 1 or len(parallel) <= 1:
+        serial, parallel = candidates, []
+
+    for candidate in serial:
+        if progress:
+            progress.check()
+        result = try_candidate(volume_header, passphrase, *candidate)
+        if result:
+            remember_parameters(result[0])
+            return result[:2]
+
+    if not parallel:
+        return None
+
+    pool, flags, slot = start_search()
+    queued = iter(parallel)
+    pending = set()
+    try:
+        # Only `workers` combinations are in the pool at a time, the next one is submitted when one is done
+        for candidate in queued:
+            pending.add(pool.submit(try_candidate, volume_header, passphrase, *candidate, slot))
+            if len(pending) >= workers:
+                break
+        while pending:
+            # Wake up regularly to notice a cancelled job
+            done, pending = wait(pending, timeout=CANCEL_POLL_INTERVAL if progress else None, return_when=FIRST_COMPLETED)
+            if progress:
+                progress.check()
+            for future in done:
+                result = future.result()
+                if result:
+                    # The key was derived in a worker, cache it in this process
+                    parameters, decrypted_header, key = result
+                    key_cache.put(volume_header[:SALT_SIZE], passphrase, parameters.prf, parameters.iterations, key)
+                    remember_parameters(parameters)
+                    return parameters, decrypted_header
+                candidate = next(queued, None)
+                if candidate:
+                    pending.add(pool.submit(try_candidate, volume_header, passphrase, *candidate, slot))
+    except BrokenProcessPool:
+        discard_derivation_pool(pool)
+        raise
+    finally:
+        # The workers skip the remaining combinations, running derivations are not waited for
+        stop_search(pool, flags, slot, pending)
+    return None
+
+
+def decrypt_header(parameters, volume_header, passphrase):
+    """
+    Decrypts a header whose parameters are already known, e.g. the backup header of a volume.
+
+    Args:
+        parameters (HeaderParameters): The parameters found by detect_header.
+        volume_header (bytes): The 512 bytes (salt + encrypted header).
+        passphrase (bytes): The password of the volume.
+
+    Returns:
+        bytes: The decrypted 448 byte header, or None if it is not valid with these parameters.
+    """
+    volume_header = bytes(volume_header[:FULL_HEADER_SIZE])
+    key = derive_header_key(parameters.prf, passphrase, volume_header[:SALT_SIZE], parameters.iterations,
+                            key_length(parameters.cipher))
+    decrypted_header = crypt_header(parameters.cipher, key, volume_header[SALT_SIZE:], False)
+    if not header_valid(decrypted_header, FORMATS[parameters.format]["magic"]):
+        return None
+    return decrypted_header
+
+
+def encrypt_header(parameters, salt, decrypted_header, passphrase):
+    """
+    Encrypts a decrypted header with the given parameters and salt.
+
+    Args:
+        parameters (HeaderParameters): The parameters found by detect_header.
+        salt (bytes): The 64 byte salt of the new header.
+        decrypted_header (bytes): The decrypted 448 byte header.
+        passphrase (bytes): The password of the volume.
+
+    Returns:
+        bytes: The encrypted 512 byte header, including the salt.
+    """
+    key = derive_header_key(parameters.prf, passphrase, salt, parameters.iterations, key_length(parameters.cipher))
+    return salt + crypt_header(parameters.cipher, key, decrypted_header, True)
@@ -0,0 +1,220 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+
+# AES-XTS engine for the data area of a TrueCrypt volume, used to re-key or verify whole volumes.
+# The data area is encrypted in 512 byte data units, each with its own tweak: the number of the unit,
+# counted from the start of the volume (the first unit of a normal volume behind the 128 KiB header
+# area is therefore unit 256), as a 16 byte little-endian integer.
+# The area is split into sector ranges which are memory-mapped and processed in parallel on a process pool.
+
+import mmap
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+SECTOR_SIZE = 512  # Size of a data unit, every unit has its own tweak
+BLOCKS_PER_SECTOR = SECTOR_SIZE // 16  # AES blocks per data unit
+RANGE_SIZE = 8 * 1024 * 1024  # Size of the sector ranges processed by one task (8 MiB)
+MASTER_KEY_SIZE = 64  # Primary and secondary AES-256 key of XTS
+# Offsets in the decrypted header (without the salt)
+DATA_OFFSET_OFFSET = 44  # Byte offset of the encrypted area in the volume (8 bytes, big-endian)
+DATA_LENGTH_OFFSET = 52  # Size of the encrypted area (8 bytes, big-endian)
+KEYS_OFFSET = 192  # Master keys area
+
+OPERATIONS = ("encrypt", "decrypt", "rekey", "checksum")
+
+
+def sector_tweak(sector):
+    """
+    Returns the XTS tweak of a data unit.
+
+    Args:
+        sector (int): Number of the data unit, counted from the start of the volume.
+
+    Returns:
+        bytes: The unit number as a 16 byte little-endian integer.
+    """
+    return sector.to_bytes(16, "little")
+
+
+def crypt_sectors(key, data, first_sector, encrypt, algorithm=algorithms.AES):
+    """
+    Encrypts or decrypts data units in place, each with the tweak of its unit number.
+    XTS is computed for all units of `data` at once: the tweaks of all units are encrypted in one ECB pass,
+    multiplied by the powers of alpha in GF(2^128) with NumPy, and the data is processed in a second ECB pass.
+    The result is identical to one XTS cipher per unit.
+
+    Args:
+        key (bytes): The 64 byte XTS key (primary + secondary key).
+        data (memoryview | bytearray | mmap): Writable buffer, a multiple of 16 bytes. Only the last unit may be
+                                               shorter than 512 bytes (e.g. the 448 byte volume header).
+        first_sector (int): Unit number of the first 512 bytes of `data`.
+        encrypt (bool): True to encrypt, False to decrypt.
+        algorithm (type): The 128 bit block cipher, a cryptography algorithm class (default: AES).
+    """
+    block_count = len(data) // 16
+    if not block_count:
+        return
+    sectors = -(-block_count // BLOCKS_PER_SECTOR)
+
+    # Encrypted tweak of every unit with the secondary key, as pairs of little-endian 64 bit words
+    tweaks = b"".join(sector_tweak(first_sector + sector) for sector in range(sectors))
+    tweak_encryptor = Cipher(algorithm(key[32:]), modes.ECB()).encryptor()
+    tweak = np.frombuffer(tweak_encryptor.update(tweaks), dtype="<u8").reshape(sectors, 2).copy()
+
+    # Tweak of every 16 byte block: the tweak of the unit multiplied by alpha once per block
+    masks = np.empty((sectors, BLOCKS_PER_SECTOR, 2), dtype="<u8")
+    for block in range(BLOCKS_PER_SECTOR):
+        masks[:, block] = tweak
+        carry = tweak[:, 1] >> np.uint64(63)
+        tweak[:, 1] = (tweak[:, 1] << np.uint64(1)) | (tweak[:, 0] >> np.uint64(63))
+        tweak[:, 0] = (tweak[:, 0] << np.uint64(1)) ^ (carry * np.uint64(0x87))
+
+    cipher = Cipher(algorithm(key[:32]), modes.ECB())
+    context = cipher.encryptor() if encrypt else cipher.decryptor()
+    masks = masks.reshape(-1)[:block_count * 2]
+    blocks = np.frombuffer(data, dtype="<u8", count=len(masks)) ^ masks
+    blocks = np.frombuffer(context.update(blocks.tobytes()), dtype="<u8") ^ masks
+    data[:block_count * 16] = blocks.tobytes()
+
+
+def process_range(path, operation, keys, offset, length, first_sector):
+    """
+    Processes one sector range of a file. Runs in the worker processes, so it opens and maps the file itself.
+
+    Args:
+        path (str): Path to the volume (or polyglot) file.
+        operation (str): "encrypt", "decrypt", "rekey" (decrypt with keys[0], encrypt with keys[1])
+                         or "checksum" (decrypt into memory, the file is not changed).
+        keys (tuple): The 64 byte XTS key(s) of the operation.
+        offset (int): Byte offset of the range in the file.
+        length (int): Length of the range, a multiple of 512 bytes.
+        first_sector (int): Unit number of the first sector of the range.
+
+    Returns:
+        tuple: offset, length and the CRC32 of the plaintext for "checksum" (None otherwise).
+    """
+    # mmap offsets must be aligned to the allocation granularity
+    map_offset = offset - offset % mmap.ALLOCATIONGRANULARITY
+    delta = offset - map_offset
+    writable = operation != "checksum"
+
+    with open(path, "r+b" if writable else "rb") as file:
+        with mmap.mmap(file.fileno(), delta + length, offset=map_offset,
+                       access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ) as mapped:
+            if not writable:
+                plaintext = bytearray(mapped[delta:delta + length])
+                crypt_sectors(keys[0], plaintext, first_sector, False)
+                return offset, length, zlib.crc32(plaintext)
+
+            view = memoryview(mapped)[delta:delta + length]
+            try:
+                if operation == "encrypt":
+                    crypt_sectors(keys[0], view, first_sector, True)
+                elif operation == "decrypt":
+                    crypt_sectors(keys[0], view, first_sector, False)
+                else:
+                    crypt_sectors(keys[0], view, first_sector, False)
+                    crypt_sectors(keys[1], view, first_sector, True)
+            finally:
+                view.release()
+            mapped.flush()
+    return offset, length, None
+
+
+def split_ranges(data_offset, data_length, first_sector, range_size=RANGE_SIZE):
+    """
+    Splits a data area into sector ranges.
+
+    Args:
+        data_offset (int): Byte offset of the data area in the file.
+        data_length (int): Length of the data area, a multiple of 512 bytes.
+        first_sector (int): Unit number of the first sector of the data area.
+        range_size (int): Maximum length of a range, a multiple of 512 bytes.
+
+    Returns:
+        list: Tuples of offset, length and unit number of the first sector of each range.
+    """
+    ranges = []
+    for position in range(0, data_length, range_size):
+        length = min(range_size, data_length - position)
+        ranges.append((data_offset + position, length, first_sector + position // SECTOR_SIZE))
+    return ranges
+
+
+def process_data_area(path, operation, keys, data_offset, data_length, first_sector=None,
+                      workers=None, range_size=RANGE_SIZE):
+    """
+    Encrypts, decrypts, re-keys or checksums the data area of a volume file in place.
+
+    Args:
+        path (str): Path to the volume (or polyglot) file.
+        operation (str): One of OPERATIONS, see process_range.
+        keys (tuple): The 64 byte XTS key(s), two for "rekey" (old, new), one otherwise.
+        data_offset (int): Byte offset of the data area in the file.
+        data_length (int): Length of the data area, a multiple of 512 bytes.
+        first_sector (int): Unit number of the first sector (default: data_offset / 512, as in TrueCrypt).
+        workers (int): Number of worker processes (default: number of CPUs). 1 processes the ranges
+                       serially in the calling process.
+        range_size (int): Length of the ranges given to one task, a multiple of 512 bytes.
+
+    Returns:
+        list: Per range in file order, a tuple of offset, length and the CRC32 of the plaintext ("checksum" only).
+
+    Raises:
+        ValueError: If the operation, the keys or the alignment of the data area are invalid.
+    """
+    if operation not in OPERATIONS:
+        raise ValueError(f"Unknown operation '{operation}', expected one of {', '.join(OPERATIONS)}.")
+    if len(keys) != (2 if operation == "rekey" else 1) or any(len(key) != MASTER_KEY_SIZE for key in keys):
+        raise ValueError(f"The operation '{operation}' needs {2 if operation == 'rekey' else 1} key(s) of {MASTER_KEY_SIZE} bytes.")
+    if data_offset % SECTOR_SIZE or data_length % SECTOR_SIZE or range_size % SECTOR_SIZE or range_size <= 0:
+        raise ValueError(f"The data area and the range size must be multiples of {SECTOR_SIZE} bytes.")
+    if data_offset + data_length > os.path.getsize(path):
+        raise ValueError(f"The data area ends behind the end of the file.")
+
+    if first_sector is None:
+        first_sector = data_offset // SECTOR_SIZE
+    ranges = split_ranges(data_offset, data_length, first_sector, range_size)
+    workers = workers or os.cpu_count() or 1
+
+    if workers == 1 or len(ranges) == 1:
+        return [process_range(path, operation, keys, *sector_range) for sector_range in ranges]
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as executor:
+        futures = [executor.submit(process_range, path, operation, keys, *sector_range) for sector_range in ranges]
+        return [future.result() for future in futures]
+
+
+def data_area_from_header(decrypted_header):
+    """
+    Reads the master key and the position of the data area from a decrypted header.
+
+    Args:
+        decrypted_header (bytes): The decrypted 448 byte header (without the salt), see Cryptomat.decrypt_header.
+
+    Returns:
+        tuple: The 64 byte XTS master key, the byte offset and the length of the data area.
+    """
+    key = bytes(decrypted_header[KEYS_OFFSET:KEYS_OFFSET + MASTER_KEY_SIZE])
+    data_offset = int.from_bytes(decrypted_header[DATA_OFFSET_OFFSET:DATA_OFFSET_OFFSET + 8], "big")
+    data_length = int.from_bytes(decrypted_header[DATA_LENGTH_OFFSET:DATA_LENGTH_OFFSET + 8], "big")
+    return key, data_offset, data_length
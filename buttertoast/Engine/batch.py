@@ -0,0 +1,342 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+
+# Batch mode: runs the jobs of a JSONL or CSV manifest on a pool of worker processes.
+# Every worker keeps one Engine for all of its jobs, so the interpreter start and the imports
+# are paid once per worker instead of once per job. The result of every job is written as one
+# JSON line (status, output path, bytes written, timings) to a result file.
+# Alternatively the jobs run in one process through the stages of a Pipeline (run_batch_pipeline),
+# which overlaps the reads, key derivations and writes of consecutive jobs.
+
+import csv
+import json
+import os
+import signal
+import time
+from concurrent.futures import CancelledError, ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+from buttertoast.Engine.pipeline import Pipeline, StreamJob
+from buttertoast.Engine.progress import Progress, cancel_on_interrupt
+
+JOB_FIELDS = ("host", "volume", "password", "output")
+
+# Engine of the current worker process, created by init_worker
+worker_engine = None
+# Progress of the job running in the worker process, and whether the batch was interrupted with Ctrl+C
+worker_progress = None
+worker_interrupted = False
+
+
+class BatchUI:
+    """
+    UI used inside the worker processes. It does not display anything but records
+    the error messages of the current job so they can be reported in the result file.
+    """
+
+    def __init__(self):
+        self.errors = []
+
+    def display_message(self, message, message_type):
+        if message_type == "error":
+            self.errors.append(message)
+
+
+def read_manifest(manifest_path):
+    """
+    Reads the jobs of a manifest. Files ending in '.csv' are read as CSV with a header line,
+    everything else as JSON lines. Every job needs the fields host, volume, password and output,
+    VeraCrypt volumes with a PIM also the field pim.
+
+    Args:
+        manifest_path (str): Path to the manifest.
+
+    Yields:
+        dict: The next job, with its line number in the manifest as "id" unless the job has an "id" field.
+    """
+    with open(manifest_path, 'r', newline='', encoding='utf-8') as manifest:
+        if manifest_path.lower().endswith('.csv'):
+            reader = csv.DictReader(manifest)
+            for row in reader:
+                yield {"id": reader.line_num, **{key: value for key, value in row.items() if value}}
+            return
+
+        for line_number, line in enumerate(manifest, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as e:
+                job = {"error": f"Invalid JSON: {e}"}
+            if not isinstance(job, dict):
+                job = {"error": "A job must be a JSON object."}
+            job.setdefault("id", line_number)
+            yield job
+
+
+def init_worker():
+    """
+    Initializes a worker process: creates the Engine that runs all jobs of this worker.
+    """
+    global worker_engine
+    # Imported here, the engine module imports this module
+    from buttertoast.Engine.engine import Engine
+    from buttertoast.Engine.eventManager import EventManager
+
+    worker_engine = Engine(EventManager())
+    # The jobs already run in parallel, the header format is detected in the worker itself
+    worker_engine.kdf_workers = 1
+    # Ctrl+C reaches the workers as well: the running job stops cleanly, the jobs queued in the worker are skipped
+    signal.signal(signal.SIGINT, interrupt_worker)
+
+
+def interrupt_worker(signum, frame):
+    """
+    SIGINT handler of the worker processes: cancels the running job at its next chunk boundary.
+    """
+    global worker_interrupted
+    worker_interrupted = True
+    if worker_progress:
+        worker_progress.cancel()
+
+
+def job_error(job):
+    """
+    Returns the error of an invalid job of the manifest: a line that could not be read, missing fields
+    or a PIM that is no number.
+
+    Args:
+        job (dict): The job read from the manifest.
+
+    Returns:
+        str: The error, or None if the job is valid.
+    """
+    missing = [field for field in JOB_FIELDS if not job.get(field)]
+    if job.get("error") or missing:
+        return job.get("error") or f"Missing fields: {', '.join(missing)}"
+    if job.get("pim") and not str(job["pim"]).isdigit():
+        return f"Invalid PIM: {job['pim']}"
+    return None
+
+
+def run_job(job):
+    """
+    Runs one job of the manifest in a worker process.
+
+    Args:
+        job (dict): The job with host, volume, password and output, and optionally the PIM of a VeraCrypt volume.
+
+    Returns:
+        dict: The result of the job (without the password), with the time of every stage.
+    """
+    global worker_progress
+    result = {"id": job.get("id"), "host": job.get("host"), "volume": job.get("volume"), "output": None}
+    started = time.time()
+    start = time.perf_counter()
+
+    error = job_error(job)
+    if error:
+        return {**result, "status": "error", "error": error, "bytes_written": 0, "started": started, "seconds": 0.0}
+    if worker_interrupted:
+        return {**result, "status": "cancelled", "error": "The batch was interrupted.", "bytes_written": 0,
+                "started": started, "seconds": 0.0}
+
+    ui = BatchUI()
+    worker_engine.ui = ui
+    worker_progress = worker_engine.progress = Progress()
+    try:
+        worker_engine.pim = int(job["pim"]) if job.get("pim") else None
+        outputfile = worker_engine.process_data_stream(job["host"], job["volume"], job["password"], job["output"])
+    except Exception as e:
+        outputfile = None
+        ui.errors.append(str(e))
+    finally:
+        worker_progress.end_stage()
+        worker_engine.progress = None
+    seconds = time.perf_counter() - start
+    progress, worker_progress = worker_progress, None
+    return job_result(result, outputfile, ui, progress, started, seconds)
+
+
+def job_result(result, outputfile, ui, progress, started, seconds):
+    """
+    Completes the result of a job that was run.
+
+    Args:
+        result (dict): The result with id, host, volume and output of the job.
+        outputfile (str): Path of the written polyglot, None if none was written.
+        ui (BatchUI): The UI that recorded the errors of the job.
+        progress (Progress): The progress of the job, with the time of every stage.
+        started (float): Time the job was started (seconds since the epoch).
+        seconds (float): Duration of the job.
+
+    Returns:
+        dict: The result of the job.
+    """
+    result["stages"] = progress.timings
+
+    if progress.cancelled:
+        return {**result, "status": "cancelled", "error": "The batch was interrupted.", "bytes_written": 0,
+                "started": started, "seconds": round(seconds, 6)}
+
+    if outputfile and not ui.errors:
+        return {**result, "status": "ok", "output": outputfile, "error": None,
+                "bytes_written": os.path.getsize(outputfile), "started": started, "seconds": round(seconds, 6)}
+
+    error = "; ".join(ui.errors) or "No polyglot was created."
+    return {**result, "status": "error", "output": outputfile, "error": error,
+            "bytes_written": 0, "started": started, "seconds": round(seconds, 6)}
+
+
+def run_batch(manifest_path, results_path, workers=None, ui=None):
+    """
+    Runs all jobs of a manifest on a process pool and writes one JSON line per job to the result file.
+    At most twice as many jobs as there are workers are queued at any time, so large manifests are
+    never loaded into memory completely. On Ctrl+C the queued jobs are dropped and the running jobs stop
+    at their next chunk boundary without leaving partial outputs; they are reported as "cancelled".
+
+    Args:
+        manifest_path (str): Path to the JSONL or CSV manifest.
+        results_path (str): Path to the result file (JSON lines).
+        workers (int): Number of worker processes (default: number of CPUs).
+        ui (UI): Optional UI instance to display the progress.
+
+    Returns:
+        dict: Number of successful ("ok"), failed ("error") and cancelled ("cancelled") jobs.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_pending = 2 * workers
+    summary = {"ok": 0, "error": 0, "cancelled": 0}
+
+    def write_result(future, job):
+        try:
+            result = future.result()
+        except CancelledError:
+            # Dropped from the queue when the batch was interrupted
+            result = {"id": job.get("id"), "host": job.get("host"), "volume": job.get("volume"), "output": None,
+                      "status": "cancelled", "error": "The batch was interrupted.", "bytes_written": 0, "started": None, "seconds": None}
+        except Exception as e:
+            # The worker process died, e.g. because it ran out of memory
+            result = {"id": job.get("id"), "host": job.get("host"), "volume": job.get("volume"), "output": None,
+                      "status": "error", "error": f"Worker failed: {e}", "bytes_written": 0, "started": None, "seconds": None}
+        results.write(json.dumps(result) + "\n")
+        results.flush()
+        summary[result["status"]] += 1
+        if ui:
+            ui.display_message(f"Job {result['id']}: {result['status']} {result['output'] or result['error']}", "verbose")
+
+    with open(results_path, 'w', encoding='utf-8') as results, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        pending = {}
+        try:
+            for job in read_manifest(manifest_path):
+                # Bounded queue: wait for a job to finish before queueing more
+                if len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        write_result(future, pending.pop(future))
+                pending[executor.submit(run_job, job)] = job
+
+            for future in as_completed(pending):
+                write_result(future, pending.pop(future))
+        except KeyboardInterrupt:
+            # The workers were interrupted as well, wait for their running jobs to stop
+            for future in pending:
+                future.cancel()
+            for future, job in pending.items():
+                write_result(future, job)
+
+    if ui:
+        ui.display_message(f"Batch finished: {summary['ok']} succeeded, {summary['error']} failed, {summary['cancelled']} cancelled. "
+                           f"Results written to '{results_path}'.", "info")
+    return summary
+
+
+def run_batch_pipeline(manifest_path, results_path, workers=None, ui=None):
+    """
+    Runs all jobs of a manifest in one process, passing them through the stages of a Pipeline
+    (read, plan, encrypt and write, see pipeline.py): while the keys of one job are derived, the next
+    job is read and the one before is written. `workers` threads derive keys, every other stage has one
+    thread. Writes the same result file as run_batch; on Ctrl+C the running jobs stop at their next chunk
+    boundary and the remaining jobs are reported as "cancelled".
+
+    Args:
+        manifest_path (str): Path to the JSONL or CSV manifest.
+        results_path (str): Path to the result file (JSON lines).
+        workers (int): Number of threads deriving keys (default: number of CPUs).
+        ui (UI): Optional UI instance to display the progress.
+
+    Returns:
+        dict: Number of successful ("ok"), failed ("error") and cancelled ("cancelled") jobs.
+    """
+    # Imported here, the engine module imports this module
+    from buttertoast.Engine.engine import Engine
+    from buttertoast.Engine.eventManager import EventManager
+
+    engine = Engine(EventManager())
+    # The jobs already overlap, the header format of a job is detected on its own thread
+    engine.kdf_workers = 1
+    workers = workers or os.cpu_count() or 1
+    summary = {"ok": 0, "error": 0, "cancelled": 0}
+
+    def create_jobs():
+        for job in read_manifest(manifest_path):
+            stream_job = StreamJob(job.get("host"), job.get("volume"), job.get("password"), job.get("output"), data=job)
+            stream_job.error = job_error(job)
+            if not stream_job.error:
+                stream_job.engine = engine.for_job(BatchUI(), Progress(), int(job["pim"]) if job.get("pim") else None)
+            stream_job.started = time.time()
+            stream_job.start = time.perf_counter()
+            yield stream_job
+
+    def stage(name):
+        def run(job):
+            # Invalid jobs leave the pipeline at the first stage
+            if job.engine is None:
+                return False
+            passed = job.engine.run_stream_stage(name, job)
+            # The time waiting for the next stage is not part of this one
+            job.engine.progress.end_stage()
+            return passed
+        return run
+
+    pipeline = Pipeline([(stage(name), workers if name == "encrypt_stream_job" else 1) for name in Engine.STREAM_STAGES])
+    with open(results_path, 'w', encoding='utf-8') as results, cancel_on_interrupt(pipeline):
+        for job in pipeline.run(create_jobs()):
+            result = {"id": job.data.get("id"), "host": job.host, "volume": job.volume, "output": None}
+            if job.engine is None:
+                result = {**result, "status": "error", "error": job.error, "bytes_written": 0,
+                          "started": job.started, "seconds": 0.0}
+            else:
+                job.engine.progress.end_stage()
+                if job.cancelled:
+                    job.engine.progress.cancel()
+                if job.error:
+                    job.engine.ui.errors.append(str(job.error))
+                result = job_result(result, job.outputfile, job.engine.ui, job.engine.progress, job.started,
+                                    time.perf_counter() - job.start)
+            results.write(json.dumps(result) + "\n")
+            results.flush()
+            summary[result["status"]] += 1
+            if ui:
+                ui.display_message(f"Job {result['id']}: {result['status']} {result['output'] or result['error']}", "verbose")
+
+    if ui:
+        ui.display_message(f"Batch finished: {summary['ok']} succeeded, {summary['error']} failed, {summary['cancelled']} cancelled. "
+                           f"Results written to '{results_path}'.", "info")
+    return summary
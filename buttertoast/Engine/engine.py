@@ -17,13 +17,120 @@
 
 
 import os
+import copy
 import json
-from buttertoast.Utilities.try_tchuntng import run_tchuntng, check_tchuntng
+import base64
+from contextlib import contextmanager
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from buttertoast.Engine.batch import run_batch, run_batch_pipeline
 from buttertoast.Engine.plugin_Loader import PluginLoader
 from buttertoast.UI.CLI import CLI
-from buttertoast.UI.tui import TUI  
-from buttertoast.UI.gui import GUI     
-from buttertoast.Crypt.cryptomat import Cryptomat
+from buttertoast.Crypt.cryptomat import Cryptomat, SALT_SIZE, FULL_HEADER_SIZE, HEADER_GROUP_SIZE
+from buttertoast.Crypt.key_cache import key_cache
+from buttertoast.Crypt.volume_formats import CANCEL_POLL_INTERVAL
+from buttertoast.Engine.progress import Cancelled, Progress, cancel_on_interrupt, describe_timings
+from buttertoast.Engine.layout import CHUNK_SIZE, BoundedFile, VolumeRange, layout_size, file_size, prefetch, read_at, read_layout_head, replace_head, save_layout, split_in_place, write_all, write_layout, pwrite_all
+from buttertoast.Engine.pipeline import StreamJob
+
+
+# Threads deriving the header keys of streamed jobs ahead of their plan, see Engine.start_key_derivation
+key_derivation_threads = None
+key_derivation_lock = threading.Lock()
+
+
+class DerivationFailed(Exception):
+    """
+    Raised at a chunk boundary of the copy of a streamed job when the header keys derived alongside it
+    could not be derived, see Engine.derivation_watch.
+    """
+
+
+def key_derivation_executor():
+    """
+    Returns the thread pool deriving header keys ahead of the plan, creating it on first use.
+    PBKDF2 (hashlib) releases the GIL, so the derivations run next to the reads and writes of the job.
+
+    Returns:
+        ThreadPoolExecutor: The thread pool.
+    """
+    global key_derivation_threads
+    with key_derivation_lock:
+        if key_derivation_threads is None:
+            key_derivation_threads = ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                        thread_name_prefix="key-derivation")
+        return key_derivation_threads
+
+
+@contextmanager
+def partial_output(outputfile):
+    """
+    Yields the path of a partial file next to the output file. The caller renames it to the output path
+    when the polyglot is complete; if the job fails or is cancelled before, the partial file is removed,
+    so no half-written polyglot is left behind and an existing output file is not touched.
+
+    Args:
+        outputfile (str): Path of the output file.
+
+    Yields:
+        str: Path of the partial file.
+    """
+    partfile = outputfile + ".part"
+    try:
+        yield partfile
+    finally:
+        if os.path.exists(partfile):
+            os.remove(partfile)
+
+
+def build_fanout_output(layout, volume, host, outputfile, salt_poly, decrypted_header, password, check=False,
+                        header_parameters=None, backup_header=None):
+    """
+    Builds one polyglot of a fan-out job. Runs in a worker process: derives the keys for the salt
+    of the host, encrypts the already decrypted volume header with them and writes the layout.
+    If `check` is set, the detectability of the polyglot is checked while it is written.
+
+    Args:
+        layout (list): The segments of the polyglot file, as planned by the plugin.
+        volume (str): Path to the volume file.
+        host (str): Path to the host file.
+        outputfile (str): Path of the polyglot file to write.
+        salt_poly (bytes): The 64 byte salt dictated by the host.
+        decrypted_header (bytes): The decrypted 448 byte header of the volume.
+        password (str): Password of the volume.
+        check (bool): Whether to check the detectability of the polyglot.
+        header_parameters (HeaderParameters): Format, PRF, iterations and cipher of the volume header.
+        backup_header (tuple): Offset, original bytes and decrypted content of the backup header of the volume.
+                               It is re-encrypted with a new salt if the polyglot keeps it at its offset.
+
+    Returns:
+        tuple: Path of the written polyglot file, the result of the check (None if not checked) and
+               the offset of the re-encrypted backup header (None if there is none).
+    """
+    verifier = None
+    if check:
+        from buttertoast.Utilities.detectability import DetectabilityVerifier
+        verifier = DetectabilityVerifier(PluginLoader().registry.get_magic_trie())
+
+    new_header = Cryptomat().encrypt_header(salt_poly, decrypted_header, password, header_parameters)
+    backup_offset = None
+    with partial_output(outputfile) as partfile:
+        with open(volume, 'rb') as volume_file, open(host, 'rb') as host_file:
+            save_layout(replace_head(layout, new_header), volume_file, host_file, partfile,
+                        verifier.update if verifier else None)
+
+        if backup_header:
+            offset, original_header, decrypted_backup = backup_header
+            fd = os.open(partfile, os.O_RDWR | getattr(os, "O_BINARY", 0))
+            try:
+                if os.pread(fd, FULL_HEADER_SIZE, offset) == original_header:
+                    new_backup = Cryptomat().encrypt_header(os.urandom(SALT_SIZE), decrypted_backup, password, header_parameters)
+                    pwrite_all(fd, new_backup, offset)
+                    backup_offset = offset
+            finally:
+                os.close(fd)
+        os.replace(partfile, outputfile)
+    return outputfile, verifier.result() if verifier else None, backup_offset
 
 
 class Engine:
@@ -34,6 +141,10 @@ class Engine:
         self.event_manager = event_manager
         self.config = self.load_config()
         self.ui = None
+        self.pim = None  # Personal iterations multiplier of a VeraCrypt volume
+        self.kdf_workers = None  # Processes detecting the header format, default: number of CPUs
+        self.progress = None  # Progress of the running job, set by UIs that show it or can cancel the job
+        key_cache.configure(self.config.get("key_cache", False))
 
 
     def load_config(self):
@@ -67,10 +178,14 @@ class Engine:
         """
         Selects the user interface (GUI or TUI) based on the configuration.
         """
+        # The UIs are imported here, so only the selected one and its dependencies
+        # (PySide6 and markdown for the GUI, rich for the TUI) are loaded
         use_gui = self.config.get("gui", False)
         if use_gui:
+            from buttertoast.UI.gui import GUI
             self.ui = GUI(self, self.event_manager)  
         else:
+            from buttertoast.UI.tui import TUI
             self.ui = TUI(self, self.event_manager)  
 
     def start_ui(self):
@@ -91,48 +206,1103 @@ class Engine:
             password (str): Password for encryption.
             output (str): Path to the output file.
 
+        Returns:
+            str: Path of the written polyglot file, or None if it could not be created.
+
         Raises:
             ValueError: If any of the inputs are missing.
             Exception: If there is an error during plugin execution or file saving.
         """
         try:
 
-            # Extract file extension from host file
-            extension = self.get_file_extension(host)
+            # Detect the plugin by the content of the host file, falling back to its extension
+            plugin = PluginLoader(ui=self.ui)
+            extension, plugin_name = plugin.detect_plugin(host)
+            if not plugin_name:
+                return
 
             # Load and run the plugin, passing the extension
-            plugin = PluginLoader(ui=self.ui)
-            poly_bytecode = plugin.load_and_run_plugin(volume_bytecode, host_bytecode, extension)
+            poly_bytecode = plugin.load_and_run_plugin(volume_bytecode, host_bytecode, extension, plugin_name, self.progress)
             if not poly_bytecode:
                 return
 
             # Perform encryption using Cryptomat
-            cryptomat = Cryptomat(ui=self.ui)
+            cryptomat = self.create_cryptomat()
             buttertoast = cryptomat.cryptomator(volume_bytecode, poly_bytecode, password)
 
             if buttertoast is None:
                 return
 
-            # Save the result to a file, cut old fileextension if neccessary
-            if '.' in output and os.path.splitext(output)[1]:  
-                output = os.path.splitext(output)[0]
-            outputfile = output + '.' + extension
-            self.save_bytecode_to_file(buttertoast, outputfile)
+            # Check the polyglot in memory, before it is saved
+            verifier = self.create_verifier()
+            if verifier:
+                self.report_stage("Checking the polyglot", len(buttertoast))
+                for position in range(0, len(buttertoast), CHUNK_SIZE):
+                    verifier.update(buttertoast[position:position + CHUNK_SIZE])
+                    self.advance_progress(min(CHUNK_SIZE, len(buttertoast) - position))
+
+            # Save the result to a file, it gets its name when it is complete
+            self.report_stage("Writing the polyglot", len(buttertoast))
+            outputfile = self.get_output_path(output, extension)
+            with partial_output(outputfile) as partfile:
+                if not self.save_bytecode_to_file(buttertoast, partfile):
+                    return
+                backup_offset = self.resalt_backup_header(cryptomat, partfile, len(volume_bytecode), password)
+                os.replace(partfile, outputfile)
+            self.report_stage("Verifying the polyglot")
+            if not self.verify_output(outputfile, plugin.load_plugin(extension, plugin_name), password, backup_offset):
+                return
+            self.finish_output(outputfile, verifier.result() if verifier else None)
+            return outputfile
 
-            # Display success message
-            check = self.config.get("check", False)
-            if not check:
+        except Cancelled:
+            self.ui.display_message(f"Processing cancelled.", "info")
 
-                self.ui.display_message(f"File {os.path.basename(outputfile)} successfully created", "info")
-                return
+        except Exception as e:
+            # Display error message to UI
+            self.ui.display_message(f"Error during processing: {str(e)}", "error")
+
+    def process_data_stream(self, host, volume, password, output):
+        """
+        Builds the polyglot without loading the volume into memory.
+        Only the host and volume headers are read up front, the plugin describes the polyglot
+        as a layout and the volume and host ranges are copied into the output file.
+        The stages of STREAM_STAGES run one after the other, batch runs pass them through a Pipeline instead.
+
+        Args:
+            host (str): Path to the host file.
+            volume (str): Path to the volume file.
+            password (str): Password for encryption.
+            output (str): Path to the output file.
+
+        Returns:
+            str: Path of the written polyglot file, or None if it could not be created.
+        """
+        job = StreamJob(host, volume, password, output, engine=self)
+        try:
+            for stage in self.STREAM_STAGES:
+                if not self.run_stream_stage(stage, job):
+                    return None
+            return job.outputfile
+        finally:
+            job.close()
+
+    # Stages of a streamed job, see pipeline.py
+    STREAM_STAGES = ("read_stream_job", "plan_stream_job", "encrypt_stream_job", "write_stream_job")
+
+    def run_stream_stage(self, stage, job):
+        """
+        Runs one stage of a streamed job and displays its errors.
+
+        Args:
+            stage (str): Name of the stage method, one of STREAM_STAGES.
+            job (StreamJob): The job.
+
+        Returns:
+            bool: True if the job can go on to the next stage, False if it failed or was cancelled.
+        """
+        try:
+            return getattr(self, stage)(job)
+
+        except Cancelled:
+            self.ui.display_message(f"Processing cancelled.", "info")
 
-            run_tchuntng(outputfile, self.ui)
+        except Exception as e:
+            # Display error message to UI
+            self.ui.display_message(f"Error during processing: {str(e)}", "error")
+        return False
+
+    def read_stream_job(self, job):
+        """
+        Read stage: detects the plugin and checks the host and volume headers before anything large is read,
+        opens both files and asks the OS to read their start ahead for the write stage.
+        """
+        self.report_stage("Reading the headers")
+        job.extension, job.plugin = self.preflight(job.host, job.volume)
+        if not job.plugin:
+            return False
+        job.open()
+        job.volume_size = file_size(job.volume_file)
+        prefetch(job.host_file)
+        prefetch(job.volume_file)
+        self.start_key_derivation(job)
+        return True
+
+    def start_key_derivation(self, job):
+        """
+        Starts re-encrypting the header and the backup header of a streamed job on a thread pool as soon as its
+        salt is known: the plugin predicts it from the first bytes of the host (plugin_Interface.salt_for), the
+        rest is taken from the volume header. So the key derivations run while the job is planned and written,
+        encrypt_stream_job checks the prediction against the plan. Nothing is started if the plugin cannot
+        predict the salt.
+        """
+        prefix = job.plugin.salt_for(read_at(job.host_file, 0, SALT_SIZE), job.volume_size)
+        if prefix is None:
             return
+        volume_header = read_at(job.volume_file, 0, FULL_HEADER_SIZE)
+        job.predicted_salt = (bytes(prefix) + volume_header[len(prefix):SALT_SIZE])[:SALT_SIZE]
+        self.ui.display_message(f"Deriving the header keys for the salt of the host while the files are processed...", "verbose")
+        # Without progress: the stages are reported by the stage waiting for the headers
+        cryptomat = Cryptomat(ui=self.ui, pim=self.pim, workers=self.kdf_workers)
+        # The thread gets its own descriptor, the job may close its files before the derivation has finished
+        job.headers = key_derivation_executor().submit(self.recrypt_headers, cryptomat, os.dup(job.volume_file.fileno()),
+                                                       volume_header, job.predicted_salt, job.volume_size, job.password)
+
+    def recrypt_headers(self, cryptomat, fd, volume_header, salt_poly, volume_size, password):
+        """
+        Re-encrypts the header of a volume with the salt of the polyglot and its backup header with a new salt.
+
+        Args:
+            cryptomat (Cryptomat): The Cryptomat deriving the keys.
+            fd (int): Duplicated file descriptor of the volume, closed when the headers are re-encrypted.
+            volume_header (bytes): The first 512 bytes of the volume.
+            salt_poly (bytes): The 64 byte salt dictated by the host.
+            volume_size (int): The size of the volume.
+            password (str): Password of the volume.
+
+        Returns:
+            tuple: The new header (None if it could not be decrypted) and the offset, original and re-encrypted
+                   backup header (None if there is none), see recrypt_backup_header.
+        """
+        try:
+            new_header = cryptomat.recrypt_header(volume_header, salt_poly, password)
+            if new_header is None:
+                return None, None
+            return new_header, self.recrypt_backup_header(cryptomat, fd, volume_size, password)
+        finally:
+            os.close(fd)
+
+    def wait_for_headers(self, job):
+        """
+        Waits for the headers re-encrypted by start_key_derivation, stopping if the job is cancelled.
+
+        Returns:
+            bytes: The new header, or None if the header could not be decrypted.
+        """
+        self.report_stage("Deriving the header key")
+        while not wait([job.headers], timeout=CANCEL_POLL_INTERVAL).done:
+            if self.progress:
+                self.progress.check()
+        new_header, job.backup_header = job.headers.result()
+        job.headers = None
+        return new_header
+
+    def derivation_watch(self, job):
+        """
+        Returns the progress function for the copy of a streamed job: it advances the progress of the job and,
+        while the header keys are derived alongside the copy, raises DerivationFailed as soon as the derivation
+        has failed, so a wrong password does not wait for a complete copy of the volume.
+
+        Returns:
+            callable: Function called with the number of bytes written after every chunk, or None if the
+                      headers are already known.
+        """
+        if job.headers is None:
+            return None
+
+        def advance(count):
+            if self.progress:
+                self.progress.advance(count)
+            if job.headers.done() and (job.headers.exception() is not None or job.headers.result()[0] is None):
+                raise DerivationFailed()
+        return advance
+
+    def plan_stream_job(self, job):
+        """
+        Plan stage: lets the plugin describe the polyglot as a layout.
+        """
+        self.report_stage("Planning the polyglot")
+        self.ui.display_message(f"Planning the layout of the polyglot file...", "verbose")
+        job.layout = job.plugin.plan(job.volume_file, job.host_file)
+        if not job.layout:
+            self.ui.display_message(f"The plugin for '{job.extension}' did not create a polyglot.", "error")
+            return False
+        return True
+
+    def encrypt_stream_job(self, job):
+        """
+        Encrypt stage: re-encrypts the header with the salt dictated by the host, and the backup header
+        with a new salt. Both are read from the volume, the write stage puts them into the polyglot.
+        If the keys are already derived for the predicted salt (see start_key_derivation), the write stage
+        takes the headers when the layout is copied; only the check of the polyglot needs them before.
+        """
+        salt_poly = read_layout_head(job.layout, job.volume_file, job.host_file, SALT_SIZE)
+        if job.headers is not None:
+            if salt_poly == job.predicted_salt:
+                if not self.config.get("check", False):
+                    return True
+                new_header = self.wait_for_headers(job)
+                if new_header is None:
+                    return False
+                job.layout = replace_head(job.layout, new_header)
+                return True
+            self.ui.display_message(f"The plugin predicted another salt than it planned, deriving the header keys again.", "verbose")
+            job.headers = None
+
+        volume_header = read_at(job.volume_file, 0, FULL_HEADER_SIZE)
+        new_header, job.backup_header = self.recrypt_headers(self.create_cryptomat(), os.dup(job.volume_file.fileno()),
+                                                             volume_header, salt_poly, job.volume_size, job.password)
+        if new_header is None:
+            return False
+        job.layout = replace_head(job.layout, new_header)
+        return True
+
+    def write_stream_job(self, job):
+        """
+        Write stage: streams the polyglot into a partial file, checking it while it is written, and gives it
+        the output name when it is complete. Then the polyglot is verified. Headers that are still derived
+        (see start_key_derivation) are written over the start of the partial file when the copy is done;
+        if their derivation fails (e.g. with a wrong password), the copy stops at the next chunk boundary.
+        """
+        if job.headers is not None and job.headers.done():
+            # Derived already (or failed, e.g. with a wrong password): the header is written with the layout
+            new_header = self.wait_for_headers(job)
+            if new_header is None:
+                return False
+            job.layout = replace_head(job.layout, new_header)
+
+        self.report_stage("Writing the polyglot", layout_size(job.layout))
+        verifier = self.create_verifier()
+        outputfile = self.get_output_path(job.output, job.extension)
+        with partial_output(outputfile) as partfile:
+            try:
+                if not self.save_layout_to_file(job.layout, job.volume_file, job.host_file, partfile,
+                                                verifier.update if verifier else None, self.derivation_watch(job)):
+                    return False
+            except DerivationFailed:
+                pass  # wait_for_headers reports the failure
+            if job.headers is not None:
+                # The keys were derived while the layout was copied, the header is written over its start
+                new_header = self.wait_for_headers(job)
+                if new_header is None:
+                    return False
+                fd = os.open(partfile, os.O_RDWR | getattr(os, "O_BINARY", 0))
+                try:
+                    pwrite_all(fd, new_header, 0)
+                finally:
+                    os.close(fd)
+            backup_offset = self.write_backup_header(partfile, job.backup_header)
+            os.replace(partfile, outputfile)
+
+        self.report_stage("Verifying the polyglot")
+        if not self.verify_output(outputfile, job.plugin, job.password, backup_offset):
+            return False
+        self.finish_output(outputfile, verifier.result() if verifier else None)
+        job.outputfile = outputfile
+        return True
+
+    def process_data_in_place(self, host, volume, password, output, backup=None):
+        """
+        Builds the polyglot from the volume file itself: the re-encrypted header overwrites the first 512 bytes
+        of the volume, the rest of the polyglot (e.g. the host) is appended and the volume file is renamed to
+        the output path. Only the host is copied, the I/O does not depend on the size of the volume.
+        The original header is saved to a backup file first, see undo_in_place.
+        Falls back to process_data_stream if the plugin does not support the in-place mode.
+
+        Args:
+            host (str): Path to the host file.
+            volume (str): Path to the volume file, which becomes the polyglot.
+            password (str): Password for encryption.
+            output (str): Path to the output file.
+            backup (str): Path to the backup file (default: the output path with '.header.bak' appended).
+
+        Returns:
+            str: Path of the written polyglot file, or None if it could not be created.
+        """
+        try:
+            # Detect the plugin and check host and volume headers before anything large is read
+            extension, plugin = self.preflight(host, volume)
+            if not plugin:
+                return
+
+            if not plugin.in_place:
+                self.ui.display_message(f"The plugin for '{extension}' does not support the in-place mode, the volume is copied instead.", "info")
+                return self.process_data_stream(host, volume, password, output)
+
+            outputfile = self.get_output_path(output, extension)
+            backup = backup or outputfile + ".header.bak"
+
+            with open(volume, 'rb') as volume_file, open(host, 'rb') as host_file:
+                self.report_stage("Planning the polyglot")
+                self.ui.display_message(f"Planning the layout of the polyglot file...", "verbose")
+                layout = plugin.plan(volume_file, host_file)
+                if not layout:
+                    self.ui.display_message(f"The plugin for '{extension}' did not create a polyglot.", "error")
+                    return
+
+                # Re-encrypt the header with the salt dictated by the host
+                salt_poly = read_layout_head(layout, volume_file, host_file, SALT_SIZE)
+                volume_header = read_at(volume_file, 0, FULL_HEADER_SIZE)
+                cryptomat = self.create_cryptomat()
+                new_header = cryptomat.recrypt_header(volume_header, salt_poly, password)
+                if new_header is None:
+                    return
+
+                volume_size = file_size(volume_file)
+                backup_header = self.recrypt_backup_header(cryptomat, volume_file.fileno(), volume_size, password)
+                parts = split_in_place(replace_head(layout, new_header), volume_size)
+                if parts is None:
+                    self.ui.display_message(f"The layout of the plugin for '{extension}' does not keep the volume at its offsets.", "error")
+                    return
+                head, tail = parts
+
+                # Save the original header, then patch the volume file
+                self.report_stage("Writing the polyglot", layout_size(tail))
+                self.save_in_place_backup(backup, volume, outputfile, volume_size, volume_header, backup_header)
+                self.ui.display_message(f"Original header saved to '{backup}'.", "verbose")
+                try:
+                    self.patch_volume(volume, volume_size, volume_header, head, tail, volume_file, host_file, backup_header)
+                except Cancelled:
+                    # The volume was restored, its backup is not needed
+                    os.remove(backup)
+                    raise
+
+            if os.path.abspath(volume) != os.path.abspath(outputfile):
+                os.replace(volume, outputfile)
+            self.ui.display_message(f"Volume '{volume}' patched in place and saved as '{outputfile}'.", "verbose")
+
+            self.report_stage("Verifying the polyglot")
+            if not self.verify_output(outputfile, plugin, password, backup_header[0] if backup_header else None):
+                return
+            self.finish_output(outputfile)
+            return outputfile
+
+        except Cancelled:
+            self.ui.display_message(f"Processing cancelled.", "info")
+
+        except Exception as e:
+            # Display error message to UI
+            self.ui.display_message(f"Error during processing: {str(e)}", "error")
+
+    def recrypt_backup_header(self, cryptomat, fd, volume_size, password):
+        """
+        Reads the backup header of a volume with one os.pread and re-encrypts it with a new salt.
+        The header of the volume must have been decrypted by `cryptomat` before.
+
+        Args:
+            cryptomat (Cryptomat): The Cryptomat that decrypted the header of the volume.
+            fd (int): File descriptor of the volume or of a polyglot keeping the volume at its offsets.
+            volume_size (int): The size of the volume.
+            password (str): Password of the volume.
+
+        Returns:
+            tuple: Offset, original and re-encrypted backup header, or None if the volume has no backup header.
+        """
+        offset = cryptomat.backup_header_offset(volume_size)
+        if offset is None:
+            return None
+        original_header = os.pread(fd, FULL_HEADER_SIZE, offset)
+        new_header = cryptomat.recrypt_backup_header(original_header, password)
+        if new_header is None:
+            return None
+        return offset, original_header, new_header
+
+    def resalt_backup_header(self, cryptomat, outputfile, volume_size, password):
+        """
+        Re-encrypts the backup header inside a written polyglot with os.pread/os.pwrite at its offset,
+        without reading or copying the rest of the file.
+
+        Args:
+            cryptomat (Cryptomat): The Cryptomat that decrypted the header of the volume.
+            outputfile (str): Path to the written polyglot, keeping the volume at its offsets.
+            volume_size (int): The size of the volume.
+            password (str): Password of the volume.
+
+        Returns:
+            int: Offset of the re-encrypted backup header, or None if there is none.
+        """
+        fd = os.open(outputfile, os.O_RDWR | getattr(os, "O_BINARY", 0))
+        try:
+            backup_header = self.recrypt_backup_header(cryptomat, fd, volume_size, password)
+            if backup_header is None:
+                return None
+            pwrite_all(fd, backup_header[2], backup_header[0])
+        finally:
+            os.close(fd)
+        self.ui.display_message(f"Backup header at offset {backup_header[0]} re-encrypted.", "verbose")
+        return backup_header[0]
+
+    def write_backup_header(self, outputfile, backup_header):
+        """
+        Writes a backup header that was re-encrypted before the polyglot was written (see recrypt_backup_header)
+        with os.pwrite at its offset, if the polyglot keeps the original backup header there.
+
+        Args:
+            outputfile (str): Path to the written polyglot.
+            backup_header (tuple): Offset, original and re-encrypted backup header, or None.
+
+        Returns:
+            int: Offset of the re-encrypted backup header, or None if there is none.
+        """
+        if backup_header is None:
+            return None
+        offset, original_header, new_header = backup_header
+        fd = os.open(outputfile, os.O_RDWR | getattr(os, "O_BINARY", 0))
+        try:
+            if os.pread(fd, FULL_HEADER_SIZE, offset) != original_header:
+                return None
+            pwrite_all(fd, new_header, offset)
+        finally:
+            os.close(fd)
+        self.ui.display_message(f"Backup header at offset {offset} re-encrypted.", "verbose")
+        return offset
+
+    def patch_volume(self, volume, volume_size, volume_header, head, tail, volume_file, host_file, backup_header=None):
+        """
+        Appends the tail of the polyglot to the volume file and overwrites its start with the new header,
+        and the backup header with its re-encrypted version.
+        If anything fails, the appended data is cut off and the original headers are written back.
+
+        Args:
+            volume (str): Path to the volume file.
+            volume_size (int): The original size of the volume.
+            volume_header (bytes): The original first 512 bytes of the volume.
+            head (bytes): The bytes overwriting the start of the volume.
+            tail (list): The segments appended after the volume.
+            volume_file (BinaryIO): The opened volume file (read-only).
+            host_file (BinaryIO): The opened host file.
+            backup_header (tuple): Offset, original and re-encrypted backup header, see recrypt_backup_header.
+        """
+        fd = os.open(volume, os.O_RDWR | getattr(os, "O_BINARY", 0))
+        try:
+            try:
+                os.lseek(fd, volume_size, os.SEEK_SET)
+                write_layout(tail, volume_file, host_file, fd, progress=self.progress.advance if self.progress else None)
+                if backup_header:
+                    pwrite_all(fd, backup_header[2], backup_header[0])
+                os.lseek(fd, 0, os.SEEK_SET)
+                write_all(fd, head)
+                os.fsync(fd)
+            except BaseException:
+                os.ftruncate(fd, volume_size)
+                if backup_header:
+                    pwrite_all(fd, backup_header[1], backup_header[0])
+                os.lseek(fd, 0, os.SEEK_SET)
+                write_all(fd, volume_header)
+                raise
+        finally:
+            os.close(fd)
+
+    def save_in_place_backup(self, backup, volume, outputfile, volume_size, volume_header, backup_header=None):
+        """
+        Writes the backup of an in-place build: the original header and backup header, size and path of the volume.
+
+        Args:
+            backup (str): Path to the backup file.
+            volume (str): Path to the volume file.
+            outputfile (str): Path the patched volume is saved as.
+            volume_size (int): The original size of the volume.
+            volume_header (bytes): The original first 512 bytes of the volume.
+            backup_header (tuple): Offset, original and re-encrypted backup header, see recrypt_backup_header.
+        """
+        data = {
+            "volume": os.path.abspath(volume),
+            "polyglot": os.path.abspath(outputfile),
+            "volume_size": volume_size,
+            "header": base64.b64encode(volume_header).decode('ascii'),
+        }
+        if backup_header:
+            data["backup_header_offset"] = backup_header[0]
+            data["backup_header"] = base64.b64encode(backup_header[1]).decode('ascii')
+        with open(backup, 'w') as file:
+            json.dump(data, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def undo_in_place(self, backup):
+        """
+        Turns a polyglot built in place back into the original volume: cuts off the appended data,
+        writes the original header back and renames the file to the original volume path.
+
+        Args:
+            backup (str): Path to the backup file written by process_data_in_place.
+
+        Returns:
+            str: Path of the restored volume, or None if it could not be restored.
+        """
+        try:
+            with open(backup, 'r') as file:
+                data = json.load(file)
+            volume_header = base64.b64decode(data["header"])
+            polyglot = data["polyglot"]
+
+            fd = os.open(polyglot, os.O_RDWR | getattr(os, "O_BINARY", 0))
+            try:
+                os.ftruncate(fd, data["volume_size"])
+                if "backup_header" in data:
+                    pwrite_all(fd, base64.b64decode(data["backup_header"]), data["backup_header_offset"])
+                os.lseek(fd, 0, os.SEEK_SET)
+                write_all(fd, volume_header)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+            if polyglot != data["volume"]:
+                os.replace(polyglot, data["volume"])
+            os.remove(backup)
+            self.ui.display_message(f"Volume '{data['volume']}' restored.", "info")
+            return data["volume"]
+
+        except Exception as e:
+            # Display error message to UI
+            self.ui.display_message(f"Error restoring the volume from '{backup}': {str(e)}", "error")
+
+    def rekey(self, polyglot, old_password, new_password):
+        """
+        Changes the password of an existing polyglot (or volume) without rebuilding it. Only the header
+        depends on the password: it is read with one os.pread, decrypted with the old password, re-encrypted
+        with the new one under the same host-dictated salt and written back with os.pwrite. The backup header,
+        if there is one, is changed the same way. The I/O does not depend on the size of the file.
+
+        Args:
+            polyglot (str): Path to the polyglot file.
+            old_password (str): The current password of the volume.
+            new_password (str): The new password.
+
+        Returns:
+            bool: True if the password was changed, False otherwise.
+        """
+        try:
+            self.report_stage("Deriving the header key")
+            cryptomat = self.create_cryptomat()
+            fd = os.open(polyglot, os.O_RDWR | getattr(os, "O_BINARY", 0))
+            try:
+                header = os.pread(fd, FULL_HEADER_SIZE, 0)
+                new_header = cryptomat.rekey_header(header, old_password, new_password)
+                if new_header is None:
+                    return False
+
+                # The backup header is located by the size of the volume stored in the header
+                new_backup = None
+                backup_offset = cryptomat.backup_header_offset(cryptomat.volume_size())
+                if backup_offset is not None and backup_offset + FULL_HEADER_SIZE <= os.fstat(fd).st_size:
+                    backup_header = os.pread(fd, FULL_HEADER_SIZE, backup_offset)
+                    new_backup = cryptomat.rekey_backup_header(backup_header, old_password, new_password)
+
+                if new_backup is not None:
+                    pwrite_all(fd, new_backup, backup_offset)
+                pwrite_all(fd, new_header, 0)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+            self.ui.display_message(f"Header{' and backup header' if new_backup else ''} of '{polyglot}' re-encrypted.", "verbose")
+            if not self.verify_header_of(polyglot, new_password, backup_offset if new_backup else None):
+                return False
+            self.ui.display_message(f"The password of '{polyglot}' was changed.", "info")
+            return True
+
+        except Cancelled:
+            raise
+        except Exception as e:
+            # Display error message to UI
+            self.ui.display_message(f"Error changing the password of '{polyglot}': {str(e)}", "error")
+            return False
+
+    def swap_host(self, polyglot, host, password):
+        """
+        Replaces the host of an existing polyglot without copying the volume again. All built-in plugins keep
+        the volume at its original offsets, so the volume inside the polyglot ends at the size stored in its
+        header. The plugin of the new host plans the polyglot from that part of the file, the host-dependent
+        tail is cut off and rewritten and the header is re-encrypted under the salt dictated by the new host.
+        Only the new host and the header are written, the volume data is not touched.
+        The old tail is kept in a copy until the new header is written, see preserved_tail, and the old
+        header stays valid until the tail is written, it is replaced last.
+
+        Args:
+            polyglot (str): Path to the polyglot file.
+            host (str): Path to the new host file.
+            password (str): Password of the volume.
+
+        Returns:
+            str: Path of the polyglot (renamed if the new host has another file extension), or None on errors.
+        """
+        try:
+            extension, plugin = PluginLoader(ui=self.ui).load_plugin_for_host(host)
+            if not plugin:
+                return None
+            if not plugin.in_place:
+                self.ui.display_message(f"The plugin for '{extension}' moves the volume, the host cannot be swapped.", "error")
+                return None
+
+            cryptomat = self.create_cryptomat()
+            with open(polyglot, 'rb') as polyglot_file, open(host, 'rb') as host_file:
+                if not self.validate_host(plugin, host_file, host):
+                    return None
+
+                decrypted_header = cryptomat.decrypt_header(read_at(polyglot_file, 0, FULL_HEADER_SIZE), password)
+                if decrypted_header is None:
+                    self.ui.display_message(f"Decryption failed. Wrong password or invalid volume.", "error")
+                    return None
+                # Without a backup header area (TrueCrypt before 6.0) the end of the volume is not known
+                volume_size = cryptomat.volume_size()
+                if cryptomat.encrypted_area[1] <= 0 or volume_size < 2 * HEADER_GROUP_SIZE:
+                    self.ui.display_message(f"The header of '{polyglot}' does not describe the size of the volume, the host cannot be swapped.", "error")
+                    return None
+                if volume_size > file_size(polyglot_file):
+                    self.ui.display_message(f"The volume described by the header of '{polyglot}' ends behind the end of the file.", "error")
+                    return None
+
+                # Plan the new polyglot from the volume inside the old one
+                volume = BoundedFile(polyglot_file, volume_size)
+                layout = plugin.plan(volume, host_file)
+                if not layout:
+                    self.ui.display_message(f"The plugin for '{extension}' did not create a polyglot.", "error")
+                    return None
+                salt_poly = read_layout_head(layout, volume, host_file, SALT_SIZE)
+                new_header = cryptomat.encrypt_header(salt_poly, decrypted_header, password)
+                parts = split_in_place(replace_head(layout, new_header), volume_size)
+                if parts is None:
+                    self.ui.display_message(f"The plugin for '{extension}' does not keep the volume at its offsets.", "error")
+                    return None
+                head, tail = parts
+
+                # Rewrite the tail, then the header
+                self.ui.display_message(f"Replacing the host of '{polyglot}' behind byte {volume_size}...", "verbose")
+                fd = os.open(polyglot, os.O_RDWR | getattr(os, "O_BINARY", 0))
+                try:
+                    with self.preserved_tail(fd, polyglot_file, polyglot, volume_size, len(head)):
+                        os.ftruncate(fd, volume_size)
+                        os.lseek(fd, volume_size, os.SEEK_SET)
+                        write_layout(tail, volume, host_file, fd)
+                        os.fsync(fd)
+                        pwrite_all(fd, head, 0)
+                        os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+            outputfile = self.get_output_path(polyglot, extension)
+            if outputfile != polyglot:
+                os.replace(polyglot, outputfile)
+            if not self.verify_output(outputfile, plugin, password):
+                return None
+            self.ui.display_message(f"Host of {os.path.basename(outputfile)} replaced by {os.path.basename(host)}", "info")
+            return outputfile
+
+        except Exception as e:
+            # Display error message to UI
+            self.ui.display_message(f"Error replacing the host of '{polyglot}': {str(e)}", "error")
+            return None
+
+    def process_data_fanout(self, hosts, volume, password, output_dir, workers=None):
+        """
+        Embeds one volume into many host files. The volume header is decrypted only once, the
+        polyglots are planned in this process and the key derivation for each host-specific salt,
+        the header encryption and the writing run in parallel on a process pool.
+
+        Args:
+            hosts (list): Paths to the host files.
+            volume (str): Path to the volume file.
+            password (str): Password of the volume.
+            output_dir (str): Directory for the polyglot files, named like their host files.
+            workers (int): Number of worker processes (default: number of CPUs).
+
+        Returns:
+            list: Paths of the polyglot files that were created.
+        """
+        created = []
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+
+            with open(volume, 'rb') as volume_file:
+                # Decrypt the header of the volume once for all hosts
+                if not self.validate_volume(volume_file):
+                    return created
+                volume_header = read_at(volume_file, 0, FULL_HEADER_SIZE)
+                cryptomat = self.create_cryptomat()
+                decrypted_header = cryptomat.decrypt_header(volume_header, password)
+                if decrypted_header is None:
+                    self.ui.display_message(f"Decryption failed. Wrong password or invalid volume.", "error")
+                    return created
+
+                # The backup header is decrypted once as well, every polyglot gets its own salt
+                backup_header = None
+                backup_offset = cryptomat.backup_header_offset(file_size(volume_file))
+                if backup_offset is not None:
+                    original_backup = os.pread(volume_file.fileno(), FULL_HEADER_SIZE, backup_offset)
+                    decrypted_backup = cryptomat.decrypt_backup_header(original_backup, password)
+                    if decrypted_backup is not None:
+                        backup_header = (backup_offset, original_backup, decrypted_backup)
+
+                # Plan all polyglots, every plugin is loaded only once
+                plugin_loader = PluginLoader(ui=self.ui)
+                plugins = {}
+                output_plugins = {}
+                jobs = []
+                for host in hosts:
+                    try:
+                        extension, plugin_name = plugin_loader.detect_plugin(host)
+                        if not plugin_name:
+                            continue
+                        if plugin_name not in plugins:
+                            plugins[plugin_name] = plugin_loader.load_plugin(extension, plugin_name)
+                        plugin = plugins[plugin_name]
+                        if not plugin:
+                            continue
+
+                        with open(host, 'rb') as host_file:
+                            if not self.validate_host(plugin, host_file, host):
+                                continue
+                            layout = plugin.plan(volume_file, host_file)
+                            if not layout:
+                                self.ui.display_message(f"The plugin for '{extension}' did not create a polyglot for '{host}'.", "error")
+                                continue
+                            salt_poly = read_layout_head(layout, volume_file, host_file, SALT_SIZE)
+
+                        # Hosts with the same name in different directories must not overwrite each other's polyglot
+                        default_outputfile = self.get_output_path(os.path.join(output_dir, os.path.basename(host)), extension)
+                        outputfile = self.unique_output_path(default_outputfile, output_plugins)
+                        if outputfile != default_outputfile:
+                            self.ui.display_message(f"Another host has the name of '{host}', its polyglot is written to '{outputfile}'.", "info")
+                        jobs.append((layout, volume, host, outputfile, salt_poly))
+                        output_plugins[outputfile] = plugin
+                    except Exception as e:
+                        self.ui.display_message(f"Error planning the polyglot for '{host}': {e}", "error")
+
+            # Derive the keys and write the polyglots in parallel
+            self.ui.display_message(f"Building {len(jobs)} polyglot files...", "verbose")
+            check = self.config.get("check", False)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(build_fanout_output, layout, volume, host, outputfile, salt_poly, decrypted_header, password,
+                                    check, cryptomat.header_parameters, backup_header): host
+                    for layout, volume, host, outputfile, salt_poly in jobs
+                }
+                for future in as_completed(futures):
+                    try:
+                        outputfile, report, written_backup = future.result()
+                    except Exception as e:
+                        self.ui.display_message(f"Error building the polyglot for '{futures[future]}': {e}", "error")
+                        continue
+                    if not self.verify_output(outputfile, output_plugins[outputfile], password, written_backup):
+                        continue
+                    created.append(outputfile)
+                    self.finish_output(outputfile, report)
 
         except Exception as e:
             # Display error message to UI
             self.ui.display_message(f"Error during processing: {str(e)}", "error")
 
+        return created
+
+    def preflight(self, host, volume):
+        """
+        Pre-flight check of a job: detects the plugin by the first bytes of the host, lets the plugin check
+        the header/trailer of the host and checks the size and header of the volume.
+        Only a few small reads are needed, so invalid jobs are rejected before any large read.
+
+        Args:
+            host (str): Path to the host file.
+            volume (str): Path to the volume file.
+
+        Returns:
+            tuple: The extension to use for the polyglot and the plugin instance, which is None if the job is invalid.
+        """
+        extension, plugin = PluginLoader(ui=self.ui).load_plugin_for_host(host)
+        if not plugin:
+            return extension, None
+
+        with open(host, 'rb') as host_file:
+            if not self.validate_host(plugin, host_file, host):
+                return extension, None
+
+        with open(volume, 'rb') as volume_file:
+            if not self.validate_volume(volume_file):
+                return extension, None
+
+        return extension, plugin
+
+    def validate_host(self, plugin, host_file, host):
+        """
+        Lets the plugin check the header/trailer of the host.
+
+        Args:
+            plugin (plugin_Interface): The plugin for the host.
+            host_file (BinaryIO): The opened host file.
+            host (str): Path to the host file, used in the error message.
+
+        Returns:
+            bool: True if the plugin can embed a volume into the host, False otherwise.
+        """
+        try:
+            plugin.validate(host_file)
+        except ValueError as e:
+            self.ui.display_message(f"Invalid host file '{host}': {e}", "error")
+            return False
+        return True
+
+    def validate_volume(self, volume_file):
+        """
+        Checks the size and the first 512 bytes of the volume.
+
+        Args:
+            volume_file (BinaryIO): The opened volume file.
+
+        Returns:
+            bool: True if the volume may be a TrueCrypt volume, False otherwise.
+        """
+        volume_header = read_at(volume_file, 0, FULL_HEADER_SIZE)
+        return self.create_cryptomat().check_volume(volume_header, file_size(volume_file))
+
+    @contextmanager
+    def preserved_tail(self, fd, file, path, offset, head_length):
+        """
+        Keeps the end of a file from `offset` on in a '.tail' file next to it and its first `head_length` bytes
+        in memory while the caller rewrites them. If the caller fails, the old tail and head are written back;
+        the copy is removed when the caller is done. If the process dies in between, the copy is left behind.
+
+        Args:
+            fd (int): File descriptor of the file, opened for reading and writing.
+            file (BinaryIO): The file, opened for reading.
+            path (str): Path of the file.
+            offset (int): Start of the tail that is rewritten.
+            head_length (int): Number of bytes at the start of the file that are rewritten.
+
+        Yields:
+            str: Path of the copy of the tail.
+        """
+        tailfile = path + ".tail"
+        tail_length = os.fstat(fd).st_size - offset
+        head = os.pread(fd, head_length, 0)
+        tail_fd = os.open(tailfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+        try:
+            write_layout([VolumeRange(offset, tail_length)], file, None, tail_fd)
+            os.fsync(tail_fd)
+        finally:
+            os.close(tail_fd)
+
+        try:
+            yield tailfile
+        except BaseException as e:
+            try:
+                os.ftruncate(fd, offset)
+                os.lseek(fd, offset, os.SEEK_SET)
+                with open(tailfile, 'rb') as tail:
+                    write_layout([VolumeRange(0, tail_length)], tail, None, fd)
+                pwrite_all(fd, head, 0)
+                os.fsync(fd)
+            except OSError as restore_error:
+                raise OSError(f"{e} The file could not be restored ({restore_error}), its old end is kept in '{tailfile}'.") from e
+            os.remove(tailfile)
+            raise
+        os.remove(tailfile)
+
+    def advance_progress(self, count):
+        """
+        Reports processed bytes of the current stage to the progress of the UI, if it shows one.
+        Raises Cancelled if the job was cancelled.
+
+        Args:
+            count (int): Number of bytes processed since the last call.
+        """
+        if self.progress:
+            self.progress.advance(count)
+
+    def finish_progress(self):
+        """
+        Ends the progress of the job: records the time of the last stage, removes the progress display
+        and shows the time of every stage in verbose mode.
+        """
+        if not self.progress:
+            return
+        self.progress.end_stage()
+        clear_progress = getattr(self.ui, "clear_progress", None)
+        if clear_progress:
+            clear_progress()
+        if self.progress.timings:
+            self.ui.display_message(f"Stages: {describe_timings(self.progress.timings)}", "verbose")
+        self.progress = None
+
+    def report_stage(self, name, total=0):
+        """
+        Reports the start of a stage of the running job to the progress of the UI, if it shows one.
+        Raises Cancelled if the job was cancelled.
+
+        Args:
+            name (str): Name of the stage.
+            total (int): Number of bytes the stage processes, 0 if unknown.
+        """
+        if self.progress:
+            self.progress.stage(name, total)
+
+    def for_job(self, ui, progress=None, pim=None):
+        """
+        Returns an engine for one job that runs at the same time as other jobs, e.g. in a Pipeline.
+        It shares the configuration with this engine, but has its own UI, progress and PIM.
+
+        Args:
+            ui (UI): The UI receiving the messages of the job.
+            progress (Progress): The progress of the job.
+            pim (int): The PIM of a VeraCrypt volume.
+
+        Returns:
+            Engine: The engine of the job.
+        """
+        engine = copy.copy(self)
+        engine.ui = ui
+        engine.progress = progress
+        engine.pim = pim
+        return engine
+
+    def create_cryptomat(self):
+        """
+        Creates a Cryptomat for the current job, with the PIM of the job.
+
+        Returns:
+            Cryptomat: The Cryptomat, displaying its messages on the UI.
+        """
+        return Cryptomat(ui=self.ui, pim=self.pim, workers=self.kdf_workers, progress=self.progress)
+
+    def get_output_path(self, output, extension):
+        """
+        Returns the path of the output file, replacing an existing file extension by the one of the host.
+
+        Args:
+            output (str): Path to the output file as given by the user.
+            extension (str): The file extension of the host file.
+
+        Returns:
+            str: The path of the output file.
+        """
+        # cut old fileextension if neccessary
+        if '.' in output and os.path.splitext(output)[1]:
+            output = os.path.splitext(output)[0]
+        return output + '.' + extension
+
+    def unique_output_path(self, outputfile, taken):
+        """
+        Appends '-2', '-3', ... to the name of an output file if another polyglot of the same job already uses the path.
+
+        Args:
+            outputfile (str): Path of the output file.
+            taken (Container): Paths of the output files of the job so far.
+
+        Returns:
+            str: A path that is not taken.
+        """
+        name, extension = os.path.splitext(outputfile)
+        number = 2
+        while outputfile in taken:
+            outputfile = f"{name}-{number}{extension}"
+            number += 1
+        return outputfile
+
+    def verify_output(self, outputfile, plugin, password, backup_offset=None):
+        """
+        Round-trip check of a written polyglot, without reading it completely: the first 512 bytes are
+        read with one os.pread and must decrypt to a valid header (magic number and CRC32 checksums),
+        as must the backup header if there is one, and the plugin walks the host structure of the polyglot
+        with small reads.
+        Skipped if 'verify' is disabled in the config.
+
+        Args:
+            outputfile (str): Path to the written polyglot file.
+            plugin (plugin_Interface): The plugin that planned the polyglot.
+            password (str): Password of the volume.
+            backup_offset (int): Offset of the re-encrypted backup header, None if the polyglot has none.
+
+        Returns:
+            bool: True if the polyglot passed the check (or the check is disabled), False otherwise.
+        """
+        if not self.config.get("verify", True):
+            return True
+
+        self.ui.display_message(f"Verifying the header and the host structure of '{outputfile}'...", "verbose")
+        if not self.verify_header_of(outputfile, password, backup_offset):
+            return False
+
+        try:
+            with open(outputfile, 'rb') as polyglot:
+                plugin.verify(polyglot)
+        except ValueError as e:
+            self.ui.display_message(f"The polyglot '{outputfile}' is no valid host file: {e}", "error")
+            return False
+
+        self.ui.display_message(f"Polyglot '{outputfile}' passed the round-trip check.", "verbose")
+        return True
+
+    def verify_header_of(self, polyglot, password, backup_offset=None):
+        """
+        Checks that the header (and the backup header) of a written file decrypt to valid headers,
+        reading them with os.pread.
+
+        Args:
+            polyglot (str): Path to the polyglot file.
+            password (str): Password of the volume.
+            backup_offset (int): Offset of the backup header, None if it is not checked.
+
+        Returns:
+            bool: True if the headers are valid, False otherwise.
+        """
+        fd = os.open(polyglot, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            header = os.pread(fd, FULL_HEADER_SIZE, 0)
+            backup_header = os.pread(fd, FULL_HEADER_SIZE, backup_offset) if backup_offset is not None else None
+        finally:
+            os.close(fd)
+
+        cryptomat = self.create_cryptomat()
+        if not cryptomat.verify_header(header, password):
+            self.ui.display_message(f"The polyglot '{polyglot}' cannot be mounted: its header is invalid.", "error")
+            return False
+        if backup_header is not None and not cryptomat.verify_header(backup_header, password):
+            self.ui.display_message(f"The backup header of the polyglot '{polyglot}' is invalid.", "error")
+            return False
+        return True
+
+    def create_verifier(self):
+        """
+        Creates the detectability verifier for a polyglot if the check is enabled in the config.
+
+        Returns:
+            DetectabilityVerifier: The verifier to feed with the polyglot while it is written, or None.
+        """
+        if not self.config.get("check", False):
+            return None
+
+        # Imported here, NumPy is only needed if the check is enabled
+        from buttertoast.Utilities.detectability import DetectabilityVerifier
+        return DetectabilityVerifier(PluginLoader(ui=self.ui).registry.get_magic_trie())
+
+    def finish_output(self, outputfile, report=None):
+        """
+        Displays the success message for a written polyglot or the result of the detectability check if enabled.
+
+        Args:
+            outputfile (str): Path to the written polyglot file.
+            report (dict): The result of the verifier that checked the polyglot while it was written.
+                           If the check is enabled but there is no result, the file is checked now.
+
+        Returns:
+            dict: The result of the detectability check, or None if the check is disabled.
+        """
+        if key_cache.enabled:
+            stats = key_cache.stats()
+            self.ui.display_message(f"Key cache: {stats['hits']} hits, {stats['misses']} misses, "
+                                    f"{stats['entries']} of {stats['size']} keys cached.", "verbose")
+
+        check = self.config.get("check", False)
+        if not check:
+            self.ui.display_message(f"File {os.path.basename(outputfile)} successfully created", "info")
+            return None
+
+        from buttertoast.Utilities.detectability import verify_file, describe
+        if report is None:
+            self.report_stage("Checking the polyglot", os.path.getsize(outputfile))
+            report = verify_file(outputfile, PluginLoader(ui=self.ui).registry.get_magic_trie(),
+                                 progress=self.progress)
+
+        for region in report["regions"]:
+            self.ui.display_message(f"Region {region['offset']}+{region['length']}: chi-square {region['chi_square']}, "
+                                    f"entropy {region['entropy']}{' (random)' if region['random'] else ''}", "verbose")
+        self.ui.display_message(f"Detectability of {os.path.basename(outputfile)}: {describe(report)}", "verbose")
+
+        if report["likely_encrypted"]:
+            self.ui.display_message(f"File {os.path.basename(outputfile)} generated, but it is recognized as '...likely to be encrypted.'", "error")
+        else:
+            self.ui.display_message(f"File {os.path.basename(outputfile)} successfully created and not recognized as encrypted.", "info")
+        return report
+
 
     def read_file_as_bytecode(self, file_path):
         """
@@ -149,7 +1319,24 @@ class Engine:
         """
         try:
             with open(file_path, 'rb') as file:
-                return file.read()
+                if not self.progress:
+                    return file.read()
+
+                # Read in chunks, reporting the progress
+                data = bytearray(file_size(file))
+                view = memoryview(data)
+                position = 0
+                file.seek(0)
+                while position < len(data):
+                    count = file.readinto(view[position:position + CHUNK_SIZE])
+                    if not count:
+                        break
+                    position += count
+                    self.progress.advance(count)
+                view.release()
+                return bytes(data[:position]) if position < len(data) else data
+        except Cancelled:
+            raise
         except Exception as e:
             raise ValueError(f"Error reading the file '{file_path}': {e}")
         
@@ -161,17 +1348,59 @@ class Engine:
             bytecode (bytes): The data to save.
             filename (str): Name of the output file.
 
-        Raises:
-            Exception: If the file cannot be written.
+        Returns:
+            bool: True if the file was written, False otherwise.
         """
         try:
             with open(filename, 'wb') as file:
-                file.write(bytecode)
+                if not self.progress:
+                    file.write(bytecode)
+                else:
+                    # Write in chunks, reporting the progress
+                    view = memoryview(bytecode)
+                    for position in range(0, len(view), CHUNK_SIZE):
+                        file.write(view[position:position + CHUNK_SIZE])
+                        self.progress.advance(min(CHUNK_SIZE, len(view) - position))
             # Display debug message to UI
             self.ui.display_message(f"Bytecode successfully written to the file '{filename}'.", "verbose")
+            return True
+        except Cancelled:
+            raise
         except Exception as e:
             # Display error message to UI
             self.ui.display_message(f"Error saving bytecode to the file '{filename}': {e}", "error")
+            return False
+
+    def save_layout_to_file(self, layout, volume_file, host_file, filename, observer=None, progress=None):
+        """
+        Writes the file described by a layout into the output file. Volume and host ranges are
+        copied by the kernel (os.copy_file_range) or in fixed-size chunks as a fallback.
+
+        Args:
+            layout (list): The segments of the polyglot file.
+            volume_file (BinaryIO): The opened volume file.
+            host_file (BinaryIO): The opened host file.
+            filename (str): Name of the output file.
+            observer (callable): Optional function called with the written data, e.g. the update of a verifier.
+            progress (callable): Optional function called with the number of bytes written after every chunk,
+                                 default: the progress of the job. It may raise to stop writing.
+
+        Returns:
+            bool: True if the file was written, False otherwise.
+        """
+        if progress is None and self.progress:
+            progress = self.progress.advance
+        try:
+            save_layout(layout, volume_file, host_file, filename, observer, progress)
+            # Display debug message to UI
+            self.ui.display_message(f"Layout successfully streamed to the file '{filename}'.", "verbose")
+            return True
+        except (Cancelled, DerivationFailed):
+            raise
+        except Exception as e:
+            # Display error message to UI
+            self.ui.display_message(f"Error streaming the layout to the file '{filename}': {e}", "error")
+            return False
 
     def get_file_extension(self, file_path):
         """
@@ -193,12 +1422,15 @@ class Engine:
         Raises:
             Exception: If there is an error during engine initialization or UI startup.
         """
-        # register handler
+        # register handler. The jobs share the state of the engine, so their events keep the default
+        # of one event at a time, in order. Requests to list the plugins that pile up are merged.
+        self.event_manager.configure_event("list_data", coalesce=True)
         self.event_manager.register_event("process_data", self.on_process_data)
         self.event_manager.register_event("list_data", self.on_list_data)
         self.event_manager.register_event("change_ui", self.on_change_ui)
         self.event_manager.register_event("change_verbose", self.on_change_verbose)
         self.event_manager.register_event("change_check", self.on_change_check)
+        self.event_manager.register_event("rekey", self.on_rekey)
 
         try:
             self.select_ui()
@@ -207,6 +1439,8 @@ class Engine:
             # Display error message to UI
             print(f"Error starting the engine: {e}", "error")
             self.ui.display_message(f"Error starting the engine: {e}", "error")
+        finally:
+            self.event_manager.close()
 
     def on_process_data(self, data):
         """
@@ -221,17 +1455,41 @@ class Engine:
             volume = data["volume"]
             password = data["password"]
             output = data["output"]
+            self.pim = data.get("pim")
+            self.progress = data.get("progress")
+
+            # Patch the volume file itself if the in-place mode is enabled
+            if self.config.get("in_place", False) or data.get("in_place", False):
+                self.process_data_in_place(host, volume, password, output)
+                return
+
+            # Stream the files unless the in-memory build is configured
+            if self.config.get("streaming", True):
+                self.process_data_stream(host, volume, password, output)
+                return
+
+            # Reject invalid jobs before the files are read
+            _, plugin = self.preflight(host, volume)
+            if not plugin:
+                return
 
             # Read files and start processing
+            self.report_stage("Reading the files", os.path.getsize(host) + os.path.getsize(volume))
             host_bytecode = self.read_file_as_bytecode(host)
             volume_bytecode = self.read_file_as_bytecode(volume)
             self.process_data(host, host_bytecode, volume_bytecode, password, output)
             return
 
+        except Cancelled:
+            self.ui.display_message(f"Processing cancelled.", "info")
+
         except Exception as e:
             # Display error message to UI
             self.ui.display_message(f"Error: {str(e)}", "error")
 
+        finally:
+            self.finish_progress()
+
 
     def process_data_cli(self, data, verbose):
         """
@@ -246,11 +1504,30 @@ class Engine:
             print("Verbose mode enabled.")
             print("Starting the processing of data in CLI mode...")
 
+        # Ctrl+C stops the job cleanly after the current chunk
+        self.progress = Progress(callback=self.ui.display_progress)
+        with cancel_on_interrupt(self.progress):
+            self.run_cli_job(data, verbose)
+
+    def report_complete(self, outputfile):
+        """Tells the CLI user that the polyglot was written. Jobs that failed or were cancelled return no file."""
+        if outputfile and not (self.progress and self.progress.cancelled):
+            self.ui.display_message(f"Processing complete. Output saved to {outputfile}", "verbose")
+
+    def run_cli_job(self, data, verbose):
+        """
+        Runs the job of process_data_cli, showing its progress.
+
+        Args:
+            data (dict): Data passed from the CLI.
+            verbose (bool): Flag to enable verbose output.
+        """
         try:
             host = data["host"]
             volume = data["volume"]
             password = data["password"]
             output = data["output"]
+            self.pim = data.get("pim")
 
             if verbose:
                 print(f"Host file: {host}")
@@ -258,23 +1535,136 @@ class Engine:
                 print(f"Password: {password}")
                 print(f"Output file: {output}")
 
+            # Patch the volume file itself if the in-place mode is enabled
+            if self.config.get("in_place", False) or data.get("in_place", False):
+                self.report_complete(self.process_data_in_place(host, volume, password, output))
+                return
+
+            # Stream the files unless the in-memory build is configured
+            if self.config.get("streaming", True):
+                self.report_complete(self.process_data_stream(host, volume, password, output))
+                return
+
+            # Reject invalid jobs before the files are read
+            _, plugin = self.preflight(host, volume)
+            if not plugin:
+                return
+
             # Read files and start processing
+            self.report_stage("Reading the files", os.path.getsize(host) + os.path.getsize(volume))
             host_bytecode = self.read_file_as_bytecode(host)
             volume_bytecode = self.read_file_as_bytecode(volume)
 
-            if verbose:
-                print(f"Read host file: {host}")
-                print(f"Read volume file: {volume}")
+            self.ui.display_message(f"Read host file: {host}", "verbose")
+            self.ui.display_message(f"Read volume file: {volume}", "verbose")
 
-            self.process_data(host, host_bytecode, volume_bytecode, password, output)
+            self.report_complete(self.process_data(host, host_bytecode, volume_bytecode, password, output))
 
-            if verbose:
-                print(f"Processing complete. Output saved to {output}")
+        except Cancelled:
+            self.ui.display_message(f"Processing cancelled.", "info")
 
         except Exception as e:
             # Handle errors and output to the console
             print(f"Error during processing: {str(e)}")
 
+        finally:
+            self.finish_progress()
+
+    def on_rekey(self, data):
+        """
+        Event handler for the 'rekey' event: changes the password of an existing polyglot.
+
+        Args:
+            data (dict): Data passed from the UI ("polyglot", "old_password", "new_password", optional "pim"
+                         and "progress").
+        """
+        try:
+            self.pim = data.get("pim")
+            self.progress = data.get("progress")
+            self.rekey(data["polyglot"], data["old_password"], data["new_password"])
+        except Cancelled:
+            self.ui.display_message(f"Changing the password cancelled.", "info")
+        except Exception as e:
+            # Display error message to UI
+            self.ui.display_message(f"Error: {str(e)}", "error")
+        finally:
+            self.finish_progress()
+
+    def rekey_cli(self, data, verbose):
+        """
+        Changes the password of an existing polyglot when the tool is run in CLI mode.
+
+        Args:
+            data (dict): Data passed from the CLI ("polyglot", "old_password", "new_password", "pim").
+            verbose (bool): Flag to enable verbose output.
+        """
+        self.ui = CLI(verbose)
+        self.on_rekey(data)
+
+    def swap_host_cli(self, data, verbose):
+        """
+        Replaces the host of an existing polyglot when the tool is run in CLI mode.
+
+        Args:
+            data (dict): Data passed from the CLI ("polyglot", "host", "password", "pim").
+            verbose (bool): Flag to enable verbose output.
+        """
+        self.ui = CLI(verbose)
+        self.pim = data.get("pim")
+        self.swap_host(data["polyglot"], data["host"], data["password"])
+
+    def undo_in_place_cli(self, backup, verbose):
+        """
+        Restores a volume that was patched in place when the tool is run in CLI mode.
+
+        Args:
+            backup (str): Path to the backup file of the in-place build.
+            verbose (bool): Flag to enable verbose output.
+        """
+        self.ui = CLI(verbose)
+        self.undo_in_place(backup)
+
+    def process_data_fanout_cli(self, data, verbose, workers=None):
+        """
+        Runs a fan-out job (one volume, many hosts) when the tool is run in CLI mode.
+
+        Args:
+            data (dict): Data passed from the CLI ("hosts", "volume", "password", "output").
+            verbose (bool): Flag to enable verbose output.
+            workers (int): Number of worker processes (default: number of CPUs).
+        """
+        self.ui = CLI(verbose)
+        if verbose:
+            print("Verbose mode enabled.")
+            print(f"Embedding the volume {data['volume']} into {len(data['hosts'])} host files...")
+
+        self.pim = data.get("pim")
+        created = self.process_data_fanout(data["hosts"], data["volume"], data["password"], data["output"], workers)
+        self.ui.display_message(f"{len(created)} of {len(data['hosts'])} polyglot files created in '{data['output']}'.", "info")
+
+    def process_batch_cli(self, manifest, results, verbose, workers=None, pipeline=False):
+        """
+        Runs all jobs of a JSONL or CSV manifest on a process pool when the tool is run in CLI mode.
+
+        Args:
+            manifest (str): Path to the manifest with one job (host, volume, password, output) per line.
+            results (str): Path to the result file, default: the manifest path with '.results.jsonl' appended.
+            verbose (bool): Flag to enable verbose output.
+            workers (int): Number of worker processes, or of key derivation threads in the pipeline
+                           (default: number of CPUs).
+            pipeline (bool): Run the jobs in one process through a staged pipeline instead.
+        """
+        self.ui = CLI(verbose)
+        results = results or manifest + ".results.jsonl"
+        try:
+            if pipeline:
+                run_batch_pipeline(manifest, results, workers, self.ui)
+            else:
+                run_batch(manifest, results, workers, self.ui)
+        except Exception as e:
+            # Handle errors and output to the console
+            self.ui.display_message(f"Error during batch processing: {str(e)}", "error")
+
     def on_list_data(self, _):
         try:
             plugin_loader = PluginLoader(directory="plugins", ui=self.ui)  # Pass the UI instance here
@@ -330,15 +1720,9 @@ class Engine:
     def on_change_check(self, _):
         """
         Event handler for the 'change_check' event.
-        Toggles the value of the 'check' parameter in the config.json, but only
-        if 'tchuntng' is available in the PATH.
+        Toggles the value of the 'check' parameter in the config.json.
         """
         try:
-            # Check if tchuntng is available
-            if not check_tchuntng():
-                self.ui.display_message(f"'tchuntng' is not available in the PATH or is not executable.", "error")
-                return
-
             # Toggle 'check' value
             self.config["check"] = not self.config.get("check", False)
 
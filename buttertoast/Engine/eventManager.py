@@ -15,13 +15,80 @@
 #
 # For more information, contact: mail@matthias-ferstl.de
 
+import asyncio
+import inspect
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Number of events of one type that may wait for their handlers before publish() blocks
+DEFAULT_QUEUE_SIZE = 16
+
+
+class EventEntry:
+    """An event waiting in the queue of its channel, with the future of its result."""
+    def __init__(self, data):
+        self.data = data
+        self.future = Future()
+
+
+class EventChannel:
+    """
+    The handlers and the bounded queue of one event type.
+
+    Args:
+        queue_size (int): Number of events that may wait for their handlers.
+        coalesce (bool): If true, an event that is published while another one is still waiting replaces
+            its data, both publishers get the result of the one run of the handlers.
+        concurrency (int): Number of events that are handled at the same time. With 1 (the default),
+            the events are handled strictly in the order they were published.
+    """
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, coalesce=False, concurrency=1):
+        self.handlers = []
+        self.queue_size = queue_size
+        self.coalesce = coalesce
+        self.concurrency = max(1, concurrency)
+        self.queue = None  # Created on the event loop when the first event is published
+        self.waiting = None  # Last queued entry that has not been started, merged into when coalescing
+        self.consumer = None
+
 
 class EventManager:
-    def __init__(self):
+    def __init__(self, workers=None):
         """
         Initializes the event manager with an empty list of event handlers.
+        The events are handled on an asyncio event loop that runs in its own thread and is started with the
+        first event. Coroutine handlers run on the loop, all other handlers run in a thread pool, so handlers
+        of different events (or of one event with a concurrency above 1) run at the same time.
+
+        Args:
+            workers (int): Number of threads for the handlers (default: number of CPUs).
+        """
+        self.events = {}  # Dictionary of event channels
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = None
+        self.loop = None
+        self.loop_thread = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def configure_event(self, event_name, queue_size=DEFAULT_QUEUE_SIZE, coalesce=False, concurrency=1):
         """
-        self.events = {}  # Dictionary for event handlers
+        Sets how the events of one type are queued, see EventChannel. Must be called before the first event
+        of this type is published.
+
+        Args:
+            event_name (str): Name of the event.
+            queue_size (int): Number of events that may wait for their handlers.
+            coalesce (bool): Merge events that are waiting, the last data wins.
+            concurrency (int): Number of events that are handled at the same time.
+        """
+        channel = self.events.get(event_name)
+        if channel and channel.queue is not None:
+            raise RuntimeError(f"The event '{event_name}' is already in use and cannot be configured.")
+        handlers = channel.handlers if channel else []
+        self.events[event_name] = EventChannel(queue_size, coalesce, concurrency)
+        self.events[event_name].handlers = handlers
 
     def register_event(self, event_name, handler):
         """
@@ -29,25 +96,178 @@ class EventManager:
 
         Args:
             event_name (str): Name of the event.
-            handler (callable): Function or method to be called when the event is triggered.
+            handler (callable): Function, method or coroutine function to be called when the event is triggered.
         """
         if event_name not in self.events:
-            self.events[event_name] = []
-        self.events[event_name].append(handler)
+            self.events[event_name] = EventChannel()
+        self.events[event_name].handlers.append(handler)
 
     def trigger_event(self, event_name, data=None):
         """
-        Triggers an event and calls all registered handlers.
+        Triggers an event and waits until all registered handlers have run.
+        Kept for the UIs, which expect the event to be handled when the call returns.
 
         Args:
             event_name (str): Name of the event.
             data (optional): Data to be passed to the handlers.
+
+        Returns:
+            list: The return values of the handlers, or None if no handler is registered.
         """
-        if event_name in self.events:
-            for handler in self.events[event_name]:
-                handler(data)
-        else:
+        if event_name not in self.events:
             print(f"[WARNING] No handler registered for event '{event_name}'.")
+            return None
+        if getattr(self.local, "in_handler", False):
+            # Triggered by a handler: run inline, waiting for the queue could deadlock
+            return [self.run_inline(handler, data) for handler in self.events[event_name].handlers]
+        return self.publish(event_name, data).result()
 
+    def publish(self, event_name, data=None):
+        """
+        Queues an event without waiting for its handlers. Blocks while the queue of the event is full.
+        Must not be called on the event loop, coroutines use emit().
+
+        Args:
+            event_name (str): Name of the event.
+            data (optional): Data to be passed to the handlers.
+
+        Returns:
+            concurrent.futures.Future: The return values of the handlers, or their first exception.
+        """
+        loop = self.start()
+        if threading.current_thread() is self.loop_thread:
+            raise RuntimeError("publish() cannot be called on the event loop, use emit().")
+        return asyncio.run_coroutine_threadsafe(self.enqueue(event_name, data), loop).result()
+
+    async def emit(self, event_name, data=None):
+        """
+        Queues an event from a coroutine running on the event loop of this manager and waits for its handlers.
 
+        Args:
+            event_name (str): Name of the event.
+            data (optional): Data to be passed to the handlers.
+
+        Returns:
+            list: The return values of the handlers.
+        """
+        return await asyncio.wrap_future(await self.enqueue(event_name, data))
+
+    async def enqueue(self, event_name, data):
+        """
+        Puts an event into the queue of its channel (on the event loop), waiting while the queue is full.
+
+        Returns:
+            concurrent.futures.Future: The future of the event.
+        """
+        channel = self.events.get(event_name)
+        if channel is None:
+            future = Future()
+            future.set_exception(KeyError(f"No handler registered for event '{event_name}'."))
+            return future
+
+        if channel.queue is None:
+            channel.queue = asyncio.Queue(channel.queue_size)
+            channel.consumer = asyncio.get_running_loop().create_task(self.consume(channel))
+
+        if channel.coalesce and channel.waiting:
+            channel.waiting.data = data
+            return channel.waiting.future
+
+        entry = EventEntry(data)
+        if channel.coalesce:
+            channel.waiting = entry
+        await channel.queue.put(entry)
+        return entry.future
+
+    async def consume(self, channel):
+        """
+        Takes the events of a channel from its queue and runs their handlers, at most
+        channel.concurrency events at the same time.
+        """
+        slots = asyncio.Semaphore(channel.concurrency)
+        running = set()  # The loop only keeps weak references to its tasks
+        while True:
+            await slots.acquire()
+            entry = await channel.queue.get()
+            if channel.waiting is entry:
+                channel.waiting = None
+            task = asyncio.get_running_loop().create_task(self.dispatch(channel, entry))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+    async def dispatch(self, channel, entry):
+        """Runs all handlers of a channel for one event, in the order they were registered."""
+        if not entry.future.set_running_or_notify_cancel():
+            return
+        loop = asyncio.get_running_loop()
+        results = []
+        try:
+            for handler in list(channel.handlers):
+                if inspect.iscoroutinefunction(handler):
+                    results.append(await handler(entry.data))
+                else:
+                    results.append(await loop.run_in_executor(self.executor, self.run_handler, handler, entry.data))
+        except Exception as e:
+            entry.future.set_exception(e)
+        else:
+            entry.future.set_result(results)
+
+    def run_handler(self, handler, data):
+        """Runs a handler in the thread pool, marking the thread so events triggered by the handler run inline."""
+        self.local.in_handler = True
+        try:
+            return handler(data)
+        finally:
+            self.local.in_handler = False
+
+    def run_inline(self, handler, data):
+        """Runs a handler on the calling thread, coroutine handlers are passed to the event loop."""
+        if inspect.iscoroutinefunction(handler):
+            return asyncio.run_coroutine_threadsafe(handler(data), self.loop).result()
+        return handler(data)
+
+    def start(self):
+        """
+        Starts the event loop thread and the thread pool of the handlers, if they are not running yet.
+
+        Returns:
+            asyncio.AbstractEventLoop: The event loop.
+        """
+        with self.lock:
+            if self.loop is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="event-handler")
+                self.loop = asyncio.new_event_loop()
+                self.loop_thread = threading.Thread(target=self.loop.run_forever, name="event-loop", daemon=True)
+                self.loop_thread.start()
+            return self.loop
+
+    async def shutdown(self):
+        """
+        Cancels the events that are still queued, stops the consumers of the channels and waits for the events
+        that are being handled, so their publishers get the results (on the event loop).
+        """
+        consumers = []
+        for channel in self.events.values():
+            while channel.queue is not None and not channel.queue.empty():
+                channel.queue.get_nowait().future.cancel()
+            if channel.consumer is not None:
+                channel.consumer.cancel()
+                consumers.append(channel.consumer)
+        await asyncio.gather(*consumers, return_exceptions=True)
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        await asyncio.gather(*tasks, return_exceptions=True)
 
+    def close(self):
+        """Stops the event loop and waits for the running handlers."""
+        with self.lock:
+            if self.loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+            self.executor.shutdown(wait=True)
+            self.loop.close()
+            self.loop = self.loop_thread = self.executor = None
+            for channel in self.events.values():
+                channel.queue = channel.waiting = channel.consumer = None
@@ -0,0 +1,569 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+
+# A layout describes a polyglot file as an ordered list of segments instead of one big bytes object.
+# Every segment is either a small literal patch or a range of the volume or host file.
+# The engine copies the ranges with os.copy_file_range where available (the data never enters
+# user space) and otherwise streams them in fixed-size chunks, so the volume never has to fit into memory.
+
+import io
+import os
+import zlib
+from collections import namedtuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows, no reflinks
+
+CHUNK_SIZE = 4 * 1024 * 1024  # Size of the chunks used to copy volume and host ranges (4 MiB)
+PREFETCH_SIZE = 64 * 1024 * 1024  # Bytes at the start of a file that prefetch() asks the OS to read ahead (64 MiB)
+FICLONE = 0x40049409  # ioctl cloning a whole file on copy-on-write file systems (Btrfs, XFS), from linux/fs.h
+
+Literal = namedtuple("Literal", ["data"])  # Bytes written as they are
+VolumeRange = namedtuple("VolumeRange", ["offset", "length"])  # Range of the volume file
+HostRange = namedtuple("HostRange", ["offset", "length"])  # Range of the host file
+
+
+class BoundedFile:
+    """
+    Read-only view of the first `size` bytes of an opened binary file, e.g. of the volume at the start of a
+    polyglot. Plugins plan a polyglot from it like from a volume file. It has no file descriptor, so ranges
+    of it are never copied by the kernel and nothing is remembered per file.
+    """
+
+    def __init__(self, file, size):
+        self.file = file
+        self.size = size
+        self.position = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, length=-1):
+        remaining = max(0, self.size - self.position)
+        if length is None or length < 0 or length > remaining:
+            length = remaining
+        self.file.seek(self.position)
+        data = self.file.read(length)
+        self.position += len(data)
+        return data
+
+    def fileno(self):
+        raise io.UnsupportedOperation("A bounded view of a file has no file descriptor.")
+
+
+def file_size(file):
+    """
+    Returns the size of an opened binary file.
+
+    Args:
+        file (BinaryIO): The opened file.
+
+    Returns:
+        int: The size of the file in bytes.
+    """
+    return file.seek(0, os.SEEK_END)
+
+
+def prefetch(file, length=PREFETCH_SIZE):
+    """
+    Asks the OS to read the start of an opened file into the page cache in the background
+    (posix_fadvise WILLNEED), so a later copy of it does not wait for the disk. Nothing is read into
+    memory of the process. Does nothing where posix_fadvise is not available.
+
+    Args:
+        file (BinaryIO): The opened file.
+        length (int): Number of bytes to read ahead.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(file.fileno(), 0, length, os.POSIX_FADV_WILLNEED)
+    except (OSError, io.UnsupportedOperation):
+        pass  # Only a hint
+
+
+def read_at(file, offset, length):
+    """
+    Reads up to `length` bytes at `offset` from an opened binary file.
+
+    Args:
+        file (BinaryIO): The opened file.
+        offset (int): Position to start reading from.
+        length (int): Number of bytes to read.
+
+    Returns:
+        bytes: The bytes read (shorter than `length` at the end of the file).
+    """
+    file.seek(offset)
+    return file.read(length)
+
+
+def iter_range(file, offset, length, chunk_size=CHUNK_SIZE):
+    """
+    Yields the given range of a file in chunks of at most `chunk_size` bytes.
+
+    Args:
+        file (BinaryIO): The opened file.
+        offset (int): Start of the range.
+        length (int): Length of the range.
+        chunk_size (int): Maximum size of a single chunk.
+
+    Yields:
+        bytes: The next chunk of the range.
+
+    Raises:
+        ValueError: If the file ends before the range does.
+    """
+    file.seek(offset)
+    remaining = length
+    while remaining > 0:
+        chunk = file.read(min(chunk_size, remaining))
+        if not chunk:
+            raise ValueError(f"Unexpected end of file while reading {length} bytes at offset {offset}.")
+        remaining -= len(chunk)
+        yield chunk
+
+
+def find_in_file(file, needle, start=0, chunk_size=CHUNK_SIZE):
+    """
+    Returns the position of the first occurrence of `needle` in a file, like bytes.find().
+
+    Args:
+        file (BinaryIO): The opened file.
+        needle (bytes): The byte sequence to search for.
+        start (int): Position to start searching from.
+        chunk_size (int): Size of the chunks read from the file.
+
+    Returns:
+        int: The position of the first occurrence, or -1 if it was not found.
+    """
+    overlap = len(needle) - 1
+    position = start
+    tail = b""
+    file.seek(start)
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return -1
+        window = tail + chunk
+        index = window.find(needle)
+        if index != -1:
+            return position - len(tail) + index
+        position += len(chunk)
+        tail = window[-overlap:] if overlap else b""
+
+
+def crc32_of_range(file, offset, length, crc=0):
+    """
+    Calculates the CRC32 of a range of a file without loading the range into memory.
+
+    Args:
+        file (BinaryIO): The opened file.
+        offset (int): Start of the range.
+        length (int): Length of the range.
+        crc (int): CRC of the data preceding the range.
+
+    Returns:
+        int: The CRC32 checksum.
+    """
+    for chunk in iter_range(file, offset, length):
+        crc = zlib.crc32(chunk, crc)
+    return crc & 0xffffffff
+
+
+def layout_size(layout):
+    """
+    Returns the size of the file described by a layout.
+
+    Args:
+        layout (list): The segments of the layout.
+
+    Returns:
+        int: The size in bytes.
+    """
+    return sum(len(segment.data) if isinstance(segment, Literal) else segment.length for segment in layout)
+
+
+def iter_layout(layout, volume, host, chunk_size=CHUNK_SIZE):
+    """
+    Yields the content described by a layout in chunks of at most `chunk_size` bytes.
+
+    Args:
+        layout (list): The segments of the layout.
+        volume (BinaryIO): The opened volume file.
+        host (BinaryIO): The opened host file.
+        chunk_size (int): Maximum size of a chunk read from the volume or host.
+
+    Yields:
+        bytes: The next chunk of the file described by the layout.
+    """
+    for segment in layout:
+        if isinstance(segment, Literal):
+            if segment.data:
+                yield segment.data
+        elif isinstance(segment, VolumeRange):
+            yield from iter_range(volume, segment.offset, segment.length, chunk_size)
+        elif isinstance(segment, HostRange):
+            yield from iter_range(host, segment.offset, segment.length, chunk_size)
+        else:
+            raise TypeError(f"Unknown layout segment: {segment!r}")
+
+
+def read_layout_head(layout, volume, host, length):
+    """
+    Returns the first `length` bytes of the file described by a layout, e.g. the salt of the polyglot.
+
+    Args:
+        layout (list): The segments of the layout.
+        volume (BinaryIO): The opened volume file.
+        host (BinaryIO): The opened host file.
+        length (int): Number of bytes to return.
+
+    Returns:
+        bytes: The first bytes of the described file.
+    """
+    head = bytearray()
+    for chunk in iter_layout(layout, volume, host, chunk_size=length):
+        head += chunk[:length - len(head)]
+        if len(head) >= length:
+            break
+    return bytes(head)
+
+
+def replace_head(layout, data):
+    """
+    Returns a new layout whose first bytes are replaced by `data`, e.g. the re-encrypted header.
+
+    Args:
+        layout (list): The segments of the layout.
+        data (bytes): The bytes replacing the start of the described file.
+
+    Returns:
+        list: The new layout.
+    """
+    new_layout = [Literal(bytes(data))]
+    skip = len(data)
+    for segment in layout:
+        size = len(segment.data) if isinstance(segment, Literal) else segment.length
+        if skip >= size:
+            skip -= size
+            continue
+        if skip:
+            if isinstance(segment, Literal):
+                segment = Literal(segment.data[skip:])
+            else:
+                segment = segment._replace(offset=segment.offset + skip, length=segment.length - skip)
+            skip = 0
+        new_layout.append(segment)
+    return new_layout
+
+
+def split_in_place(layout, volume_size):
+    """
+    Splits a layout that keeps the volume at its original offsets into the patch of the start of the
+    volume and the segments appended after it, so the polyglot can be made from the volume file itself.
+
+    Args:
+        layout (list): The segments of the layout, with the re-encrypted header as first literal.
+        volume_size (int): The size of the volume file.
+
+    Returns:
+        tuple: The bytes overwriting the start of the volume and the list of appended segments,
+               or None if the layout moves the volume or reads from it after its end.
+    """
+    if len(layout) < 2 or not isinstance(layout[0], Literal) or not isinstance(layout[1], VolumeRange):
+        return None
+    head = bytes(layout[0].data)
+    if layout[1] != VolumeRange(len(head), volume_size - len(head)):
+        return None
+    tail = layout[2:]
+    if any(isinstance(segment, VolumeRange) for segment in tail):
+        return None
+    return head, tail
+
+
+def materialize(layout, volume_bytes, host_bytes):
+    """
+    Builds the file described by a layout from in-memory volume and host data.
+    Ranges are referenced through memoryviews, so the data is copied exactly once.
+
+    Args:
+        layout (list): The segments of the layout.
+        volume_bytes (bytes): The content of the volume.
+        host_bytes (bytes): The content of the host.
+
+    Returns:
+        bytes: The file described by the layout.
+    """
+    volume_view = memoryview(volume_bytes)
+    host_view = memoryview(host_bytes)
+    parts = []
+    for segment in layout:
+        if isinstance(segment, Literal):
+            parts.append(segment.data)
+        elif isinstance(segment, VolumeRange):
+            parts.append(volume_view[segment.offset:segment.offset + segment.length])
+        elif isinstance(segment, HostRange):
+            parts.append(host_view[segment.offset:segment.offset + segment.length])
+        else:
+            raise TypeError(f"Unknown layout segment: {segment!r}")
+    return b"".join(parts)
+
+
+def write_all(fd, data):
+    """
+    Writes all of `data` to a file descriptor, repeating short writes.
+
+    Args:
+        fd (int): The file descriptor.
+        data (bytes): The data to write.
+    """
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def pwrite_all(fd, data, offset):
+    """
+    Writes all of `data` at `offset` with os.pwrite, repeating short writes. The file position is not changed.
+
+    Args:
+        fd (int): The file descriptor.
+        data (bytes): The data to write.
+        offset (int): Position to write at.
+    """
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _write_literals(fd, literals):
+    """
+    Writes a run of literal segments with a single os.writev call where available.
+
+    Args:
+        fd (int): The file descriptor.
+        literals (list): The bytes of consecutive literal segments.
+    """
+    if not literals:
+        return
+    if not hasattr(os, "writev") or len(literals) == 1:
+        for data in literals:
+            write_all(fd, data)
+        return
+
+    total = sum(len(data) for data in literals)
+    written = os.writev(fd, literals)
+    if written < total:
+        # Finish a short vectored write with plain writes
+        write_all(fd, b"".join(literals)[written:])
+
+
+def _copy_range(source_fd, fd, offset, length, chunk_size=CHUNK_SIZE, observer=None, progress=None):
+    """
+    Copies a range of the source file to the current position of the output file.
+    Uses os.copy_file_range and falls back to chunked reads if the file systems do not support it.
+
+    Args:
+        source_fd (int): File descriptor of the volume or host file.
+        fd (int): File descriptor of the output file.
+        offset (int): Start of the range in the source file.
+        length (int): Length of the range.
+        chunk_size (int): Size of the chunks for the fallback copy.
+        observer (callable): Optional function called with every chunk written. The range is then
+                             copied in chunks, because os.copy_file_range bypasses user space.
+        progress (callable): Optional function called with the number of bytes copied after every chunk,
+                             it may raise to stop the copy at the chunk boundary.
+
+    Raises:
+        ValueError: If the source file ends before the range does.
+    """
+    remaining = length
+    if hasattr(os, "copy_file_range") and observer is None:
+        # Large kernel copies, unless the progress is reported per chunk
+        step = chunk_size if progress else 1 << 30
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(source_fd, fd, min(remaining, step), offset)
+                if copied == 0:
+                    raise ValueError(f"Unexpected end of file while copying {length} bytes.")
+                offset += copied
+                remaining -= copied
+                if progress:
+                    progress(copied)
+            return
+        except OSError:
+            # e.g. EXDEV or EINVAL: not supported between these files, continue with a plain copy
+            pass
+
+    while remaining > 0:
+        chunk = os.pread(source_fd, min(chunk_size, remaining), offset)
+        if not chunk:
+            raise ValueError(f"Unexpected end of file while copying {length} bytes.")
+        write_all(fd, chunk)
+        if observer:
+            observer(chunk)
+        offset += len(chunk)
+        remaining -= len(chunk)
+        if progress:
+            progress(len(chunk))
+
+
+def write_layout(layout, volume, host, fd, observer=None, progress=None):
+    """
+    Writes the file described by a layout to a file descriptor without copying ranges through Python objects.
+    Consecutive literal patches are gathered into one os.writev call, volume and host ranges are copied
+    by the kernel with os.copy_file_range.
+
+    Args:
+        layout (list): The segments of the layout.
+        volume (BinaryIO): The opened volume file.
+        host (BinaryIO): The opened host file.
+        fd (int): File descriptor of the output file, opened for writing.
+        observer (callable): Optional function called with the written data in file order, e.g. to check
+                             the output while it is written instead of reading it again.
+        progress (callable): Optional function called with the number of bytes written after every chunk,
+                             see _copy_range.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    literals = []
+    written = 0
+    for segment in layout:
+        if isinstance(segment, Literal):
+            if segment.data:
+                literals.append(bytes(segment.data))
+                if observer:
+                    observer(segment.data)
+            written += len(segment.data)
+            continue
+
+        _write_literals(fd, literals)
+        if progress and literals:
+            progress(sum(len(data) for data in literals))
+        literals = []
+        if isinstance(segment, VolumeRange):
+            _copy_range(volume.fileno(), fd, segment.offset, segment.length, observer=observer, progress=progress)
+        elif isinstance(segment, HostRange):
+            _copy_range(host.fileno(), fd, segment.offset, segment.length, observer=observer, progress=progress)
+        else:
+            raise TypeError(f"Unknown layout segment: {segment!r}")
+        written += max(0, segment.length)
+
+    _write_literals(fd, literals)
+    if progress and literals:
+        progress(sum(len(data) for data in literals))
+    return written
+
+
+def clone_file(source_fd, fd):
+    """
+    Makes the output file a reflink copy of the source file with the FICLONE ioctl: both files share
+    their data blocks until one of them is modified, so no data is copied.
+
+    Args:
+        source_fd (int): File descriptor of the source file.
+        fd (int): File descriptor of the empty output file.
+
+    Raises:
+        OSError: If the file system or platform does not support reflinks.
+    """
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform.")
+    fcntl.ioctl(fd, FICLONE, source_fd)
+
+
+def clone_layout(layout, volume, host, fd, progress=None):
+    """
+    Writes a layout that keeps the volume at its original offsets by cloning the volume file and
+    patching the clone: the start is overwritten with the header and the rest of the layout is appended.
+    Only the header and the appended data are written, the volume blocks are shared with the volume file.
+
+    Args:
+        layout (list): The segments of the layout, with the re-encrypted header as first literal.
+        volume (BinaryIO): The opened volume file.
+        host (BinaryIO): The opened host file.
+        fd (int): File descriptor of the empty output file, opened for writing.
+        progress (callable): Optional function called with the number of bytes written, see _copy_range.
+                             The cloned volume counts as written at once.
+
+    Returns:
+        int: The number of bytes of the file, or None if the layout or the file system does not allow cloning.
+    """
+    volume_size = os.fstat(volume.fileno()).st_size
+    parts = split_in_place(layout, volume_size)
+    if parts is None:
+        return None
+    head, tail = parts
+
+    try:
+        clone_file(volume.fileno(), fd)
+    except OSError:
+        # e.g. EOPNOTSUPP on ext4 or EXDEV across file systems, the layout is copied instead
+        return None
+
+    if progress:
+        progress(volume_size)
+    os.lseek(fd, volume_size, os.SEEK_SET)
+    write_layout(tail, volume, host, fd, progress=progress)
+    os.lseek(fd, 0, os.SEEK_SET)
+    write_all(fd, head)
+    return layout_size(layout)
+
+
+def save_layout(layout, volume, host, filename, observer=None, progress=None):
+    """
+    Creates (or truncates) the output file and writes the file described by a layout into it.
+    If the layout keeps the volume at its original offsets, the volume file is cloned (reflink) and
+    patched where the file system supports it, otherwise the ranges are copied with os.copy_file_range.
+
+    Args:
+        layout (list): The segments of the layout.
+        volume (BinaryIO): The opened volume file.
+        host (BinaryIO): The opened host file.
+        filename (str): Path of the output file.
+        observer (callable): Optional function called with the written data in file order.
+        progress (callable): Optional function called with the number of bytes written after every chunk,
+                             it may raise to stop writing at the chunk boundary.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+    try:
+        if observer is None:
+            written = clone_layout(layout, volume, host, fd, progress)
+            if written is not None:
+                return written
+        return write_layout(layout, volume, host, fd, observer, progress)
+    finally:
+        os.close(fd)
@@ -0,0 +1,128 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+
+# Content sniffing for host files. Plugins declare the magic numbers their hosts start with
+# (plugin_Interface.magic), all of them are put into one prefix trie and the first bytes of a
+# host are matched against it, so the plugin is found with a single small read of the host.
+
+import os
+
+
+class MagicTrie:
+    """
+    Prefix trie of magic numbers. A magic number is either bytes or a tuple of bytes and ints,
+    where an int stands for that many arbitrary bytes, e.g. (b"RIFF", 4, b"WAVE").
+    """
+
+    class Node:
+        __slots__ = ("children", "value")
+
+        def __init__(self):
+            self.children = {}  # byte (int) or None for an arbitrary byte -> Node
+            self.value = None
+
+    def __init__(self):
+        self.root = MagicTrie.Node()
+        self.depth = 0  # Length of the longest magic number
+
+    @staticmethod
+    def expand(magic):
+        """
+        Expands a magic number into the sequence of trie keys.
+
+        Args:
+            magic (bytes | tuple): The magic number.
+
+        Returns:
+            list: One key per byte, the byte value or None for an arbitrary byte.
+        """
+        if isinstance(magic, (bytes, bytearray)):
+            magic = (magic,)
+
+        keys = []
+        for part in magic:
+            if isinstance(part, int):
+                keys.extend([None] * part)
+            else:
+                keys.extend(part)
+        return keys
+
+    def insert(self, magic, value):
+        """
+        Adds a magic number. If it was already added, the first value is kept.
+
+        Args:
+            magic (bytes | tuple): The magic number.
+            value: The value returned for hosts starting with the magic number, e.g. the plugin name.
+        """
+        keys = self.expand(magic)
+        if not keys:
+            return
+
+        node = self.root
+        for key in keys:
+            node = node.children.setdefault(key, MagicTrie.Node())
+        if node.value is None:
+            node.value = value
+        self.depth = max(self.depth, len(keys))
+
+    def match(self, data):
+        """
+        Returns the value of the longest magic number `data` starts with.
+
+        Args:
+            data (bytes): The first bytes of the host file.
+
+        Returns:
+            The value of the matching magic number, or None if no magic number matches.
+        """
+        best = None
+        nodes = [self.root]
+        for byte in data:
+            next_nodes = []
+            for node in nodes:
+                for key in (byte, None):
+                    child = node.children.get(key)
+                    if child is not None:
+                        next_nodes.append(child)
+            if not next_nodes:
+                break
+            for node in next_nodes:
+                if node.value is not None:
+                    best = node.value
+                    break
+            nodes = next_nodes
+        return best
+
+
+def read_head(file_path, length):
+    """
+    Reads the first bytes of a file with a single os.pread.
+
+    Args:
+        file_path (str): Path to the file.
+        length (int): Number of bytes to read.
+
+    Returns:
+        bytes: The first bytes of the file (shorter if the file is smaller).
+    """
+    fd = os.open(file_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        return os.pread(fd, length, 0)
+    finally:
+        os.close(fd)
@@ -0,0 +1,209 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+
+# Staged pipeline: a streamed job is split into the stages read (pre-flight checks, opening the files),
+# plan (the plugin), encrypt (key derivations and header encryption) and write (copying the layout, check).
+# The Pipeline runs every stage on its own threads, connected by bounded queues, so reading the inputs of
+# one job, deriving the keys of the next and writing the output of the one before happen at the same time.
+# The key derivation (hashlib) and the copies (os.copy_file_range) release the GIL, so the stages really
+# overlap. The bounded queues hold back the jobs of a fast stage, so only a few jobs are open at once.
+
+import queue
+import threading
+
+DEFAULT_QUEUE_SIZE = 2  # Jobs waiting between two stages
+
+# Marks the end of the jobs in a queue
+END = object()
+
+
+class StreamJob:
+    """
+    State of one streamed job while it passes the stages of the Engine (see Engine.STREAM_STAGES).
+
+    Args:
+        host (str): Path to the host file.
+        volume (str): Path to the volume file.
+        password (str): Password of the volume.
+        output (str): Path to the output file as given by the user.
+        engine (Engine): The engine running the stages of this job, see Engine.for_job.
+        data (dict): Data of the caller, e.g. the job of a batch manifest.
+    """
+
+    def __init__(self, host, volume, password, output, engine=None, data=None):
+        self.host = host
+        self.volume = volume
+        self.password = password
+        self.output = output
+        self.engine = engine
+        self.data = data if data is not None else {}
+        self.extension = None
+        self.plugin = None
+        self.volume_file = None
+        self.host_file = None
+        self.volume_size = 0
+        self.layout = None
+        self.predicted_salt = None  # Salt predicted by the plugin before the plan
+        self.headers = None  # Future of the headers re-encrypted for the predicted salt
+        self.backup_header = None  # Offset, original and re-encrypted backup header
+        self.outputfile = None  # Set when the polyglot is complete
+        self.error = None  # Unexpected exception of a stage
+        self.cancelled = False
+
+    def open(self):
+        """Opens the volume and the host file for the following stages."""
+        self.volume_file = open(self.volume, 'rb')
+        self.host_file = open(self.host, 'rb')
+
+    def close(self):
+        """Closes the files of the job."""
+        for file in (self.volume_file, self.host_file):
+            if file:
+                file.close()
+        self.volume_file = self.host_file = None
+
+    def cancel(self):
+        """Cancels the job: a running stage stops at its next chunk boundary, the remaining stages are skipped."""
+        self.cancelled = True
+        if self.engine and self.engine.progress:
+            self.engine.progress.cancel()
+
+
+class Pipeline:
+    """
+    Runs jobs through a sequence of stages. Every stage has its own threads and takes the jobs from a bounded
+    queue filled by the stage before, so the stages work on different jobs at the same time. A job leaves
+    the pipeline after the last stage or as soon as a stage fails.
+
+    Args:
+        stages (list): The stages as (function, threads) tuples. function(job) runs the stage for a job and
+                       returns True if the job goes on to the next stage.
+        queue_size (int): Number of jobs waiting in front of every stage.
+    """
+
+    def __init__(self, stages, queue_size=DEFAULT_QUEUE_SIZE):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.active = set()  # Jobs in the pipeline
+        self.lock = threading.RLock()  # Also taken by cancel(), which may run in a signal handler
+        self.stopped = threading.Event()
+
+    @property
+    def cancelled(self):
+        """True if the pipeline was cancelled."""
+        return self.stopped.is_set()
+
+    def run(self, jobs):
+        """
+        Feeds the jobs into the pipeline and yields them when they leave it, in the order they are finished.
+        A job passed all stages if its attribute 'completed' is True. Its files are closed when it is yielded.
+        If the caller stops early, the remaining jobs are cancelled.
+
+        Args:
+            jobs (iterable): The jobs, objects with the methods cancel() and close(). Read as the pipeline has room.
+
+        Yields:
+            The finished jobs.
+        """
+        queues = [queue.Queue(self.queue_size) for _ in self.stages]
+        finished = queue.Queue()
+        queues.append(finished)
+        errors = []
+
+        threads = [threading.Thread(target=self.feed, args=(jobs, queues[0], errors), name="pipeline-feed", daemon=True)]
+        for index, (function, count) in enumerate(self.stages):
+            remaining = [count]
+            for _ in range(count):
+                threads.append(threading.Thread(target=self.work, name=f"pipeline-stage-{index}", daemon=True,
+                                                args=(function, queues[index], queues[index + 1], finished, remaining)))
+        for thread in threads:
+            thread.start()
+
+        job = None
+        try:
+            while True:
+                job = finished.get()
+                if job is END:
+                    break
+                with self.lock:
+                    self.active.discard(job)
+                job.close()
+                yield job
+        finally:
+            # Stopped early: cancel the jobs left and wait for the stages to drop them
+            if job is not END:
+                self.cancel()
+                while (job := finished.get()) is not END:
+                    job.close()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+
+    def feed(self, jobs, first, errors):
+        """Puts the jobs into the queue of the first stage, waiting while it is full."""
+        try:
+            for job in jobs:
+                job.completed = False
+                with self.lock:
+                    self.active.add(job)
+                if self.cancelled:
+                    job.cancelled = True
+                first.put(job)
+        except Exception as e:
+            # The caller gets the error when the pipeline has finished the jobs read so far
+            errors.append(e)
+        finally:
+            first.put(END)
+
+    def work(self, function, source, target, finished, remaining):
+        """
+        Thread of a stage: runs the stage for the jobs of its queue and passes them on. Jobs that failed
+        or were cancelled skip the remaining stages and go to the queue of the finished jobs.
+        """
+        while True:
+            job = source.get()
+            if job is END:
+                # Let the other threads of this stage see the end as well, the last one passes it on
+                source.put(END)
+                with self.lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    target.put(END)
+                return
+
+            try:
+                passed = not job.cancelled and function(job)
+            except Exception as e:
+                # The stages report their own errors, this keeps the pipeline running if one does not
+                job.error = e
+                passed = False
+            if not passed:
+                finished.put(job)
+                continue
+            job.completed = target is finished
+            target.put(job)
+
+    def cancel(self):
+        """Cancels all jobs in the pipeline and the jobs that are still fed into it."""
+        self.stopped.set()
+        with self.lock:
+            jobs = list(self.active)
+        for job in jobs:
+            job.cancel()
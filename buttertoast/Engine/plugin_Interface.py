@@ -17,6 +17,7 @@
 
 
 from abc import ABC, abstractmethod
+from buttertoast.Engine.layout import Literal
 
 class plugin_Interface(ABC):
     """
@@ -24,6 +25,15 @@ class plugin_Interface(ABC):
     that all plugin implementations must provide.
     """
 
+    # Magic numbers at the start of the host files the plugin supports. The engine uses them to find the
+    # plugin by the content of the host and only falls back to the file extension if none matches.
+    # Each entry is bytes or a tuple of bytes and ints, an int stands for that many arbitrary bytes.
+    magic = ()
+
+    # Plugins whose layout keeps the volume at its original offsets and only appends data after it
+    # can build the polyglot from the volume file itself (in-place mode of the engine).
+    in_place = False
+
     @abstractmethod
     def run(self):
         """
@@ -31,6 +41,74 @@ class plugin_Interface(ABC):
         Must be implemented by any subclass.
         """
         pass
+
+    def plan(self, truecrypt, host):
+        """
+        Describes the polyglot as a layout, an ordered list of segments (Literal, VolumeRange, HostRange,
+        see buttertoast.Engine.layout) that the engine writes without building the polyglot in memory.
+
+        Plugins should override this method. The default implementation is an adapter for plugins that
+        only implement `run`: it reads both files and returns the result of `run` as a single literal segment.
+
+        Args:
+            truecrypt (BinaryIO): The opened TrueCrypt volume.
+            host (BinaryIO): The opened host file.
+
+        Returns:
+            list: The segments of the polyglot file, or None if `run` returned no polyglot.
+        """
+        truecrypt.seek(0)
+        host.seek(0)
+        polyglot = self.run(truecrypt.read(), host.read())
+        if not polyglot:
+            return None
+        return [Literal(polyglot)]
+
+    def salt_for(self, host_prefix, volume_size):
+        """
+        Predicts the salt of the polyglot before it is planned, so the engine can derive the header keys while
+        the files are read and written. Plugins that keep the volume at its offsets return the bytes they write
+        over the start of the volume (at most 64), the engine takes the rest of the 64 byte salt from the volume.
+        The prediction is checked against the planned layout, a wrong one only costs the time of the derivation.
+        The default implementation predicts nothing.
+
+        Args:
+            host_prefix (bytes): The first 64 bytes of the host (fewer if the host is smaller).
+            volume_size (int): The size of the volume.
+
+        Returns:
+            bytes: The start of the salt written by the plugin, or None if it cannot be predicted.
+        """
+        return None
+
+    def validate(self, host):
+        """
+        Checks the host before anything is read from the volume. Plugins should only look at the header
+        and trailer of the host, so invalid hosts are rejected in milliseconds.
+        The default implementation accepts every host.
+
+        Args:
+            host (BinaryIO): The opened host file.
+
+        Raises:
+            ValueError: If the plugin cannot embed a volume into the host, with the reason as message.
+        """
+        pass
+
+    def verify(self, polyglot):
+        """
+        Checks the host structure of a written polyglot, e.g. by walking its chunks.
+        Plugins should only use small reads (headers of chunks, records at the end of the file),
+        so the polyglot is not read completely. The default implementation accepts every polyglot.
+
+        Args:
+            polyglot (BinaryIO): The opened polyglot file.
+
+        Raises:
+            ValueError: If the polyglot is no valid file of the host format, with the reason as message.
+        """
+        pass
+
     #planned but not implemented yet:    
     #@abstractmethod
     #def info(self):
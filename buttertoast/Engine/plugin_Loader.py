@@ -16,9 +16,260 @@
 # For more information, contact: mail@matthias-ferstl.de
 
 
-import importlib
+import importlib.util
+import json
 import os
-import sys
+import tempfile
+import threading
+
+from buttertoast.Engine.magic import MagicTrie, read_head
+
+try:
+    from platformdirs import user_cache_dir
+except ImportError:
+    user_cache_dir = None
+
+
+def default_index_path():
+    """
+    Returns the path of the plugin index in the cache directory of the user, so it is never written into
+    the installed package. Falls back to $XDG_CACHE_HOME or ~/.cache if platformdirs is not installed.
+    """
+    if user_cache_dir:
+        cache_dir = user_cache_dir("buttertoast", appauthor=False)
+    else:
+        cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                                 "buttertoast")
+    return os.path.join(cache_dir, "plugin_index.json")
+
+
+class PluginRegistry:
+    """
+    Process-wide registry of the plugins in one directory. The directory is scanned once into a
+    dictionary extension -> plugin file, and imported plugin classes are kept in memory, so repeated
+    jobs look plugins up in O(1). The dictionary is also stored in an index file in the cache directory of
+    the user, which is only used while the modification time of the plugin directory did not change.
+    All methods are thread-safe, plugins are loaded from their file without touching sys.path.
+    """
+
+    INDEX_PATH = default_index_path()
+
+    registries = {}  # plugin directory -> PluginRegistry
+    registries_lock = threading.Lock()
+
+    @classmethod
+    def for_directory(cls, plugin_path):
+        """
+        Returns the registry for a plugin directory, creating it on first use.
+
+        Args:
+            plugin_path (str): The plugin directory.
+
+        Returns:
+            PluginRegistry: The registry of the directory.
+        """
+        with cls.registries_lock:
+            if plugin_path not in cls.registries:
+                cls.registries[plugin_path] = cls(plugin_path)
+            return cls.registries[plugin_path]
+
+    def __init__(self, plugin_path):
+        self.plugin_path = plugin_path
+        self.mtime_ns = None  # Modification time of the directory when it was scanned
+        self.plugin_files = {}  # extension -> plugin file name
+        self.plugin_classes = {}  # plugin name -> imported 'Filetype' class
+        self.magic_trie = None  # Magic numbers of all plugins -> plugin name, built on first use
+        self.lock = threading.RLock()  # Protects the dictionaries, plugins are imported while holding it
+
+    def directory_mtime(self):
+        """
+        Returns the modification time of the plugin directory in nanoseconds, or None if it does not exist.
+        """
+        try:
+            return os.stat(self.plugin_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def refresh(self):
+        """
+        Rebuilds the dictionary if the plugin directory changed since it was scanned.
+        Uses the index file if it matches the directory, otherwise scans the directory and rewrites the index.
+        """
+        mtime_ns = self.directory_mtime()
+        with self.lock:
+            if mtime_ns == self.mtime_ns:
+                return
+
+            plugin_files = self.read_index(mtime_ns)
+            if plugin_files is None:
+                plugin_files = self.scan()
+                self.write_index(mtime_ns, plugin_files)
+
+            # Plugins may have been replaced, import them again on next use
+            self.plugin_files = plugin_files
+            self.plugin_classes = {}
+            self.magic_trie = None
+            self.mtime_ns = mtime_ns
+
+    def scan(self):
+        """
+        Scans the plugin directory for files named 'btp_<ext>[_<ext>...].py'.
+
+        Returns:
+            dict: extension -> plugin file name. If several files claim an extension, the first in sorted order wins.
+        """
+        plugin_files = {}
+        if not os.path.isdir(self.plugin_path):
+            return plugin_files
+
+        for file in sorted(os.listdir(self.plugin_path)):
+            if file.startswith('btp_') and file.endswith('.py'):
+                for extension in file[4:-3].split('_'):  # Remove "btp_" prefix and ".py" suffix
+                    plugin_files.setdefault(extension, file)
+        return plugin_files
+
+    def read_index(self, mtime_ns):
+        """
+        Reads the index file.
+
+        Args:
+            mtime_ns (int): The current modification time of the plugin directory.
+
+        Returns:
+            dict: extension -> plugin file name, or None if there is no index for the directory in its current state.
+        """
+        try:
+            with open(self.INDEX_PATH, 'r') as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        entry = index.get(self.plugin_path) if isinstance(index, dict) else None
+        if not entry or entry.get("mtime_ns") != mtime_ns or mtime_ns is None:
+            return None
+        return entry.get("plugins")
+
+    def write_index(self, mtime_ns, plugin_files):
+        """
+        Stores the dictionary of the plugin directory in the index file. The index is written to a temporary
+        file that replaces it, so a process reading it concurrently never sees a partial file. Errors are
+        ignored, the index is only a cache.
+
+        Args:
+            mtime_ns (int): The modification time of the plugin directory when it was scanned.
+            plugin_files (dict): extension -> plugin file name.
+        """
+        if mtime_ns is None:
+            return
+        try:
+            with open(self.INDEX_PATH, 'r') as file:
+                index = json.load(file)
+            if not isinstance(index, dict):
+                index = {}
+        except (OSError, ValueError):
+            index = {}
+
+        index[self.plugin_path] = {"mtime_ns": mtime_ns, "plugins": plugin_files}
+        temp_path = None
+        try:
+            index_dir = os.path.dirname(self.INDEX_PATH)
+            os.makedirs(index_dir, exist_ok=True)
+            descriptor, temp_path = tempfile.mkstemp(prefix="plugin_index.", suffix=".tmp", dir=index_dir)
+            with os.fdopen(descriptor, 'w') as file:
+                json.dump(index, file, indent=4)
+            os.replace(temp_path, self.INDEX_PATH)
+        except OSError:
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def get_plugin_file(self, extension):
+        """
+        Returns the plugin file for an extension.
+
+        Args:
+            extension (str): The file extension.
+
+        Returns:
+            str: The file name of the plugin, or None if no plugin supports the extension.
+        """
+        self.refresh()
+        return self.plugin_files.get(extension)
+
+    def get_plugin_class(self, plugin_name):
+        """
+        Returns the 'Filetype' class of a plugin. The plugin module is loaded from its file with
+        importlib.util.spec_from_file_location on first use and cached, so concurrent jobs neither
+        import it twice nor race on sys.path.
+
+        Args:
+            plugin_name (str): The name of the plugin (file name without '.py').
+
+        Returns:
+            type: The 'Filetype' class of the plugin.
+
+        Raises:
+            ModuleNotFoundError: If the plugin file does not exist.
+            AttributeError: If the plugin does not define a 'Filetype' class.
+        """
+        with self.lock:
+            plugin_class = self.plugin_classes.get(plugin_name)
+            if plugin_class:
+                return plugin_class
+
+            plugin_file = os.path.join(self.plugin_path, plugin_name + ".py")
+            if not os.path.isfile(plugin_file):
+                raise ModuleNotFoundError(f"No plugin file '{plugin_file}'", name=plugin_name)
+
+            spec = importlib.util.spec_from_file_location(plugin_name, plugin_file)
+            plugin_module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(plugin_module)
+
+            plugin_class = getattr(plugin_module, 'Filetype')
+            self.plugin_classes[plugin_name] = plugin_class
+            return plugin_class
+
+    def get_magic_trie(self):
+        """
+        Returns the prefix trie of the magic numbers declared by the plugins.
+        Builds it on first use, which loads every plugin once. Plugins that cannot be loaded are skipped,
+        if several plugins declare the same magic number, the first in sorted order wins.
+
+        Returns:
+            MagicTrie: The magic numbers, mapped to plugin names.
+        """
+        self.refresh()
+        with self.lock:
+            if self.magic_trie is None:
+                magic_trie = MagicTrie()
+                for plugin_name in self.get_plugin_names():
+                    try:
+                        plugin_class = self.get_plugin_class(plugin_name)
+                    except Exception:
+                        continue
+                    for magic in getattr(plugin_class, 'magic', ()):
+                        magic_trie.insert(magic, plugin_name)
+                self.magic_trie = magic_trie
+            return self.magic_trie
+
+    def get_plugin_extensions(self, plugin_name):
+        """
+        Returns the extensions a plugin supports, in the order of its file name.
+
+        Args:
+            plugin_name (str): The name of the plugin (file name without '.py').
+
+        Returns:
+            list: The extensions, e.g. ['jpg', 'jpeg'] for 'btp_jpg_jpeg'.
+        """
+        return plugin_name[4:].split('_')  # Remove "btp_" prefix
+
+    def get_plugin_names(self):
+        """
+        Returns the names of all plugins (file names without '.py'), sorted.
+        """
+        self.refresh()
+        return sorted({file[:-3] for file in self.plugin_files.values()})
+
 
 class PluginLoader:
     """
@@ -41,30 +292,12 @@ class PluginLoader:
         # Get the project root directory (one level above the current file)
         project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         self.plugin_path = os.path.join(project_root, directory)
+        self.registry = PluginRegistry.for_directory(self.plugin_path)
 
         # Debugging: print the resolved plugin path
         if self.ui:
             self.ui.display_message(f"Resolved plugin path: {self.plugin_path}", "verbose")
 
-    def add_plugin_directory_to_sys_path(self):
-        """
-        Adds the plugin directory to sys.path to ensure that Python can locate plugins
-        even if they are added dynamically or outside of the running environment.
-        """
-        if self.plugin_path not in sys.path:
-            if self.ui:
-                self.ui.display_message(f"Adding plugin directory '{self.plugin_path}' to sys.path...", "verbose")
-            sys.path.insert(0, self.plugin_path)
-
-    def remove_plugin_directory_from_sys_path(self):
-        """
-        Removes the plugin directory from sys.path after plugin execution to clean up.
-        """
-        if self.plugin_path in sys.path:
-            if self.ui:
-                self.ui.display_message(f"Removing plugin directory '{self.plugin_path}' from sys.path...", "verbose")
-            sys.path.remove(self.plugin_path)
-
     def find_plugin_in_directory(self, extension):
         """
         Looks for a plugin in the specified local plugin directory.
@@ -89,6 +322,7 @@ class PluginLoader:
         """
         Finds a file in the specified directory that starts with 'btp_' and ends with '.py'
         and contains the given extension in its partitioned filename.
+        The lookup uses the plugin registry, the directory is only scanned when it changed.
 
         Args:
             extension (str): The string to search for in the partitioned filename.
@@ -96,16 +330,11 @@ class PluginLoader:
         Returns:
             str: The filename of the matching file, or None if no match is found.
         """
-        self.ui.display_message(f"Searching for a file in '{self.plugin_path}' with the partition containing '{extension}'...", "verbose")
-        files = [f for f in os.listdir(self.plugin_path) if f.startswith('btp_') and f.endswith('.py')]
-
-        for file in files:
-            partitions = file[4:-3].split('_')  # Remove "btp_" prefix and ".py" suffix
-            self.ui.display_message(f"Checking file '{file}' for extension match with '{extension}'...", "verbose")
-
-            if extension in partitions:
-                self.ui.display_message(f"Found file '{file}' for extension '{extension}'.", "verbose")
-                return file
+        self.ui.display_message(f"Looking up the plugin file for '{extension}' in '{self.plugin_path}'...", "verbose")
+        file = self.registry.get_plugin_file(extension)
+        if file:
+            self.ui.display_message(f"Found file '{file}' for extension '{extension}'.", "verbose")
+            return file
 
         self.ui.display_message(f"Could not find an extension for '{extension}'. Please check the plugin folder.", "error")
         return None
@@ -129,60 +358,133 @@ class PluginLoader:
         else:
             return None
 
-    def load_and_run_plugin(self, volume_byte, host_byte, extension):
+    def load_plugin(self, extension, plugin_name=None):
         """
-        Loads and runs the plugin based on the file extension.
+        Loads the plugin for the given file extension and returns an instance of its 'Filetype' class.
 
         Args:
-            volume_byte (bytes): The bytecode data of the volume.
-            host_byte (bytes): The bytecode data of the host.
             extension (str): The file extension.
+            plugin_name (str): The plugin to load if it is already known, e.g. detected by the content of the host.
 
         Returns:
-            bytes: The processed bytecode after running the plugin.
+            plugin_Interface: The plugin instance, or None if the plugin could not be loaded.
         """
         if self.ui:
             self.ui.display_message(f"Trying to load the plugin for extension '{extension}'...", "verbose")
 
-        plugin_name = self.find_plugin_in_directory(extension)
+        plugin_name = plugin_name or self.find_plugin_in_directory(extension)
         if not plugin_name:
             return
 
         if self.ui:
             self.ui.display_message(f"Found file extension: '{extension}', Plugin name: '{plugin_name}'", "verbose")
 
-        self.add_plugin_directory_to_sys_path()
-
         try:
             if self.ui:
-                self.ui.display_message(f"Attempting to import plugin '{plugin_name}' and load the class...", "verbose")
+                self.ui.display_message(f"Loading the class of plugin '{plugin_name}'...", "verbose")
 
-            plugin_module = importlib.import_module(plugin_name)
-            class_name = 'Filetype'
-            plugin_class = getattr(plugin_module, class_name)
+            # Plugin classes are imported once per process and then taken from the registry
+            plugin_class = self.registry.get_plugin_class(plugin_name)
 
             if self.ui:
                 self.ui.display_message(f"Creating an instance of '{plugin_class.__name__}'...", "verbose")
 
-            plugin_instance = plugin_class()
+            return plugin_class()
+
+        except (ModuleNotFoundError, AttributeError) as e:
             if self.ui:
-                self.ui.display_message(f"Running the 'run' method of '{plugin_class.__name__}'...", "verbose")
+                self.ui.display_message(f"Error loading plugin '{plugin_name}': {e}", "error")
+        except Exception as e:
+            if self.ui:
+                self.ui.display_message(f"Error initializing the plugin '{plugin_name}': {e}", "error")
 
-            poly_byte = plugin_instance.run(volume_byte, host_byte)
+    def detect_plugin(self, host):
+        """
+        Finds the plugin for a host file by its content: the first bytes of the host are read with one
+        os.pread and matched against the magic numbers of the plugins. Only if none matches, the plugin
+        is looked up by the file extension of the host.
+
+        Args:
+            host (str): Path to the host file.
+
+        Returns:
+            tuple: The extension to use for the polyglot and the plugin name, or (extension, None) if no plugin was found.
+        """
+        _, extension = os.path.splitext(host)
+        extension = extension.lstrip('.')
 
+        magic_trie = self.registry.get_magic_trie()
+        plugin_name = magic_trie.match(read_head(host, magic_trie.depth)) if magic_trie.depth else None
+        if plugin_name:
+            extensions = self.registry.get_plugin_extensions(plugin_name)
+            # Keep the extension of the host if the plugin supports it (e.g. 'jpeg'), otherwise use the plugin's
+            if extension.lower() not in extensions:
+                extension = extensions[0]
+            extension = extension.lower()
             if self.ui:
-                self.ui.display_message(f"'{plugin_class.__name__}' executed successfully.", "verbose")
+                self.ui.display_message(f"Detected plugin '{plugin_name}' by the content of '{host}'.", "verbose")
+            return extension, plugin_name
 
-            return poly_byte
+        if self.ui:
+            self.ui.display_message(f"No magic number matched '{host}', using its file extension.", "verbose")
+        if not self.registry.get_plugin_file(extension) and self.registry.get_plugin_file(extension.lower()):
+            extension = extension.lower()
+        return extension, self.get_plugin_name(extension)
 
-        except (ModuleNotFoundError, AttributeError) as e:
+    def load_plugin_for_host(self, host):
+        """
+        Loads the plugin for a host file, detected by its content (see detect_plugin).
+        Reads only the first bytes of the host, so unsupported hosts are rejected before any large read.
+
+        Args:
+            host (str): Path to the host file.
+
+        Returns:
+            tuple: The extension to use for the polyglot and the plugin instance (None if no plugin could be loaded).
+        """
+        extension, plugin_name = self.detect_plugin(host)
+        if not plugin_name:
+            return extension, None
+        return extension, self.load_plugin(extension, plugin_name)
+
+    def load_and_run_plugin(self, volume_byte, host_byte, extension, plugin_name=None, progress=None):
+        """
+        Loads and runs the plugin based on the file extension.
+
+        Args:
+            volume_byte (bytes): The bytecode data of the volume.
+            host_byte (bytes): The bytecode data of the host.
+            extension (str): The file extension.
+            plugin_name (str): The plugin to run if it is already known, e.g. detected by the content of the host.
+            progress (Progress): Optional progress of the job. The plugin runs as one stage, a cancelled job
+                                 raises Cancelled before and after it.
+
+        Returns:
+            bytes: The processed bytecode after running the plugin.
+        """
+        plugin_instance = self.load_plugin(extension, plugin_name)
+        if not plugin_instance:
+            return
+
+        if progress:
+            progress.stage("Embedding the volume", len(volume_byte) + len(host_byte))
+        try:
             if self.ui:
-                self.ui.display_message(f"Error loading plugin '{plugin_name}': {e}", "error")
+                self.ui.display_message(f"Running the 'run' method of '{type(plugin_instance).__name__}'...", "verbose")
+
+            poly_byte = plugin_instance.run(volume_byte, host_byte)
+
+            if self.ui:
+                self.ui.display_message(f"'{type(plugin_instance).__name__}' executed successfully.", "verbose")
+
         except Exception as e:
             if self.ui:
                 self.ui.display_message(f"Error executing the plugin: {e}", "error")
-        finally:
-            self.remove_plugin_directory_from_sys_path()
+            return
+
+        if progress:
+            progress.advance(len(volume_byte) + len(host_byte))
+        return poly_byte
 
     def list_plugins(self):
         """
@@ -202,15 +504,9 @@ class PluginLoader:
             self.ui.display_message(f"Available plugins:", "message")
             self.ui.display_message(f"-" * 50, "message")
 
-        for filename in os.listdir(self.plugin_path):
-            if filename.startswith("btp_") and filename.endswith(".py") and filename != "__init__.py":
-                plugin_name = filename[:-3]  # removing ".py"
-                try:
-                    if self.ui:
-                        self.ui.display_message(f"{plugin_name}", "message")
-                    available_plugins.append(plugin_name)
-                except Exception as e:
-                    if self.ui:
-                        self.ui.display_message(f"Error loading plugin '{plugin_name}': {e}", "error")
+        for plugin_name in self.registry.get_plugin_names():
+            if self.ui:
+                self.ui.display_message(f"{plugin_name}", "message")
+            available_plugins.append(plugin_name)
 
         return available_plugins
\ No newline at end of file
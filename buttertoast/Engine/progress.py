@@ -0,0 +1,206 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+
+# Progress of a running job. The engine passes one Progress object through all stages of a job
+# (read, plugin, key derivation, header encryption, write and check): every stage is started with stage(),
+# processed bytes are reported with advance() at chunk boundaries, and the time of every stage is recorded.
+# The UI shows the progress (e.g. in a progress bar) and can cancel the job from another thread or a
+# signal handler; the job stops at the next chunk boundary with the Cancelled exception.
+
+import signal
+import threading
+import time
+from contextlib import contextmanager
+
+NOTIFY_INTERVAL = 0.1  # Minimum time between two progress callbacks within a stage (seconds)
+
+
+class Cancelled(Exception):
+    """
+    Raised in the engine when the job was cancelled by the user.
+    """
+
+    def __init__(self, message="The operation was cancelled."):
+        super().__init__(message)
+
+
+class Progress:
+    """
+    Progress, stage timings and cancellation flag of one job, shared between the UI and the engine.
+    """
+
+    def __init__(self, callback=None):
+        """
+        Args:
+            callback (callable): Optional function called with this Progress whenever a stage starts or ends,
+                                 and at most every NOTIFY_INTERVAL seconds while bytes are processed.
+                                 It is called in the thread running the job.
+        """
+        self.callback = callback
+        self.cancel_event = threading.Event()
+        self.stage_name = None
+        self.done = 0
+        self.total = 0
+        self.stage_started = None
+        self.last_notified = 0.0
+        self.timings = []  # Finished stages: name, seconds and bytes processed
+
+    def cancel(self):
+        """
+        Asks the job to stop. Can be called from any thread and from signal handlers.
+        """
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def check(self):
+        """
+        Raises Cancelled if the job was cancelled.
+        """
+        if self.cancel_event.is_set():
+            raise Cancelled()
+
+    def stage(self, name, total=0):
+        """
+        Ends the current stage and starts a new one.
+
+        Args:
+            name (str): Name of the stage, shown by the UI.
+            total (int): Number of bytes the stage processes, 0 if unknown.
+        """
+        self.check()
+        self.end_stage()
+        self.stage_name = name
+        self.done = 0
+        self.total = total
+        self.stage_started = time.perf_counter()
+        self.notify(force=True)
+
+    def advance(self, count):
+        """
+        Adds processed bytes to the current stage. Called at chunk boundaries, so a cancelled job stops here.
+
+        Args:
+            count (int): Number of bytes processed since the last call.
+        """
+        self.done += count
+        self.notify(force=bool(self.total) and self.done >= self.total)
+        self.check()
+
+    def end_stage(self):
+        """
+        Records the time of the current stage. Called by stage() and when the job has ended.
+        """
+        if self.stage_name is None:
+            return
+        self.timings.append({"stage": self.stage_name, "seconds": round(self.elapsed(), 6), "bytes": self.done})
+        self.stage_name = None
+
+    def elapsed(self):
+        """
+        Returns the time spent in the current stage in seconds.
+        """
+        return time.perf_counter() - self.stage_started if self.stage_started is not None else 0.0
+
+    def eta(self):
+        """
+        Estimates the remaining time of the current stage from its throughput so far.
+
+        Returns:
+            float: Remaining seconds, or None if the stage has no known size or nothing was processed yet.
+        """
+        if not self.total or not self.done:
+            return None
+        return self.elapsed() * (self.total - self.done) / self.done
+
+    def describe(self):
+        """
+        Summarizes the current stage in one line, e.g. "Writing the polyglot: 42% (1.3 of 3.0 GB), 0:00:07 left".
+        """
+        if not self.total:
+            return f"{self.stage_name}..."
+        text = f"{self.stage_name}: {min(100, self.done * 100 // self.total)}% ({format_size(self.done, self.total)})"
+        eta = self.eta()
+        if eta is not None:
+            text += f", {time.strftime('%H:%M:%S', time.gmtime(eta))} left"
+        return text
+
+    def notify(self, force=False):
+        if not self.callback:
+            return
+        now = time.perf_counter()
+        if force or now - self.last_notified >= NOTIFY_INTERVAL:
+            self.last_notified = now
+            self.callback(self)
+
+
+def format_size(done, total):
+    """
+    Formats processed and total bytes in the unit of the total, e.g. "1.3 of 3.0 GB".
+    """
+    for unit, factor in (("GB", 1e9), ("MB", 1e6), ("kB", 1e3)):
+        if total >= factor:
+            return f"{done / factor:.1f} of {total / factor:.1f} {unit}"
+    return f"{done} of {total} bytes"
+
+
+def describe_timings(timings):
+    """
+    Summarizes the recorded stages of a job in one line, with the throughput of stages that processed bytes.
+
+    Args:
+        timings (list): The timings of a Progress.
+
+    Returns:
+        str: e.g. "Planning the polyglot 0.00 s, Writing the polyglot 1.20 s (850.2 MB/s)".
+    """
+    parts = []
+    for timing in timings:
+        part = f"{timing['stage']} {timing['seconds']:.2f} s"
+        if timing["bytes"] and timing["seconds"]:
+            part += f" ({timing['bytes'] / timing['seconds'] / 1e6:.1f} MB/s)"
+        parts.append(part)
+    return ", ".join(parts)
+
+
+@contextmanager
+def cancel_on_interrupt(progress):
+    """
+    Cancels the job on Ctrl+C instead of interrupting it, so it stops cleanly at the next chunk boundary.
+    A second Ctrl+C interrupts as usual. Signal handlers can only be set in the main thread, elsewhere
+    this does nothing.
+
+    Args:
+        progress (Progress): The progress of the job.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def handler(signum, frame):
+        if progress.cancelled:
+            raise KeyboardInterrupt
+        progress.cancel()
+
+    previous = signal.signal(signal.SIGINT, handler)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGINT, previous)
@@ -51,6 +51,21 @@ class BaseUI(ABC):
         """
         pass
 
+    def display_progress(self, progress):
+        """
+        Shows the progress of the running job. UIs that cannot show it ignore it.
+
+        Args:
+            progress (Progress): The progress of the job (stage, bytes done and total, remaining time).
+        """
+        pass
+
+    def clear_progress(self):
+        """
+        Removes the progress display when the job has ended.
+        """
+        pass
+
     @abstractmethod
     def edit_config(self):
         """
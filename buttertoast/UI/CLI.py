@@ -16,14 +16,54 @@
 # For more information, contact: mail@matthias-ferstl.de
 
 
+import shutil
+import sys
+
+
+class ProgressLine:
+    """
+    Shows the progress of a job in one line of the terminal (stderr), overwritten in place.
+    Nothing is shown if stderr is no terminal, e.g. when the output is redirected to a file.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+        self.shown = False
+
+    def show(self, progress):
+        if not self.stream.isatty():
+            return
+        width = shutil.get_terminal_size().columns - 1
+        self.stream.write("\r" + progress.describe()[:width].ljust(width))
+        self.stream.flush()
+        self.shown = True
+
+    def clear(self):
+        if not self.shown:
+            return
+        width = shutil.get_terminal_size().columns - 1
+        self.stream.write("\r" + " " * width + "\r")
+        self.stream.flush()
+        self.shown = False
+
 
 class CLI():
     def __init__(self, verbose):
 
         self.verbose = verbose
+        self.progress_line = ProgressLine()
+
+
+    def display_progress(self, progress):
+        """Shows the stage, percentage and remaining time of the running job."""
+        self.progress_line.show(progress)
 
+    def clear_progress(self):
+        """Removes the progress line, e.g. before a message is printed or when the job has ended."""
+        self.progress_line.clear()
 
     def display_message(self, message, message_type):
+        self.clear_progress()
 
         # ANSI color codes
         colors = {
@@ -17,19 +17,22 @@
 
 
 from buttertoast.UI.BaseUI import BaseUI
-from PySide6.QtCore import QPropertyAnimation
-from PySide6.QtGui import QPixmap, QIcon, QAction, QFont
+from buttertoast.Engine.progress import Progress
+from PySide6.QtCore import QPropertyAnimation, QObject, QThread, Signal
+from PySide6.QtGui import QPixmap, QIcon, QAction, QFont, QIntValidator
 from PySide6.QtWidgets import (
-    QApplication, QMainWindow, QLabel, QPushButton, QVBoxLayout,
-    QWidget, QMessageBox, QLineEdit, QFileDialog, QHBoxLayout, QTextEdit, QCheckBox, QDialog
+    QApplication, QMainWindow, QLabel, QPushButton, QVBoxLayout, QProgressBar,
+    QWidget, QMessageBox, QLineEdit, QFileDialog, QHBoxLayout, QTextEdit, QCheckBox, QDialog, QInputDialog
 )
 import sys
 import markdown
 import importlib.resources
 
-# Zugriff auf die Ressourcen im Paket buttertoast
-with importlib.resources.path("buttertoast.res", "BuToTransp.png") as logo_path:
-    LOGO_PATH = str(logo_path)
+def get_logo_path():
+    """Returns the path of the logo in the resources of the buttertoast package."""
+    # Zugriff auf die Ressourcen im Paket buttertoast
+    with importlib.resources.path("buttertoast.res", "BuToTransp.png") as logo_path:
+        return str(logo_path)
 
 class FileButton(QPushButton):
     """A custom button that supports drag-and-drop functionality."""
@@ -56,6 +59,25 @@ class FileButton(QPushButton):
 
     
 
+class UIBridge(QObject):
+    """Carries messages and progress from the worker thread to the Qt main thread (queued signals)."""
+    message = Signal(str, str)  # message, message type
+    progress = Signal(str, object, object, str)  # stage, bytes done, total bytes (Python ints), description
+
+
+class ProcessWorker(QThread):
+    """Runs a job of the engine ('process_data' or 'rekey') outside of the Qt main thread, so the window stays responsive."""
+    def __init__(self, event_manager, data, parent=None, event="process_data"):
+        super().__init__(parent)
+        self.event_manager = event_manager
+        self.data = data
+        self.event_name = event
+
+    def run(self):
+        """Triggers the event in the worker thread, the engine handles it there."""
+        self.event_manager.trigger_event(self.event_name, self.data)
+
+
 class GUI(BaseUI):
     def __init__(self, engine, event_manager):
         super().__init__(engine)
@@ -66,6 +88,8 @@ class GUI(BaseUI):
         self.save_location = None
         self.event_manager =event_manager
         self.load_config()
+        self.worker = None  # Thread running the current job
+        self.job_progress = None  # Progress of the current job, used to cancel it
         
 
         if not QApplication.instance():
@@ -73,6 +97,8 @@ class GUI(BaseUI):
         else:
             self.app = QApplication.instance()
 
+        logo_path = get_logo_path()
+
         # Create main window
         self.window = QMainWindow()
         self.window.setWindowTitle("Buttertoast. The melting pot for polyglot")
@@ -81,13 +107,18 @@ class GUI(BaseUI):
         # Create central widget
         central_widget = QWidget()
         self.window.setCentralWidget(central_widget)
-        self.window.setWindowIcon(QIcon(LOGO_PATH))
+        self.window.setWindowIcon(QIcon(logo_path))
 
         self.create_menu()
 
+        # Messages and progress of the worker thread are shown by the main thread
+        self.bridge = UIBridge()
+        self.bridge.message.connect(self.show_message)
+        self.bridge.progress.connect(self.update_progress)
+
         # Add background image
         self.background_label = QLabel(central_widget)
-        self.background_label.setPixmap(QPixmap(LOGO_PATH))
+        self.background_label.setPixmap(QPixmap(logo_path))
         self.background_label.setScaledContents(True)
         self.background_label.setGeometry(0, 0, 600, 600)
 
@@ -126,6 +157,12 @@ class GUI(BaseUI):
         self.show_password_checkbox = QCheckBox("Show Password", central_widget)
         self.show_password_checkbox.stateChanged.connect(self.toggle_password)
 
+        # Personal iterations multiplier of VeraCrypt volumes, empty for the default
+        self.pim_entry = QLineEdit(central_widget)
+        self.pim_entry.setValidator(QIntValidator(1, 2147468, self.pim_entry))
+        self.pim_entry.setPlaceholderText("PIM (optional)")
+        self.pim_entry.setMaximumWidth(120)
+
         # Execute and Cancel buttons
         self.execute_button = QPushButton("Execute", central_widget)
         self.execute_button.setEnabled(False)  # Initially disabled
@@ -133,6 +170,12 @@ class GUI(BaseUI):
         self.execute_button.clicked.connect(self.on_execute_click)
         self.cancel_button.clicked.connect(self.on_exit_click)
 
+        # Progress of the running job
+        self.progress_bar = QProgressBar(central_widget)
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setValue(0)
+        self.progress_bar.setFormat("Ready")
+
         # Log output
         self.log_output = QTextEdit(central_widget)
         self.log_output.setReadOnly(True)
@@ -156,6 +199,7 @@ class GUI(BaseUI):
         # Password field and checkbox
         password_layout = QHBoxLayout()
         password_layout.addWidget(self.password_entry)
+        password_layout.addWidget(self.pim_entry)
         password_layout.addWidget(self.show_password_checkbox)
 
         # Execute and Cancel buttons side by side
@@ -172,6 +216,7 @@ class GUI(BaseUI):
         main_layout.addLayout(file_buttons_layout) # File selection buttons in main layout
         main_layout.addLayout(password_layout) # Password field and checkbox
         main_layout.addLayout(action_buttons_layout) # Execute and Cancel
+        main_layout.addWidget(self.progress_bar) # Progress of the running job
         main_layout.addLayout(bottom_layout) # Log area
 
         # Show window
@@ -212,6 +257,13 @@ class GUI(BaseUI):
         settings_menu.addAction(toggle_check_action)
 
 
+        # Create the "Tools" menu
+        tools_menu = menubar.addMenu("Tools")
+
+        rekey_action = QAction("Change Password of a Polyglot...", self.window)
+        rekey_action.triggered.connect(self.rekey_polyglot)
+        tools_menu.addAction(rekey_action)
+
         # Create the "About" menu
         about_menu = menubar.addMenu("About")
 
@@ -281,21 +333,112 @@ class GUI(BaseUI):
             self.update_execute_button_state()
 
     def on_execute_click(self):
-        """Executes the main logic."""
+        """Executes the main logic on a worker thread."""
+        if self.worker is not None:
+            return
+
         host = self.host_file
         guest = self.guest_file
         password = self.password_entry.text()
         saveloc = self.save_location
-        
-        self.event_manager.trigger_event("process_data", {
+
+        # The engine reports its progress in the worker thread, the bridge passes it on to the progress bar
+        self.job_progress = Progress(callback=self.display_progress)
+        self.worker = ProcessWorker(self.event_manager, {
             "host": host,
             "volume": guest,
             "password": password,
             "output": saveloc,
+            "pim": self.get_pim(),
+            "progress": self.job_progress,
         })
+        self.start_worker()
+
+    def start_worker(self):
+        """Starts the prepared worker thread and shows the job as running."""
+        self.worker.finished.connect(self.on_worker_finished)
+
+        self.execute_button.setEnabled(False)
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.setFormat("Starting...")
+        self.worker.start()
+
+    def get_pim(self):
+        """Returns the PIM entered for a VeraCrypt volume, or None for the default."""
+        text = self.pim_entry.text().strip()
+        return int(text) if text else None
+
+    def on_worker_finished(self):
+        """Resets the progress bar and the buttons when the job has ended."""
+        cancelled = self.job_progress.cancelled
+        self.worker.deleteLater()
+        self.worker = None
+        self.job_progress = None
+
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setValue(0 if cancelled else 100)
+        self.progress_bar.setFormat("Cancelled" if cancelled else "Done")
+        self.update_execute_button_state()
+
+    def display_progress(self, progress):
+        """Passes the progress of the running job from the worker thread on to the progress bar."""
+        self.bridge.progress.emit(progress.stage_name, progress.done, progress.total, progress.describe())
+
+    def update_progress(self, stage, done, total, description):
+        """Shows the progress of the running job: percent of the bytes of the stage and remaining time, or busy if unknown."""
+        if total:
+            self.progress_bar.setRange(0, 100)
+            self.progress_bar.setValue(min(100, done * 100 // total))
+        else:
+            self.progress_bar.setRange(0, 0)
+        self.progress_bar.setFormat(description)
+
+    def rekey_polyglot(self):
+        """
+        Asks for an existing polyglot and its old and new password and triggers the 'rekey' event on a worker thread.
+        The PIM of the main window is used for the volume.
+        """
+        if self.worker is not None:
+            self.display_message("Wait until the running job has ended.", "error")
+            return
+
+        polyglot, _ = QFileDialog.getOpenFileName(self.window, "Select Polyglot File")
+        if not polyglot:
+            return
+
+        old_password, ok = QInputDialog.getText(self.window, "Change Password", "Old password:", QLineEdit.Password)
+        if not ok or not old_password:
+            return
+        new_password, ok = QInputDialog.getText(self.window, "Change Password", "New password:", QLineEdit.Password)
+        if not ok or not new_password:
+            return
+        repeated_password, ok = QInputDialog.getText(self.window, "Change Password", "Repeat the new password:", QLineEdit.Password)
+        if not ok:
+            return
+        if new_password != repeated_password:
+            self.display_message("The new passwords do not match.", "error")
+            return
+
+        self.log_output.append(f"Changing the password of: {polyglot}")
+        # Detecting the header format can take many seconds, the window stays responsive meanwhile
+        self.job_progress = Progress(callback=self.display_progress)
+        self.worker = ProcessWorker(self.event_manager, {
+            "polyglot": polyglot,
+            "old_password": old_password,
+            "new_password": new_password,
+            "pim": self.get_pim(),
+            "progress": self.job_progress,
+        }, event="rekey")
+        self.start_worker()
 
     def on_exit_click(self):
-        """Closes the program."""
+        """Cancels the running job, or closes the program if no job is running."""
+        if self.worker is not None:
+            self.job_progress.cancel()
+            self.progress_bar.setFormat("Cancelling...")
+            self.log_output.append("Cancelling the running job...")
+            return
+
         reply = QMessageBox.question(self.window, "Exit", "Are you sure you want to exit?",
                                      QMessageBox.Yes | QMessageBox.No)
         if reply == QMessageBox.Yes:
@@ -322,6 +465,13 @@ class GUI(BaseUI):
         self.window.move(window_geometry.topLeft())
 
     def display_message(self, message, message_type):
+        """Displays a message, passing it on to the main thread if it is called from the worker thread."""
+        if QThread.currentThread() != self.app.thread():
+            self.bridge.message.emit(message, message_type)
+            return
+        self.show_message(message, message_type)
+
+    def show_message(self, message, message_type):
         """Displays a message in the log area of the GUI and optionally as a popup."""
         if message_type == "info":
             self.log_output.append(f"[INFO] {message}")
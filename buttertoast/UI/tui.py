@@ -16,6 +16,8 @@
 # For more information, contact: mail@matthias-ferstl.de
 
 from buttertoast.UI.BaseUI import BaseUI
+from buttertoast.UI.CLI import ProgressLine
+from buttertoast.Engine.progress import Progress, cancel_on_interrupt
 import getpass
 import importlib.resources
 from rich.console import Console
@@ -32,6 +34,7 @@ class TUI(BaseUI):
         """
         super().__init__(engine)
         self.event_manager = event_manager
+        self.progress_line = ProgressLine(sys.stdout)
 
     def display_title(self):
         """
@@ -72,7 +75,8 @@ class TUI(BaseUI):
             print("2: List plugins")
             print("3: Settings")
             print("4: View Documentation")  
-            print("5: Exit")  
+            print("5: Change the password of a polyglot")
+            print("6: Exit")  
             print("\n")
 
             choice = input("Please choose an option: ").strip()
@@ -86,6 +90,8 @@ class TUI(BaseUI):
             elif choice == "4":
                 self.show_documentation_menu()  # Show documentation menu
             elif choice == "5":
+                self.rekey_menu()  # Change the password of an existing polyglot
+            elif choice == "6":
                 print("Goodbye!")
                 break  # Exit the application
             else:
@@ -101,6 +107,7 @@ class TUI(BaseUI):
         host = input("Host file path: ").strip()
         volume = input("Volume file path: ").strip()
         password = getpass.getpass("Password: ").strip()
+        pim = self.input_pim()
         output = input("Output file path: ").strip()
 
         while True:
@@ -111,9 +118,10 @@ class TUI(BaseUI):
             print(f"2: Volume file path: {volume}")
             print(f"3: Password: {'*****' if password else 'Not Set'}")
             print(f"4: Output file path: {output}")
+            print(f"5: PIM (VeraCrypt): {pim if pim is not None else 'Default'}")
             print("\n")
-            print("5: Start data processing")
-            print("6: Cancel and restart")
+            print("6: Start data processing")
+            print("7: Cancel and restart")
             print("\n")
 
             choice = input("Please choose an option (you can change your input or start/cancel the process): ").strip()
@@ -127,23 +135,77 @@ class TUI(BaseUI):
             elif choice == "4":
                 output = input("Enter the output file path: ").strip()
             elif choice == "5":
+                pim = self.input_pim()
+            elif choice == "6":
                 # Check if all necessary fields are filled
                 if host and volume and password and output:
-                    self.event_manager.trigger_event("process_data", {
-                        "host": host,
-                        "volume": volume,
-                        "password": password,
-                        "output": output,
-                    })
+                    # Ctrl+C stops the processing after the current chunk instead of quitting
+                    progress = Progress(callback=self.display_progress)
+                    print("Processing... (press Ctrl+C to cancel)")
+                    with cancel_on_interrupt(progress):
+                        self.event_manager.trigger_event("process_data", {
+                            "host": host,
+                            "volume": volume,
+                            "password": password,
+                            "output": output,
+                            "pim": pim,
+                            "progress": progress,
+                        })
                     break  # Exit the loop once data is processed
                 else:
                     self.display_message("All fields must be filled before starting the processing. Please complete the inputs.", "error")
-            elif choice == "6":
+            elif choice == "7":
                 self.display_message("Operation cancelled. Restarting data input process...", "info")
                 return  # Restart the entire data input process by returning to the main menu
             else:
                 self.display_message("Invalid selection. Please try again.", "info")
 
+    def rekey_menu(self):
+        """
+        Asks for an existing polyglot file and its old and new password, and triggers the 'rekey' event.
+        The polyglot is not rebuilt, only its header is re-encrypted.
+        """
+        print("\nChange the password of a polyglot file.")
+        polyglot = input("Polyglot file path: ").strip()
+        old_password = getpass.getpass("Old password: ").strip()
+        new_password = getpass.getpass("New password: ").strip()
+        repeated_password = getpass.getpass("Repeat the new password: ").strip()
+        pim = self.input_pim()
+
+        if not (polyglot and old_password and new_password):
+            self.display_message("All fields must be filled. Returning to the main menu...", "error")
+            return
+        if new_password != repeated_password:
+            self.display_message("The new passwords do not match. Returning to the main menu...", "error")
+            return
+
+        # Ctrl+C stops the detection of the header format instead of quitting
+        progress = Progress(callback=self.display_progress)
+        print("Changing the password... (press Ctrl+C to cancel)")
+        with cancel_on_interrupt(progress):
+            self.event_manager.trigger_event("rekey", {
+                "polyglot": polyglot,
+                "old_password": old_password,
+                "new_password": new_password,
+                "pim": pim,
+                "progress": progress,
+            })
+
+    def input_pim(self):
+        """
+        Asks for the PIM of a VeraCrypt volume until a valid one or nothing is entered.
+
+        Returns:
+            int: The PIM, or None to use the default iteration counts.
+        """
+        while True:
+            pim = input("PIM (VeraCrypt, leave empty for the default): ").strip()
+            if not pim:
+                return None
+            if pim.isdigit() and int(pim) > 0:
+                return int(pim)
+            self.display_message("The PIM must be a positive number.", "error")
+
     def edit_config(self):
         """
         Allows the user to modify settings in the config file (config.json).
@@ -169,7 +231,7 @@ class TUI(BaseUI):
             
             print(f"{'1: Toggle Graphical User Interface':<40} {gui_status}")
             print(f"{'2: Toggle verbose mode':<40} {verbose_status}")
-            print(f"{'3: Toggle auto-tchunt-check':<40} {check_status}")
+            print(f"{'3: Toggle auto-check':<40} {check_status}")
             print()
             print(f"'4: Return to Main Menu'")
             
@@ -208,7 +270,16 @@ class TUI(BaseUI):
         """
         self.event_manager.trigger_event("list_data", None)
 
+    def display_progress(self, progress):
+        """Shows the stage, percentage and remaining time of the running job in one line."""
+        self.progress_line.show(progress)
+
+    def clear_progress(self):
+        """Removes the progress line, e.g. before a message is printed or when the job has ended."""
+        self.progress_line.clear()
+
     def display_message(self, message, message_type):
+        self.clear_progress()
         config = self.engine.load_config()
         verbose = config.get("verbose", False)
 
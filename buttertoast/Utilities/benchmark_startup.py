@@ -0,0 +1,136 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+
+# Measures the cold-start time of the CLI, TUI and GUI paths.
+# Every measurement starts a fresh interpreter that imports what the respective path imports,
+# so the numbers include the interpreter start and all module imports, but not the UI loop.
+#
+# A path that loads a heavy module it does not need fails the benchmark (exit status 1).
+#
+# Usage: python -m buttertoast.Utilities.benchmark_startup [-n RUNS] [--output RESULT.json]
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# Heavy third-party modules that should only be loaded by the path that needs them
+HEAVY_MODULES = ["PySide6", "rich", "markdown", "numpy", "cryptography"]
+# Heavy modules each path needs, any other heavy module in sys.modules is a regression
+EXPECTED_MODULES = {
+    "python": [],
+    "cli": ["cryptography"],
+    "tui": ["rich", "cryptography"],
+    "gui": ["PySide6", "markdown", "cryptography"],
+}
+
+ENTRY = "import buttertoast.buttertoast; from buttertoast.Engine.engine import Engine; "
+
+STARTUP_PATHS = {
+    "python": "",
+    "cli": ENTRY + "from buttertoast.UI.CLI import CLI",
+    "tui": ENTRY + "from buttertoast.UI.tui import TUI",
+    "gui": ENTRY + "from buttertoast.UI.gui import GUI",
+}
+
+REPORT = "\nimport sys, json; print(json.dumps([m for m in {modules!r} if m in sys.modules]))"
+
+
+def measure(code, runs):
+    """
+    Starts `runs` fresh interpreters executing `code` and measures their wall-clock time.
+
+    Args:
+        code (str): The Python code to execute.
+        runs (int): Number of interpreters to start.
+
+    Returns:
+        tuple: List of the measured times in seconds and the heavy modules that were loaded.
+    """
+    times = []
+    loaded = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-c", code + REPORT.format(modules=HEAVY_MODULES)],
+            capture_output=True, text=True, check=True
+        )
+        times.append(time.perf_counter() - start)
+        loaded = json.loads(result.stdout.strip().splitlines()[-1])
+    return times, loaded
+
+
+def run_benchmark(runs=10):
+    """
+    Measures the cold-start time of all startup paths.
+
+    Args:
+        runs (int): Number of measurements per path.
+
+    Returns:
+        dict: Per path the median, minimum and maximum time in milliseconds, the loaded heavy modules and
+              those of them the path should not have loaded.
+    """
+    results = {}
+    for name, code in STARTUP_PATHS.items():
+        try:
+            times, loaded = measure(code, runs)
+        except subprocess.CalledProcessError as e:
+            results[name] = {"error": e.stderr.strip().splitlines()[-1] if e.stderr else str(e)}
+            continue
+        results[name] = {
+            "median_ms": round(statistics.median(times) * 1000, 1),
+            "min_ms": round(min(times) * 1000, 1),
+            "max_ms": round(max(times) * 1000, 1),
+            "heavy_modules": loaded,
+            "unexpected_modules": [module for module in loaded if module not in EXPECTED_MODULES[name]],
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold-start time of the CLI, TUI and GUI paths.")
+    parser.add_argument('-n', '--runs', type=int, default=10, help="Number of measurements per path")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.runs)
+
+    print(f"{'Path':<8} {'median':>10} {'min':>10} {'max':>10}  heavy modules")
+    for name, result in results.items():
+        if "error" in result:
+            print(f"{name:<8} error: {result['error']}")
+            continue
+        print(f"{name:<8} {result['median_ms']:>8} ms {result['min_ms']:>7} ms {result['max_ms']:>7} ms  "
+              f"{', '.join(result['heavy_modules']) or '-'}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=4)
+
+    regressions = {name: result["unexpected_modules"] for name, result in results.items()
+                   if result.get("unexpected_modules")}
+    for name, modules in regressions.items():
+        print(f"The {name} path loads {', '.join(modules)}, which it does not need.", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+
+# Measures the throughput of the data-area XTS engine, serial against the process pool.
+# A temporary file with random data is encrypted, checksummed, re-keyed and decrypted; the serial and the
+# parallel run must produce the same bytes, and the decrypted file must match the original data.
+#
+# Usage: python -m buttertoast.Utilities.benchmark_xts [--size MiB] [-j WORKERS] [--output RESULT.json]
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from buttertoast.Crypt.xts_engine import process_data_area
+
+DATA_OFFSET = 128 * 1024  # Data area behind the header area of a normal volume
+
+
+def measure(path, operation, keys, data_length, workers):
+    """
+    Runs one operation on the data area of `path` and measures its wall-clock time.
+
+    Returns:
+        tuple: The time in seconds and the result of process_data_area.
+    """
+    start = time.perf_counter()
+    result = process_data_area(path, operation, keys, DATA_OFFSET, data_length, workers=workers)
+    return time.perf_counter() - start, result
+
+
+def run_benchmark(size_mib=64, workers=None):
+    """
+    Measures all operations serially and on the process pool.
+
+    Args:
+        size_mib (int): Size of the data area in MiB.
+        workers (int): Number of worker processes of the parallel run (default: number of CPUs).
+
+    Returns:
+        dict: Per operation and mode the throughput in MB/s, and whether both modes produced the same bytes.
+    """
+    workers = workers or os.cpu_count() or 1
+    data_length = size_mib * 1024 * 1024
+    old_key, new_key = os.urandom(64), os.urandom(64)
+    steps = [("encrypt", (old_key,)), ("checksum", (old_key,)), ("rekey", (old_key, new_key)), ("decrypt", (new_key,))]
+
+    results = {"size_mib": size_mib, "workers": workers, "operations": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        serial_path = os.path.join(directory, "serial.bin")
+        parallel_path = os.path.join(directory, "parallel.bin")
+        with open(serial_path, 'wb') as file:
+            file.write(os.urandom(DATA_OFFSET + data_length))
+        shutil.copyfile(serial_path, parallel_path)
+        with open(serial_path, 'rb') as file:
+            original = file.read()
+
+        identical = True
+        for operation, keys in steps:
+            serial_time, serial_result = measure(serial_path, operation, keys, data_length, 1)
+            parallel_time, parallel_result = measure(parallel_path, operation, keys, data_length, workers)
+            identical = identical and serial_result == parallel_result
+            results["operations"][operation] = {
+                "serial_mb_s": round(data_length / serial_time / 1e6, 1),
+                "parallel_mb_s": round(data_length / parallel_time / 1e6, 1),
+                "speedup": round(serial_time / parallel_time, 2),
+            }
+
+        with open(serial_path, 'rb') as serial, open(parallel_path, 'rb') as parallel:
+            serial_data = serial.read()
+            results["identical"] = identical and serial_data == parallel.read()
+        results["round_trip"] = serial_data == original
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the throughput of the data-area XTS engine, serial against parallel.")
+    parser.add_argument('--size', type=int, default=64, help="Size of the data area in MiB")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.size, args.jobs)
+
+    print(f"{results['size_mib']} MiB data area, {results['workers']} worker(s)")
+    print(f"{'Operation':<10} {'serial':>12} {'parallel':>12} {'speedup':>8}")
+    for name, result in results["operations"].items():
+        print(f"{name:<10} {result['serial_mb_s']:>7} MB/s {result['parallel_mb_s']:>7} MB/s {result['speedup']:>7}x")
+    print(f"Serial and parallel identical: {'yes' if results['identical'] else 'no'}, "
+          f"round trip: {'ok' if results['round_trip'] else 'failed'}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
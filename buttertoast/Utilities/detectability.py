@@ -0,0 +1,193 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+
+# Built-in detectability check of a polyglot, computing the signals tools like TCHunt/tchuntng use to
+# find TrueCrypt volumes: the file size modulo 512, the minimum size, a chi-square test of the byte
+# distribution and the absence of a known file header. The byte entropy is reported as well.
+# The verifier is fed with the blocks of the file while it is written, so the output is never read again.
+
+import numpy as np
+
+SECTOR_SIZE = 512  # TrueCrypt volumes consist of whole 512 byte sectors
+MIN_VOLUME_SIZE = 19 * 1024  # TCHunt ignores files smaller than 19 KiB
+REGION_SIZE = 1024 * 1024  # Size of the regions reported separately (1 MiB)
+HEAD_SIZE = 64  # Bytes kept to look for a known file header
+
+# Critical value of the chi-square distribution with 255 degrees of freedom for p = 0.001.
+# Uniformly distributed (encrypted) data stays below, any file format with structure is far above.
+CHI_SQUARE_LIMIT = 330.5
+
+
+def chi_square(histogram):
+    """
+    Chi-square statistic of a byte histogram against the uniform distribution.
+
+    Args:
+        histogram (np.ndarray): Count of each of the 256 byte values.
+
+    Returns:
+        float: The chi-square statistic (255 degrees of freedom), 0.0 for empty data.
+    """
+    total = int(histogram.sum())
+    if not total:
+        return 0.0
+    expected = total / 256
+    return float(((histogram - expected) ** 2).sum() / expected)
+
+
+def entropy(histogram):
+    """
+    Shannon entropy of a byte histogram.
+
+    Args:
+        histogram (np.ndarray): Count of each of the 256 byte values.
+
+    Returns:
+        float: The entropy in bits per byte (0.0 to 8.0).
+    """
+    total = int(histogram.sum())
+    if not total:
+        return 0.0
+    probabilities = histogram[histogram > 0] / total
+    return float(-(probabilities * np.log2(probabilities)).sum())
+
+
+class DetectabilityVerifier:
+    """
+    Computes the detectability signals of a file from its blocks, in file order.
+    Every block is counted with one vectorized np.bincount, per region and for the whole file.
+    """
+
+    def __init__(self, magic_trie=None, region_size=REGION_SIZE):
+        """
+        Args:
+            magic_trie (MagicTrie): Optional magic numbers of known file formats (see buttertoast.Engine.magic).
+            region_size (int): Size of the regions reported separately.
+        """
+        self.magic_trie = magic_trie
+        self.region_size = region_size
+        self.size = 0
+        self.head = b""
+        self.histogram = np.zeros(256, dtype=np.int64)
+        self.region_histogram = np.zeros(256, dtype=np.int64)
+        self.regions = []
+
+    def update(self, data):
+        """
+        Adds the next block of the file.
+
+        Args:
+            data (bytes): The block, following the previously added ones.
+        """
+        view = memoryview(data).cast("B")
+        if len(self.head) < HEAD_SIZE:
+            self.head += bytes(view[:HEAD_SIZE - len(self.head)])
+
+        while view:
+            # Split the block at region boundaries
+            region_offset = self.size % self.region_size
+            part = view[:self.region_size - region_offset]
+            counts = np.bincount(np.frombuffer(part, dtype=np.uint8), minlength=256)
+            self.histogram += counts
+            self.region_histogram += counts
+            self.size += len(part)
+            view = view[len(part):]
+            if self.size % self.region_size == 0:
+                self.close_region()
+
+    def close_region(self):
+        """
+        Stores the result of the current region and starts the next one.
+        """
+        length = int(self.region_histogram.sum())
+        if not length:
+            return
+        region_chi_square = chi_square(self.region_histogram)
+        self.regions.append({
+            "offset": self.size - length,
+            "length": length,
+            "chi_square": round(region_chi_square, 2),
+            "entropy": round(entropy(self.region_histogram), 6),
+            "random": region_chi_square < CHI_SQUARE_LIMIT,
+        })
+        self.region_histogram[:] = 0
+
+    def result(self):
+        """
+        Returns the result of the whole file and of every region.
+
+        Returns:
+            dict: size, size_mod_512, chi_square, entropy, known_header, likely_encrypted (all criteria of
+                  TCHunt are met) and regions (offset, length, chi_square, entropy, random per region).
+        """
+        self.close_region()
+        file_chi_square = chi_square(self.histogram)
+        known_header = bool(self.magic_trie and self.magic_trie.match(self.head))
+        size_mod_512 = self.size % SECTOR_SIZE
+        return {
+            "size": self.size,
+            "size_mod_512": size_mod_512,
+            "chi_square": round(file_chi_square, 2),
+            "entropy": round(entropy(self.histogram), 6),
+            "known_header": known_header,
+            "likely_encrypted": (
+                size_mod_512 == 0
+                and self.size >= MIN_VOLUME_SIZE
+                and file_chi_square < CHI_SQUARE_LIMIT
+                and not known_header
+            ),
+            "regions": self.regions,
+        }
+
+
+def verify_file(file_path, magic_trie=None, chunk_size=REGION_SIZE, progress=None):
+    """
+    Checks a file that was written without a verifier, reading it block by block.
+
+    Args:
+        file_path (str): Path to the file.
+        magic_trie (MagicTrie): Optional magic numbers of known file formats.
+        chunk_size (int): Size of the blocks read.
+        progress (Progress): Optional progress of the job, advanced after every block.
+
+    Returns:
+        dict: The result, see DetectabilityVerifier.result.
+    """
+    verifier = DetectabilityVerifier(magic_trie)
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(chunk_size):
+            verifier.update(chunk)
+            if progress:
+                progress.advance(len(chunk))
+    return verifier.result()
+
+
+def describe(result):
+    """
+    Summarizes a result in one line.
+
+    Args:
+        result (dict): The result of a verifier.
+
+    Returns:
+        str: The signals of the whole file.
+    """
+    random_regions = sum(region["random"] for region in result["regions"])
+    return (f"size mod 512 = {result['size_mod_512']}, chi-square = {result['chi_square']}, "
+            f"entropy = {result['entropy']} bits/byte, known header: {'yes' if result['known_header'] else 'no'}, "
+            f"random regions: {random_regions}/{len(result['regions'])}")
@@ -25,6 +25,10 @@ def load_config(config_file=CONFIG_PATH):
         "gui": False,
         "verbose": False,
         "check": False,
+        "streaming": True,
+        "verify": True,
+        "in_place": False,
+        "key_cache": False,
     }
 
     try:
@@ -90,6 +94,78 @@ def parse_arguments():
         help="Enable verbose output"
     )
 
+    # Fan-out: ein Volume in viele Host-Dateien einbetten
+    parser.add_argument(
+        '--fanout',
+        action='append',
+        metavar='HOST',
+        help="Embed the volume into this host file, repeat the option for every host (CLI mode). "
+             "The positional arguments are then: volume password output_directory"
+    )
+
+    # Batch-Modus: Jobs aus einem Manifest abarbeiten
+    parser.add_argument(
+        '--batch',
+        metavar='MANIFEST',
+        help="Run all jobs of a JSONL or CSV manifest with the fields host, volume, password and output (CLI mode)"
+    )
+    parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help="Run the batch in one process through the stages read, plan, encrypt and write, "
+             "which overlap for consecutive jobs (-j sets the number of key derivation threads)"
+    )
+    parser.add_argument(
+        '--results',
+        metavar='PATH',
+        help="Result file of the batch mode (default: <MANIFEST>.results.jsonl)"
+    )
+
+    # In-place-Modus: das Volume selbst wird zur Polyglot-Datei
+    parser.add_argument(
+        '--in-place',
+        action='store_true',
+        help="Build the polyglot from the volume file itself instead of copying it (CLI mode). "
+             "The original header is saved to <OUTPUT>.header.bak"
+    )
+    parser.add_argument(
+        '--undo-in-place',
+        metavar='BACKUP',
+        help="Restore a volume that was patched in place from its header backup (CLI mode)"
+    )
+
+    # Passwort einer fertigen Polyglot-Datei ändern
+    parser.add_argument(
+        '--rekey',
+        metavar='POLYGLOT',
+        help="Change the password of an existing polyglot file without rebuilding it (CLI mode). "
+             "The positional arguments are then: old_password new_password"
+    )
+
+    # Host einer fertigen Polyglot-Datei austauschen
+    parser.add_argument(
+        '--swap-host',
+        metavar='POLYGLOT',
+        help="Replace the host of an existing polyglot file without copying the volume again (CLI mode). "
+             "The positional arguments are then: new_host password"
+    )
+
+    # PIM eines VeraCrypt-Volumes
+    parser.add_argument(
+        '--pim',
+        type=int,
+        default=None,
+        help="PIM (personal iterations multiplier) of a VeraCrypt volume (CLI mode)"
+    )
+
+    # Anzahl der Worker-Prozesse
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=None,
+        help="Number of worker processes for fan-out and batch mode (default: number of CPUs)"
+    )
+
     # Falls -cli angegeben ist, müssen diese Argumente übergeben werden
     parser.add_argument(
         'host', 
@@ -132,7 +208,67 @@ def main():
     args = parse_arguments()
     verbose = args.verbose
 
-    if args.cli:
+    if args.cli and args.undo_in_place:
+        event_manager = EventManager()
+        engine = Engine(event_manager)
+        engine.undo_in_place_cli(args.undo_in_place, verbose)
+    elif args.cli and args.rekey:
+        # Beim Ändern des Passworts sind die Positionsargumente: old_password, new_password
+        positionals = [arg for arg in (args.host, args.volume, args.password, args.output) if arg]
+        if len(positionals) != 2:
+            print("Error: Rekey mode expects the old and the new password as positional arguments.")
+            return
+
+        data = {
+            "polyglot": args.rekey,
+            "old_password": positionals[0],
+            "new_password": positionals[1],
+            "pim": args.pim
+        }
+
+        event_manager = EventManager()
+        engine = Engine(event_manager)
+        engine.rekey_cli(data, verbose)
+    elif args.cli and args.swap_host:
+        # Beim Austauschen des Hosts sind die Positionsargumente: new_host, password
+        positionals = [arg for arg in (args.host, args.volume, args.password, args.output) if arg]
+        if len(positionals) != 2:
+            print("Error: Host swap mode expects the new host and the password as positional arguments.")
+            return
+
+        data = {
+            "polyglot": args.swap_host,
+            "host": positionals[0],
+            "password": positionals[1],
+            "pim": args.pim
+        }
+
+        event_manager = EventManager()
+        engine = Engine(event_manager)
+        engine.swap_host_cli(data, verbose)
+    elif args.cli and args.batch:
+        event_manager = EventManager()
+        engine = Engine(event_manager)
+        engine.process_batch_cli(args.batch, args.results, verbose, args.jobs, args.pipeline)
+    elif args.cli and args.fanout:
+        # Im Fan-out-Modus verschieben sich die Positionsargumente: volume, password, output_directory
+        positionals = [arg for arg in (args.host, args.volume, args.password, args.output) if arg]
+        if len(positionals) != 3:
+            print("Error: Fan-out mode expects volume, password and output directory as positional arguments.")
+            return
+
+        data = {
+            "hosts": args.fanout,
+            "volume": positionals[0],
+            "password": positionals[1],
+            "output": positionals[2],
+            "pim": args.pim
+        }
+
+        event_manager = EventManager()
+        engine = Engine(event_manager)
+        engine.process_data_fanout_cli(data, verbose, args.jobs)
+    elif args.cli:
         # Wenn im CLI-Modus, müssen die erforderlichen Argumente vorhanden sein
         if not all([args.host, args.volume, args.password, args.output]):
             print("Error: Missing required arguments for CLI mode. Please provide host, volume, password, and output.")
@@ -143,7 +279,9 @@ def main():
             "host": args.host,
             "volume": args.volume,
             "password": args.password,
-            "output": args.output
+            "output": args.output,
+            "in_place": args.in_place,
+            "pim": args.pim
         }
 
         # Instanziiere den EventManager und Engine und rufe on_process_data auf
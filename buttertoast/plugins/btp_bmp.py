@@ -16,20 +16,87 @@
 # For more information, contact: mail@matthias-ferstl.de
 
 
+import io
 from buttertoast.Engine.plugin_Interface import plugin_Interface
+from buttertoast.Engine.layout import Literal, VolumeRange, HostRange, file_size, read_at, materialize
 import struct
 
 class Filetype(plugin_Interface):
+    magic = (b"BM",)
+    in_place = True  # The volume stays at its offsets, the host is appended
+
     def run(self, truecrypt, bmp_host):
-        polyglot = bytearray(truecrypt) + bytearray(bmp_host)
-        bmp_header = bmp_host[:54]
+        # Build the polyglot from the layout, the data is copied only once
+        return materialize(self.plan(io.BytesIO(truecrypt), io.BytesIO(bmp_host)), truecrypt, bmp_host)
+
+    def plan(self, truecrypt, bmp_host):
+        """
+        Describes the polyglot as a layout, without reading the volume.
+
+        Parameters:
+            - `truecrypt` (BinaryIO): The opened TrueCrypt volume.
+            - `bmp_host` (BinaryIO): The opened BMP host file.
+
+        Returns:
+            - `layout` (list): The segments of the polyglot file.
+        """
+        volume_size = file_size(truecrypt)
+        host_size = file_size(bmp_host)
+        bmp_header = read_at(bmp_host, 0, 54)
         bfOffBits_position = 10
-        new_bfOffBits = len(truecrypt)
         modified_bmp_header = (
                 bmp_header[:bfOffBits_position] +
-                struct.pack('<I', new_bfOffBits) +
+                struct.pack('<I', volume_size) +
                 bmp_header[bfOffBits_position + 4:]
         )
         salt = modified_bmp_header + b'\x00' * (64 - len(modified_bmp_header))
-        polyglot = bytes(bytearray(salt) + bytearray(polyglot[64:]))
-        return polyglot
\ No newline at end of file
+        return [
+            Literal(salt),
+            VolumeRange(64, volume_size - 64),
+            HostRange(0, host_size),
+        ]
+
+    def salt_for(self, host_prefix, volume_size):
+        """
+        Predicts the salt of the polyglot: the BMP header with the volume size as pixel data offset, padded to 64 bytes.
+
+        Parameters:
+            - `host_prefix` (bytes): The first 64 bytes of the BMP host.
+            - `volume_size` (int): The size of the volume.
+
+        Returns:
+            - `salt` (bytes): The 64 byte salt.
+        """
+        return host_prefix[:10] + struct.pack('<I', volume_size) + host_prefix[14:54] + b'\x00' * 10
+
+    def validate(self, bmp_host):
+        """
+        Checks the BMP header (file header and BITMAPINFOHEADER, 54 bytes) of the host.
+
+        Parameters:
+            - `bmp_host` (BinaryIO): The opened BMP host file.
+
+        Raises:
+            - `ValueError`: If the host is not a BMP file with a complete 54-byte header.
+        """
+        bmp_header = read_at(bmp_host, 0, 54)
+        if len(bmp_header) < 54 or bmp_header[:2] != b'BM':
+            raise ValueError("The host is not a BMP file with a complete 54-byte header.")
+        if struct.unpack('<I', bmp_header[14:18])[0] < 40:
+            raise ValueError("The BMP host has no BITMAPINFOHEADER.")
+
+    def verify(self, polyglot):
+        """
+        Checks the BMP header of the polyglot: the pixel data offset must lie inside the file.
+
+        Parameters:
+            - `polyglot` (BinaryIO): The opened polyglot file.
+
+        Raises:
+            - `ValueError`: If the polyglot is no valid BMP file.
+        """
+        bmp_header = read_at(polyglot, 0, 54)
+        if len(bmp_header) < 54 or bmp_header[:2] != b'BM':
+            raise ValueError("The polyglot has no BMP header.")
+        if struct.unpack('<I', bmp_header[10:14])[0] >= file_size(polyglot):
+            raise ValueError("The pixel data offset of the BMP polyglot lies outside the file.")
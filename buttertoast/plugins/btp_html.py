@@ -16,7 +16,9 @@
 # For more information, contact: mail@matthias-ferstl.de
 
 
+import io
 from buttertoast.Engine.plugin_Interface import plugin_Interface
+from buttertoast.Engine.layout import Literal, VolumeRange, HostRange, file_size, find_in_file, read_at, materialize
 
 class Filetype(plugin_Interface):
     """
@@ -43,10 +45,79 @@ class Filetype(plugin_Interface):
             f.write(polyglot)
         ```
     """
-    def run(self, truecrypt, html_host):        
-        offset = html_host.find(b'>')
-        comment_start = (b'<!--')
-        comment_end = (b'//-->')    
-        polyglott = html_host[:offset+1] + comment_start + truecrypt[offset+5:] + comment_end + html_host[1+offset:]
 
-        return polyglott
\ No newline at end of file
+    magic = (b"<!DOCTYPE html", b"<!DOCTYPE HTML", b"<!doctype html", b"<html", b"<HTML")
+    in_place = True  # The volume stays at its offsets, the rest of the host is appended
+
+    def run(self, truecrypt, html_host):
+        # Build the polyglot from the layout, the data is copied only once
+        return materialize(self.plan(io.BytesIO(truecrypt), io.BytesIO(html_host)), truecrypt, html_host)
+
+    def plan(self, truecrypt, html_host):
+        """
+        Describes the polyglot as a layout, without reading the volume.
+
+        Parameters:
+            - `truecrypt` (BinaryIO): The opened TrueCrypt volume.
+            - `html_host` (BinaryIO): The opened HTML host file.
+
+        Returns:
+            - `layout` (list): The segments of the polyglot file.
+        """
+        volume_size = file_size(truecrypt)
+        host_size = file_size(html_host)
+        offset = find_in_file(html_host, b'>')
+        return [
+            HostRange(0, offset + 1),
+            Literal(b'<!--'),
+            VolumeRange(offset + 5, volume_size - (offset + 5)),
+            Literal(b'//-->'),
+            HostRange(offset + 1, host_size - (offset + 1)),
+        ]
+
+    def salt_for(self, host_prefix, volume_size):
+        """
+        Predicts the salt of the polyglot: the host up to its first '>' and the start of the comment.
+
+        Parameters:
+            - `host_prefix` (bytes): The first 64 bytes of the HTML host.
+            - `volume_size` (int): The size of the volume.
+
+        Returns:
+            - `salt` (bytes): The start of the salt, the rest is taken from the volume. None if the host
+              is shorter than 64 bytes and has no '>'.
+        """
+        offset = host_prefix.find(b'>')
+        if offset == -1:
+            return host_prefix[:64] if len(host_prefix) >= 64 else None
+        return (host_prefix[:offset + 1] + b'<!--')[:64]
+
+    def validate(self, html_host):
+        """
+        Checks that the host contains a '>', after which the volume is embedded as a comment.
+        The search stops at the first '>', which is usually in the first bytes of the host.
+
+        Parameters:
+            - `html_host` (BinaryIO): The opened HTML host file.
+
+        Raises:
+            - `ValueError`: If the host contains no '>'.
+        """
+        if find_in_file(html_host, b'>') == -1:
+            raise ValueError("The HTML host contains no tag ('>') to embed the volume after.")
+
+    def verify(self, polyglot):
+        """
+        Checks that the comment hiding the volume starts right after the first '>' of the polyglot.
+        It is only intact if the first '>' of the host is in the salt (first 64 bytes), which is not re-encrypted.
+
+        Parameters:
+            - `polyglot` (BinaryIO): The opened polyglot file.
+
+        Raises:
+            - `ValueError`: If the volume is not hidden in an HTML comment.
+        """
+        salt = read_at(polyglot, 0, 64)
+        offset = salt.find(b'>')
+        if offset == -1 or salt[offset + 1:offset + 5] != b'<!--':
+            raise ValueError("The HTML polyglot has no comment after the first tag.")
@@ -16,7 +16,9 @@
 # For more information, contact: mail@matthias-ferstl.de
 
 
+import io
 from buttertoast.Engine.plugin_Interface import plugin_Interface
+from buttertoast.Engine.layout import Literal, VolumeRange, HostRange, file_size, read_at, materialize
 import struct
 
 class Filetype(plugin_Interface):
@@ -45,31 +47,87 @@ class Filetype(plugin_Interface):
         ```
     """
 
+    magic = (b"\x00\x00\x01\x00",)
+    in_place = True  # The volume stays at its offsets, the rest of the host is appended
+
     def run(self, truecrypt, ico_host):
-        # Extract ICO header and Icon Directory Entry
-        ico_header = ico_host[:6]  # The first 6 bytes of the ICO file
-        icon_directory_entry = ico_host[6:22]  # Next 16 bytes for the Icon Directory Entry
-
-        # Calculate new image offset
-        new_image_offset = len(truecrypt) + 8  # Length of TrueCrypt data + padding
-        modified_icon_directory_entry = (
-            icon_directory_entry[:12] +
-            struct.pack('<I', new_image_offset)  # New offset
-        )
-
-        # Define padding
-        padding = b'\x00' * 8
-
-        # Extract original image data from the ICO file
-        image_offset = struct.unpack('<I', icon_directory_entry[12:16])[0]
-        ico_image_data = ico_host[image_offset:]
-
-        # Assemble the polyglot file
-        polyglot = (
-            ico_header +
-            modified_icon_directory_entry +
-            truecrypt[22:] +
-            padding +
-            ico_image_data
-        )
-        return polyglot
+        # Build the polyglot from the layout, the data is copied only once
+        return materialize(self.plan(io.BytesIO(truecrypt), io.BytesIO(ico_host)), truecrypt, ico_host)
+
+    def plan(self, truecrypt, ico_host):
+        """
+        Describes the polyglot as a layout, without reading the volume.
+
+        Parameters:
+            - `truecrypt` (BinaryIO): The opened TrueCrypt volume.
+            - `ico_host` (BinaryIO): The opened ICO host file.
+
+        Returns:
+            - `layout` (list): The segments of the polyglot file.
+        """
+        volume_size = file_size(truecrypt)
+        host_size = file_size(ico_host)
+
+        # ICO header (6 bytes) and Icon Directory Entry (16 bytes)
+        ico_head = read_at(ico_host, 0, 22)
+        image_offset = struct.unpack('<I', ico_head[18:22])[0]
+        modified_head = ico_head[:18] + struct.pack('<I', volume_size + 8)
+
+        return [
+            Literal(modified_head),
+            VolumeRange(22, volume_size - 22),
+            Literal(b'\x00' * 8),
+            HostRange(image_offset, max(0, host_size - image_offset)),
+        ]
+
+    def salt_for(self, host_prefix, volume_size):
+        """
+        Predicts the salt of the polyglot: the ICO header and the first directory entry pointing behind the volume.
+
+        Parameters:
+            - `host_prefix` (bytes): The first 64 bytes of the ICO host.
+            - `volume_size` (int): The size of the volume.
+
+        Returns:
+            - `salt` (bytes): The first 22 bytes of the salt, the rest is taken from the volume.
+        """
+        return host_prefix[:18] + struct.pack('<I', volume_size + 8)
+
+    def validate(self, ico_host):
+        """
+        Checks the ICO header and the first Icon Directory Entry of the host.
+
+        Parameters:
+            - `ico_host` (BinaryIO): The opened ICO host file.
+
+        Raises:
+            - `ValueError`: If the host is not an ICO file or its first image lies outside the file.
+        """
+        ico_head = read_at(ico_host, 0, 22)
+        if len(ico_head) < 22:
+            raise ValueError("The ICO host is smaller than its header and first directory entry (22 bytes).")
+        reserved, image_type, image_count = struct.unpack('<HHH', ico_head[:6])
+        if reserved != 0 or image_type != 1 or image_count == 0:
+            raise ValueError("The host is not an ICO file with at least one image.")
+        image_offset = struct.unpack('<I', ico_head[18:22])[0]
+        if image_offset < 22 or image_offset > file_size(ico_host):
+            raise ValueError("The first image of the ICO host lies outside the file.")
+
+    def verify(self, polyglot):
+        """
+        Checks the ICO header of the polyglot and that the first image starts with a PNG signature
+        or a BITMAPINFOHEADER.
+
+        Parameters:
+            - `polyglot` (BinaryIO): The opened polyglot file.
+
+        Raises:
+            - `ValueError`: If the polyglot is no valid ICO file.
+        """
+        ico_head = read_at(polyglot, 0, 22)
+        if len(ico_head) < 22 or ico_head[:4] != b'\x00\x00\x01\x00':
+            raise ValueError("The polyglot has no ICO header.")
+        image_offset = struct.unpack('<I', ico_head[18:22])[0]
+        image_head = read_at(polyglot, image_offset, 8)
+        if image_head != b'\x89PNG\r\n\x1a\n' and image_head[:4] != struct.pack('<I', 40):
+            raise ValueError("The first image of the ICO polyglot does not start at its directory entry's offset.")
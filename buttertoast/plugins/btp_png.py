@@ -16,7 +16,10 @@
 # For more information, contact: mail@matthias-ferstl.de
 
 
+import io
+import os
 from buttertoast.Engine.plugin_Interface import plugin_Interface
+from buttertoast.Engine.layout import Literal, VolumeRange, HostRange, file_size, crc32_of_range, read_at, materialize
 import struct
 import zlib
 
@@ -46,21 +49,117 @@ class Filetype(plugin_Interface):
         ```
     """
 
+    magic = (b"\x89PNG\r\n\x1a\n",)
+    in_place = False  # The CRC of the custom chunk covers the whole volume, building in place would read all of it
+
+    def __init__(self):
+        self.volume_crcs = {}  # CRCs of the custom chunk, per volume file
+
     def crc_calculate(self, data):
         """Calculates the CRC checksum for a given data chunk."""
         return zlib.crc32(data) & 0xffffffff
 
+    def volume_crc(self, truecrypt, chunk_type, chunk_length):
+        """
+        Calculates the CRC of the custom chunk, which only depends on the volume.
+        The result is remembered per volume file, so embedding one volume into many hosts reads it only once.
+        """
+        try:
+            stat = os.fstat(truecrypt.fileno())
+            key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        except (OSError, io.UnsupportedOperation):
+            key = None  # In-memory volume, nothing to remember
+
+        if key in self.volume_crcs:
+            return self.volume_crcs[key]
+
+        chunk_crc = crc32_of_range(truecrypt, 41, chunk_length, self.crc_calculate(chunk_type))
+        if key is not None:
+            self.volume_crcs[key] = chunk_crc
+        return chunk_crc
+
     def run(self, truecrypt, png_host):
-        # Assemble the custom chunk
+        # Build the polyglot from the layout, the data is copied only once
+        return materialize(self.plan(io.BytesIO(truecrypt), io.BytesIO(png_host)), truecrypt, png_host)
+
+    def plan(self, truecrypt, png_host):
+        """
+        Describes the polyglot as a layout. The volume is only read in chunks to calculate the CRC.
+
+        Parameters:
+            - `truecrypt` (BinaryIO): The opened TrueCrypt volume.
+            - `png_host` (BinaryIO): The opened PNG host file.
+
+        Returns:
+            - `layout` (list): The segments of the polyglot file.
+        """
+        volume_size = file_size(truecrypt)
+        host_size = file_size(png_host)
+
+        # Assemble the custom chunk, its data is the TrueCrypt volume from byte 41 on
         chunk_type = b'buTt'  # Custom chunk type
-        chunk_data = truecrypt[41:]  # Extract the data to be embedded from the TrueCrypt volume
-        chunk_length = len(chunk_data)
-        chunk_crc = self.crc_calculate(chunk_type + chunk_data)  # Call the CRC calculation method
+        chunk_length = volume_size - 41
+        chunk_crc = self.volume_crc(truecrypt, chunk_type, chunk_length)
+
+        # Insert the custom chunk [length][type][data][CRC] after the IHDR chunk (at byte offset 33)
+        return [
+            HostRange(0, 33),
+            Literal(struct.pack('!I4s', chunk_length, chunk_type)),
+            VolumeRange(41, chunk_length),
+            Literal(struct.pack('!I', chunk_crc)),
+            HostRange(33, host_size - 33),
+        ]
+
+    def salt_for(self, host_prefix, volume_size):
+        """
+        Predicts the salt of the polyglot: the PNG signature, the IHDR chunk and the header of the custom chunk.
+
+        Parameters:
+            - `host_prefix` (bytes): The first 64 bytes of the PNG host.
+            - `volume_size` (int): The size of the volume.
+
+        Returns:
+            - `salt` (bytes): The first 41 bytes of the salt, the rest is taken from the volume.
+        """
+        return host_prefix[:33] + struct.pack('!I4s', volume_size - 41, b'buTt')
+
+    def validate(self, png_host):
+        """
+        Checks that the host starts with the PNG signature followed by the IHDR chunk (bytes 8 to 33),
+        the custom chunk is inserted right after it.
+
+        Parameters:
+            - `png_host` (BinaryIO): The opened PNG host file.
+
+        Raises:
+            - `ValueError`: If the host has no PNG signature or no IHDR chunk at byte 8.
+        """
+        png_head = read_at(png_host, 0, 33)
+        if len(png_head) < 33 or png_head[:8] != b'\x89PNG\r\n\x1a\n':
+            raise ValueError("The host is not a PNG file.")
+        if png_head[8:16] != struct.pack('!I4s', 13, b'IHDR'):
+            raise ValueError("The PNG host has no IHDR chunk at byte 8.")
 
-        # Format the chunk: [length][type][data][CRC]
-        custom_chunk = struct.pack(f'!I4s{chunk_length}sI', chunk_length, chunk_type, chunk_data, chunk_crc)
+    def verify(self, polyglot):
+        """
+        Walks the chunks of the polyglot, reading only the 8-byte chunk headers.
+        The chunks must follow each other up to an IEND chunk at the end of the file.
 
-        # Insert the custom chunk after the IHDR chunk (at byte offset 33)
-        polyglot = png_host[:33] + custom_chunk + png_host[33:]
+        Parameters:
+            - `polyglot` (BinaryIO): The opened polyglot file.
 
-        return polyglot
+        Raises:
+            - `ValueError`: If the chunk structure of the PNG polyglot is broken.
+        """
+        size = file_size(polyglot)
+        if read_at(polyglot, 0, 8) != b'\x89PNG\r\n\x1a\n':
+            raise ValueError("The polyglot has no PNG signature.")
+        position = 8
+        while position + 12 <= size:
+            chunk_length, chunk_type = struct.unpack('!I4s', read_at(polyglot, position, 8))
+            position += 12 + chunk_length  # length, type, data and CRC
+            if chunk_type == b'IEND':
+                if position != size:
+                    raise ValueError("The PNG polyglot has data after the IEND chunk.")
+                return
+        raise ValueError("The chunks of the PNG polyglot do not end with an IEND chunk.")
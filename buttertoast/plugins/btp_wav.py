@@ -16,7 +16,9 @@
 # For more information, contact: mail@matthias-ferstl.de
 
 
+import io
 from buttertoast.Engine.plugin_Interface import plugin_Interface
+from buttertoast.Engine.layout import Literal, VolumeRange, HostRange, file_size, read_at, materialize
 import struct
 
 class Filetype(plugin_Interface):
@@ -45,6 +47,9 @@ class Filetype(plugin_Interface):
         ```
     """
 
+    magic = ((b"RIFF", 4, b"WAVE"),)  # RIFF header, file size, WAVE form type
+    in_place = True  # The volume stays at its offsets, the rest of the host is appended
+
     def run(self, truecrypt, wav_host):
         """
         Embeds the TrueCrypt volume into the WAV file and adjusts the file size in the header.
@@ -59,40 +64,90 @@ class Filetype(plugin_Interface):
         Returns:
             - `polyglot` (bytes): The resulting WAV file with the embedded TrueCrypt volume.
         """
-        # Extract parts of the WAV file
-        riff_header = wav_host[:4]  # "RIFF" header (first 4 bytes)
-        file_size_bytes = wav_host[4:8]  # Current file size (bytes 4-8)
-        rest_of_header = wav_host[8:36]  # Remaining header data
-        rest_of_data = wav_host[36:]  # Audio data and other chunks
-
-        # Extract data from the TrueCrypt volume
-        chunk_data = truecrypt[44:]  # Skip the first 44 bytes of the TrueCrypt volume
-        chunk_id = 'info'  # Custom chunk ID
-        chunk_id = chunk_id.ljust(4)[:4]  # Ensure the chunk ID is exactly 4 bytes (padded if necessary)
-        chunk_size = len(chunk_data)  # Size of the custom chunk
-
-        # Create a custom chunk using the TrueCrypt data
-        custom_chunk = struct.pack(
-            f'4sI{chunk_size}s',  # Format: 4 bytes for chunk ID, 4 bytes for chunk size, variable length for chunk data
-            chunk_id.encode('ascii'),  # Encode chunk ID as ASCII
-            chunk_size,  # Size of the chunk
-            chunk_data  # Chunk data (from the TrueCrypt volume)
-        )
-
-        # Read the current file size from the WAV header
-        current_file_size = struct.unpack('<I', file_size_bytes)[0]  # '<I' indicates Little-Endian 32-bit Integer
-        new_file_size = current_file_size + len(custom_chunk)  # Update the file size by adding the custom chunk size
-
-        # Pack the new file size back into the WAV header
-        new_file_size_bytes = struct.pack('<I', new_file_size)
-
-        # Combine all parts of the WAV file into the polyglot
-        polyglot = (
-            riff_header +  # RIFF header
-            new_file_size_bytes +  # Updated file size
-            rest_of_header +  # Remaining WAV header
-            custom_chunk +  # Custom chunk containing the TrueCrypt volume
-            rest_of_data  # Remaining WAV data
-        )
-
-        return polyglot
+        # Build the polyglot from the layout, the data is copied only once
+        return materialize(self.plan(io.BytesIO(truecrypt), io.BytesIO(wav_host)), truecrypt, wav_host)
+
+    def plan(self, truecrypt, wav_host):
+        """
+        Describes the polyglot as a layout, without reading the volume.
+
+        Parameters:
+            - `truecrypt` (BinaryIO): The opened TrueCrypt volume.
+            - `wav_host` (BinaryIO): The opened WAV host file.
+
+        Returns:
+            - `layout` (list): The segments of the polyglot file.
+        """
+        volume_size = file_size(truecrypt)
+        host_size = file_size(wav_host)
+        wav_header = read_at(wav_host, 0, 36)
+
+        # Header of the custom chunk, the chunk data is streamed from the volume
+        chunk_size = volume_size - 44
+        chunk_header = struct.pack('4sI', 'info'.encode('ascii'), chunk_size)
+
+        # Update the file size in the RIFF header by the size of the custom chunk
+        current_file_size = struct.unpack('<I', wav_header[4:8])[0]
+        new_file_size_bytes = struct.pack('<I', current_file_size + len(chunk_header) + chunk_size)
+
+        return [
+            Literal(wav_header[:4] + new_file_size_bytes + wav_header[8:36] + chunk_header),
+            VolumeRange(44, chunk_size),
+            HostRange(36, host_size - 36),
+        ]
+
+    def salt_for(self, host_prefix, volume_size):
+        """
+        Predicts the salt of the polyglot: the WAV header with the new file size and the header of the custom chunk.
+
+        Parameters:
+            - `host_prefix` (bytes): The first 64 bytes of the WAV host.
+            - `volume_size` (int): The size of the volume.
+
+        Returns:
+            - `salt` (bytes): The first 44 bytes of the salt, the rest is taken from the volume.
+        """
+        chunk_size = volume_size - 44
+        chunk_header = struct.pack('4sI', 'info'.encode('ascii'), chunk_size)
+        current_file_size = struct.unpack('<I', host_prefix[4:8])[0]
+        new_file_size_bytes = struct.pack('<I', current_file_size + len(chunk_header) + chunk_size)
+        return host_prefix[:4] + new_file_size_bytes + host_prefix[8:36] + chunk_header
+
+    def validate(self, wav_host):
+        """
+        Checks that the host has a 36-byte RIFF/WAVE header (with a 16-byte fmt chunk), the custom chunk is inserted after it.
+
+        Parameters:
+            - `wav_host` (BinaryIO): The opened WAV host file.
+
+        Raises:
+            - `ValueError`: If the host is not a WAV file or its header is not 36 bytes long.
+        """
+        wav_header = read_at(wav_host, 0, 36)
+        if len(wav_header) < 36 or wav_header[:4] != b'RIFF' or wav_header[8:12] != b'WAVE':
+            raise ValueError("The host is not a WAV (RIFF/WAVE) file.")
+        if wav_header[12:16] != b'fmt ' or struct.unpack('<I', wav_header[16:20])[0] != 16:
+            raise ValueError("The RIFF header of the WAV host is not 36 bytes long (fmt chunk of 16 bytes expected).")
+
+    def verify(self, polyglot):
+        """
+        Checks the RIFF size of the polyglot and walks its chunks, reading only the 8-byte chunk headers.
+
+        Parameters:
+            - `polyglot` (BinaryIO): The opened polyglot file.
+
+        Raises:
+            - `ValueError`: If the chunk structure of the WAV polyglot is broken.
+        """
+        size = file_size(polyglot)
+        riff_header = read_at(polyglot, 0, 12)
+        if len(riff_header) < 12 or riff_header[:4] != b'RIFF' or riff_header[8:12] != b'WAVE':
+            raise ValueError("The polyglot has no RIFF/WAVE header.")
+        if struct.unpack('<I', riff_header[4:8])[0] != size - 8:
+            raise ValueError("The RIFF size of the WAV polyglot does not match its file size.")
+        position = 12
+        while position + 8 <= size:
+            chunk_size = struct.unpack('<I', read_at(polyglot, position + 4, 4))[0]
+            position += 8 + chunk_size + (chunk_size & 1)  # Chunks are padded to an even size
+        if position != size:
+            raise ValueError("The chunks of the WAV polyglot do not end at the end of the file.")
@@ -16,21 +16,110 @@
 # For more information, contact: mail@matthias-ferstl.de
 
 
+import io
 from buttertoast.Engine.plugin_Interface import plugin_Interface
+from buttertoast.Engine.layout import Literal, VolumeRange, HostRange, file_size, read_at, materialize
 import struct
 
 class Filetype(plugin_Interface):
+    magic = (b"PK\x03\x04", b"PK\x05\x06")  # Local file header, end of central directory of an empty archive
+    in_place = True  # The volume stays at its offsets, the host is appended
+
     def run(self, truecrypt, zip_host):
-        polyglot = bytearray(truecrypt) + bytearray(zip_host)
-        polyglot = bytes(polyglot)
-        eocd_signature = b'\x50\x4b\x05\x06'
-        eocd_index = polyglot.find(eocd_signature)
+        # Build the polyglot from the layout, the data is copied only once
+        return materialize(self.plan(io.BytesIO(truecrypt), io.BytesIO(zip_host)), truecrypt, zip_host)
+
+    def plan(self, truecrypt, zip_host):
+        """
+        Describes the polyglot as a layout, without reading the volume.
+        The End of Central Directory record is searched in the trailer of the host only, like in validate.
+
+        Parameters:
+            - `truecrypt` (BinaryIO): The opened TrueCrypt volume.
+            - `zip_host` (BinaryIO): The opened ZIP host file.
+
+        Returns:
+            - `layout` (list): The segments of the polyglot file.
+
+        Raises:
+            - `ValueError`: If the host has no End of Central Directory record.
+        """
+        volume_size = file_size(truecrypt)
+        host_size = file_size(zip_host)
+        eocd_index = self.find_eocd(zip_host)
+        if eocd_index == -1:
+            raise ValueError("The ZIP host has no End of Central Directory record.")
+
         central_offset_position = eocd_index + 16
-        central_offset = struct.unpack("<I", polyglot[central_offset_position:central_offset_position + 4])[0]
-        new_central_offset = central_offset + len(truecrypt)
-        polyglot = (
-                polyglot[:central_offset_position]
-                + struct.pack("<I", new_central_offset)
-                + polyglot[central_offset_position + 4:]
-        )
-        return polyglot
\ No newline at end of file
+        central_offset = struct.unpack("<I", read_at(zip_host, central_offset_position, 4))[0]
+        new_central_offset = central_offset + volume_size
+        return [
+            VolumeRange(0, volume_size),
+            HostRange(0, central_offset_position),
+            Literal(struct.pack("<I", new_central_offset)),
+            HostRange(central_offset_position + 4, host_size - (central_offset_position + 4)),
+        ]
+
+    def salt_for(self, host_prefix, volume_size):
+        """
+        Predicts the salt of the polyglot: the volume comes first, so the salt of the volume is kept.
+
+        Parameters:
+            - `host_prefix` (bytes): The first 64 bytes of the ZIP host.
+            - `volume_size` (int): The size of the volume.
+
+        Returns:
+            - `salt` (bytes): Nothing, the whole salt is taken from the volume.
+        """
+        return b''
+
+    def find_eocd(self, zip_file):
+        """
+        Finds the last End of Central Directory record, as ZIP readers do.
+        Only the last 65557 bytes (record and maximum comment length) are read.
+
+        Parameters:
+            - `zip_file` (BinaryIO): The opened ZIP host or polyglot file.
+
+        Returns:
+            - `eocd_index` (int): The offset of the record in the file, or -1 if there is none.
+        """
+        size = file_size(zip_file)
+        trailer_size = min(size, 22 + 0xffff)
+        trailer = read_at(zip_file, size - trailer_size, trailer_size)
+        eocd_index = trailer.rfind(b'\x50\x4b\x05\x06', 0, max(0, len(trailer) - 18))
+        return eocd_index if eocd_index == -1 else size - trailer_size + eocd_index
+
+    def validate(self, zip_host):
+        """
+        Checks that the End of Central Directory record is in the trailer of the host.
+        Only the last 65557 bytes (record and maximum comment length) are read.
+
+        Parameters:
+            - `zip_host` (BinaryIO): The opened ZIP host file.
+
+        Raises:
+            - `ValueError`: If the host has no End of Central Directory record.
+        """
+        if self.find_eocd(zip_host) == -1:
+            raise ValueError("The ZIP host has no End of Central Directory record.")
+
+    def verify(self, polyglot):
+        """
+        Checks that the End of Central Directory record of the polyglot points to the central directory.
+        Only the trailer and the first central directory header are read.
+
+        Parameters:
+            - `polyglot` (BinaryIO): The opened polyglot file.
+
+        Raises:
+            - `ValueError`: If the central directory of the ZIP polyglot cannot be found.
+        """
+        eocd_index = self.find_eocd(polyglot)
+        if eocd_index == -1:
+            raise ValueError("The ZIP polyglot has no End of Central Directory record.")
+        entries, central_size, central_offset = struct.unpack('<HII', read_at(polyglot, eocd_index + 10, 10))
+        if central_offset + central_size > eocd_index:
+            raise ValueError("The central directory of the ZIP polyglot lies outside the file.")
+        if entries and read_at(polyglot, central_offset, 4) != b'\x50\x4b\x01\x02':
+            raise ValueError("The End of Central Directory record of the ZIP polyglot does not point to the central directory.")
@@ -0,0 +1,128 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+import io
+import os
+import shutil
+import struct
+import wave
+import zipfile
+
+import pytest
+
+from buttertoast.Engine.engine import Engine
+from buttertoast.Engine.eventManager import EventManager
+from buttertoast.Engine.plugin_Loader import PluginRegistry
+
+RES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "res")
+TC_VOLUME = os.path.join(RES_DIR, "TCVolume_1MB")  # TrueCrypt 7 volume with a backup header
+TC_PASSWORD = "buttertoast"
+HOST_EXTENSIONS = ("bmp", "html", "ico", "png", "wav", "zip")
+
+
+class RecordingUI:
+    """UI that keeps the messages of the engine instead of showing them."""
+
+    def __init__(self):
+        self.messages = []
+
+    def display_message(self, message, message_type):
+        self.messages.append((message_type, message))
+
+    def display_progress(self, *args):
+        pass
+
+    def errors(self):
+        return [message for message_type, message in self.messages if message_type == "error"]
+
+
+@pytest.fixture
+def ui():
+    return RecordingUI()
+
+
+@pytest.fixture
+def engine(ui):
+    """An engine with the default config, reporting to a RecordingUI. The config is not saved."""
+    event_manager = EventManager()
+    engine = Engine(event_manager)
+    engine.ui = ui
+    engine.kdf_workers = 1
+    engine.config = dict(engine.config, check=False, in_place=False)
+    yield engine
+    event_manager.close()
+
+
+@pytest.fixture
+def tc_volume(tmp_path):
+    """A copy of the TrueCrypt test volume, which the test may modify."""
+    path = tmp_path / "volume.tc"
+    shutil.copyfile(TC_VOLUME, path)
+    return str(path)
+
+
+def make_host(directory, extension):
+    """Writes a small valid host file of a built-in plugin and returns its path."""
+    path = os.path.join(directory, f"host.{extension}")
+    if extension == "png":
+        shutil.copyfile(os.path.join(RES_DIR, "png_6_0.05mb.png"), path)
+        return path
+
+    if extension == "bmp":
+        pixels = b"\x10\x20\x30" * 16
+        data = (b"BM" + struct.pack("<IHHI", 54 + len(pixels), 0, 0, 54)
+                + struct.pack("<IiiHHIIiiII", 40, 4, 4, 1, 24, 0, len(pixels), 0, 0, 0, 0) + pixels)
+    elif extension == "html":
+        data = b"<html><body><p>Hello</p></body></html>\n"
+    elif extension == "ico":
+        image = b"\x89PNG\r\n\x1a\n" + bytes(range(100))
+        data = struct.pack("<HHH", 0, 1, 1) + struct.pack("<BBBBHHII", 16, 16, 0, 0, 1, 32, len(image), 22) + image
+    elif extension == "wav":
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as file:
+            file.setnchannels(1)
+            file.setsampwidth(2)
+            file.setframerate(8000)
+            file.writeframes(bytes(4000))
+        data = buffer.getvalue()
+    elif extension == "zip":
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as file:
+            file.writestr("a.txt", "hello world" * 10)
+        data = buffer.getvalue()
+    else:
+        raise ValueError(f"No test host for '{extension}'")
+
+    with open(path, "wb") as file:
+        file.write(data)
+    return path
+
+
+@pytest.fixture
+def hosts(tmp_path):
+    """One host file per built-in plugin: extension -> path."""
+    directory = tmp_path / "hosts"
+    directory.mkdir()
+    return {extension: make_host(str(directory), extension) for extension in HOST_EXTENSIONS}
+
+
+@pytest.fixture(autouse=True)
+def plugin_index(tmp_path_factory, monkeypatch):
+    """Keeps the plugin index of the tests out of the cache directory of the user."""
+    path = tmp_path_factory.getbasetemp() / "plugin_index.json"
+    monkeypatch.setattr(PluginRegistry, "INDEX_PATH", str(path))
+    return path
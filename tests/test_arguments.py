@@ -0,0 +1,47 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+# Command line arguments of the CLI modes.
+
+import sys
+
+import pytest
+
+from buttertoast.buttertoast import parse_arguments
+
+
+def parse(monkeypatch, *arguments):
+    monkeypatch.setattr(sys, "argv", ["buttertoast", *arguments])
+    return parse_arguments()
+
+
+@pytest.mark.parametrize("arguments", [
+    ("-cli", "--fanout", "a.png", "--fanout", "b.zip", "volume", "pw", "out"),
+    ("-cli", "volume", "pw", "out", "--fanout", "a.png", "--fanout", "b.zip"),
+])
+def test_fanout_hosts_do_not_take_the_positional_arguments(monkeypatch, arguments):
+    args = parse(monkeypatch, *arguments)
+
+    assert args.fanout == ["a.png", "b.zip"]
+    assert (args.host, args.volume, args.password) == ("volume", "pw", "out")
+
+
+def test_single_job_without_fanout(monkeypatch):
+    args = parse(monkeypatch, "-cli", "host.png", "volume", "pw", "out")
+
+    assert args.fanout is None
+    assert (args.host, args.volume, args.password, args.output) == ("host.png", "volume", "pw", "out")
@@ -0,0 +1,84 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+# The batch mode on the process pool: JSONL and CSV manifests in, one result line per job out.
+
+import csv
+import json
+
+from buttertoast.Crypt.cryptomat import Cryptomat, FULL_HEADER_SIZE
+from buttertoast.Engine.batch import read_manifest, run_batch
+from conftest import TC_PASSWORD, TC_VOLUME
+
+
+def read_results(path):
+    return {result["id"]: result for result in map(json.loads, path.read_text().splitlines())}
+
+
+def assert_polyglot(result, output):
+    assert result["status"] == "ok" and result["error"] is None
+    assert result["output"] == output and result["bytes_written"] > 0
+    with open(output, "rb") as file:
+        assert Cryptomat().verify_header(file.read(FULL_HEADER_SIZE), TC_PASSWORD)
+
+
+def test_read_jsonl_manifest(tmp_path):
+    manifest = tmp_path / "jobs.jsonl"
+    manifest.write_text('# a comment\n\n{"host": "a.png", "id": "first"}\n{"host": \n[1, 2]\n{"host": "b.zip"}\n')
+
+    jobs = list(read_manifest(str(manifest)))
+
+    assert jobs[0] == {"host": "a.png", "id": "first"}
+    assert jobs[1]["id"] == 4 and jobs[1]["error"].startswith("Invalid JSON")
+    assert jobs[2] == {"id": 5, "error": "A job must be a JSON object."}
+    assert jobs[3] == {"host": "b.zip", "id": 6}
+
+
+def test_run_batch_jsonl(hosts, tmp_path):
+    manifest = tmp_path / "jobs.jsonl"
+    jobs = [{"host": hosts["png"], "volume": TC_VOLUME, "password": TC_PASSWORD, "output": str(tmp_path / "polyglot")},
+            {"host": hosts["zip"], "volume": TC_VOLUME, "password": "wrong", "output": str(tmp_path / "wrong")},
+            {"host": hosts["zip"], "volume": TC_VOLUME}]
+    manifest.write_text("\n".join(json.dumps(job) for job in jobs) + "\nnot json\n")
+
+    summary = run_batch(str(manifest), str(tmp_path / "results.jsonl"), workers=2)
+
+    assert summary == {"ok": 1, "error": 3, "cancelled": 0}
+    results = read_results(tmp_path / "results.jsonl")
+    assert_polyglot(results[1], str(tmp_path / "polyglot.png"))
+    assert results[2]["status"] == "error" and not (tmp_path / "wrong.zip").exists()
+    assert results[3]["error"] == "Missing fields: password, output"
+    assert results[4]["error"].startswith("Invalid JSON")
+
+
+def test_run_batch_csv(hosts, tmp_path):
+    manifest = tmp_path / "jobs.csv"
+    with open(manifest, "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, ["host", "volume", "password", "output", "pim"])
+        writer.writeheader()
+        for extension in ("bmp", "html"):
+            # An empty PIM column is left out of the job
+            writer.writerow({"host": hosts[extension], "volume": TC_VOLUME, "password": TC_PASSWORD,
+                             "output": str(tmp_path / f"polyglot_{extension}"), "pim": ""})
+
+    summary = run_batch(str(manifest), str(tmp_path / "results.jsonl"), workers=2)
+
+    assert summary == {"ok": 2, "error": 0, "cancelled": 0}
+    results = read_results(tmp_path / "results.jsonl")
+    # The id of a CSV job is the line it ended on, after the header line
+    assert_polyglot(results[2], str(tmp_path / "polyglot_bmp.bmp"))
+    assert_polyglot(results[3], str(tmp_path / "polyglot_html.html"))
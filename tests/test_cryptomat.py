@@ -0,0 +1,96 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+# The header-only Cryptomat against the full-buffer path it replaced, which decrypted and re-encrypted
+# the whole volume as one AES-XTS data unit and kept the first 512 bytes.
+
+import os
+
+import pytest
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+from buttertoast.Crypt.cryptomat import Cryptomat, FULL_HEADER_SIZE, SALT_SIZE
+from conftest import TC_PASSWORD, TC_VOLUME
+
+TWEAK = b"\x00" * 16
+
+
+def full_buffer_key(salt, passphrase):
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA512(), length=64, salt=salt, iterations=1000)
+    return kdf.derive(passphrase.encode())
+
+
+def full_buffer_decrypt(volume, passphrase):
+    decryptor = Cipher(algorithms.AES(full_buffer_key(volume[:SALT_SIZE], passphrase)), modes.XTS(TWEAK)).decryptor()
+    return decryptor.update(volume[SALT_SIZE:]) + decryptor.finalize()
+
+
+def full_buffer_recrypt(volume, polyglot, passphrase):
+    salt_poly = polyglot[:SALT_SIZE]
+    encryptor = Cipher(algorithms.AES(full_buffer_key(salt_poly, passphrase)), modes.XTS(TWEAK)).encryptor()
+    re_encrypted = salt_poly + encryptor.update(full_buffer_decrypt(volume, passphrase)) + encryptor.finalize()
+    return re_encrypted[:FULL_HEADER_SIZE] + polyglot[FULL_HEADER_SIZE:]
+
+
+@pytest.fixture(scope="module")
+def volume():
+    with open(TC_VOLUME, "rb") as file:
+        return file.read()
+
+
+@pytest.fixture
+def polyglot(volume):
+    return os.urandom(SALT_SIZE) + volume[SALT_SIZE:] + b"host data" * 100
+
+
+def test_decrypt_header_matches_full_buffer(volume):
+    decrypted_header = Cryptomat().decrypt_header(volume[:FULL_HEADER_SIZE], TC_PASSWORD)
+
+    assert decrypted_header[:4] == b"TRUE"
+    assert decrypted_header == full_buffer_decrypt(volume, TC_PASSWORD)[:FULL_HEADER_SIZE - SALT_SIZE]
+
+
+def test_recrypt_header_matches_full_buffer(volume, polyglot):
+    new_header = Cryptomat().recrypt_header(volume[:FULL_HEADER_SIZE], polyglot[:SALT_SIZE], TC_PASSWORD)
+
+    assert new_header == full_buffer_recrypt(volume, polyglot, TC_PASSWORD)[:FULL_HEADER_SIZE]
+
+
+def test_cryptomator_matches_full_buffer(volume, polyglot):
+    result = Cryptomat().cryptomator(volume, polyglot, TC_PASSWORD)
+
+    assert bytes(result) == full_buffer_recrypt(volume, polyglot, TC_PASSWORD)
+
+
+def test_recrypted_header_decrypts_with_the_new_salt(volume, polyglot):
+    cryptomat = Cryptomat()
+    new_header = cryptomat.recrypt_header(volume[:FULL_HEADER_SIZE], polyglot[:SALT_SIZE], TC_PASSWORD)
+
+    assert new_header[:SALT_SIZE] == polyglot[:SALT_SIZE]
+    assert cryptomat.volume_size() == len(volume)
+    assert Cryptomat().decrypt_header(new_header, TC_PASSWORD) == cryptomat.decrypt_header(volume[:FULL_HEADER_SIZE], TC_PASSWORD)
+
+
+def test_wrong_password(volume, polyglot):
+    # Every TrueCrypt and VeraCrypt combination is tried, so this is the slow one
+    assert Cryptomat().cryptomator(volume, polyglot, "wrong") is None
+
+
+def test_short_header(volume):
+    assert Cryptomat().recrypt_header(volume[:FULL_HEADER_SIZE - 1], os.urandom(SALT_SIZE), TC_PASSWORD) is None
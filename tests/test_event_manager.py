@@ -0,0 +1,175 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+# The asyncio event bus: handlers run on the thread pool or the event loop, results and exceptions go back
+# to the publisher, and the channels order, merge or parallelize their events.
+
+import asyncio
+import threading
+from concurrent.futures import CancelledError
+
+import pytest
+
+from buttertoast.Engine.eventManager import EventManager
+
+TIMEOUT = 10
+
+
+@pytest.fixture
+def events():
+    event_manager = EventManager(workers=4)
+    yield event_manager
+    event_manager.close()
+
+
+def test_handlers_run_on_the_pool_in_order_of_registration(events):
+    threads = []
+    events.register_event("job", lambda data: threads.append(threading.current_thread()) or data + 1)
+    events.register_event("job", lambda data: threads.append(threading.current_thread()) or data * 2)
+
+    assert events.trigger_event("job", 20) == [21, 40]
+    assert all(thread.name.startswith("event-handler") for thread in threads)
+
+
+def test_exception_of_a_handler_reaches_the_caller(events):
+    def failing(data):
+        raise ValueError(f"bad {data}")
+
+    events.register_event("job", failing)
+
+    with pytest.raises(ValueError, match="bad 1"):
+        events.trigger_event("job", 1)
+    # The channel keeps working
+    with pytest.raises(ValueError, match="bad 2"):
+        events.publish("job", 2).result(TIMEOUT)
+
+
+def test_unknown_event(events, capsys):
+    assert events.trigger_event("unknown") is None
+    assert "No handler registered" in capsys.readouterr().out
+    with pytest.raises(KeyError):
+        events.publish("unknown").result(TIMEOUT)
+
+
+def test_events_of_one_channel_are_handled_one_at_a_time_in_order(events):
+    handled = []
+    running = []
+    overlaps = []
+    lock = threading.Lock()
+
+    def handler(data):
+        with lock:
+            running.append(data)
+            overlaps.append(len(running))
+        handled.append(data)
+        with lock:
+            running.remove(data)
+
+    events.register_event("job", handler)
+    futures = [events.publish("job", number) for number in range(40)]
+    for future in futures:
+        future.result(TIMEOUT)
+
+    assert handled == list(range(40))
+    assert max(overlaps) == 1
+
+
+def test_concurrent_channel_runs_events_at_the_same_time(events):
+    # Both handlers wait for each other, this only ends if they run at the same time
+    barrier = threading.Barrier(2, timeout=TIMEOUT)
+    events.configure_event("job", concurrency=2)
+    events.register_event("job", lambda data: barrier.wait() is not None)
+
+    futures = [events.publish("job", number) for number in range(2)]
+    assert [future.result(TIMEOUT) for future in futures] == [[True], [True]]
+
+
+def test_different_events_run_at_the_same_time(events):
+    started = threading.Event()
+    events.register_event("slow", lambda data: started.wait(TIMEOUT))
+    events.register_event("fast", lambda data: started.set())
+
+    slow = events.publish("slow")
+    assert events.trigger_event("fast") == [None]
+    assert slow.result(TIMEOUT) == [True]
+
+
+def test_waiting_events_are_coalesced(events):
+    release = threading.Event()
+    handled = []
+
+    def handler(data):
+        if data == "first":
+            release.wait(TIMEOUT)
+        handled.append(data)
+        return data
+
+    events.configure_event("list", coalesce=True)
+    events.register_event("list", handler)
+    first = events.publish("list", "first")
+    # The first event is running, the next ones wait and are merged into one
+    while not first.running():
+        pass
+    waiting = [events.publish("list", data) for data in ("second", "third", "fourth")]
+    release.set()
+
+    assert first.result(TIMEOUT) == ["first"]
+    assert [future.result(TIMEOUT) for future in waiting] == [["fourth"]] * 3
+    assert handled == ["first", "fourth"]
+
+
+def test_event_triggered_by_a_handler_runs_inline(events):
+    # Waiting for the queue of its own channel would deadlock
+    events.register_event("outer", lambda data: events.trigger_event("inner", data))
+    events.register_event("inner", lambda data: (data, threading.current_thread().name))
+
+    [[(data, thread_name)]] = events.trigger_event("outer", 5)
+    assert data == 5 and thread_name.startswith("event-handler")
+
+
+def test_coroutine_handlers_run_on_the_loop(events):
+    async def handler(data):
+        await asyncio.sleep(0)
+        return threading.current_thread().name, data
+
+    async def emitting(data):
+        return await events.emit("coroutine", data)
+
+    events.register_event("coroutine", handler)
+    events.register_event("emitting", emitting)
+
+    assert events.trigger_event("coroutine", 1) == [("event-loop", 1)]
+    assert events.trigger_event("emitting", 2) == [[("event-loop", 2)]]
+
+
+def test_close_cancels_the_queued_events(events):
+    release = threading.Event()
+    events.register_event("job", lambda data: release.wait(TIMEOUT))
+    running = events.publish("job", 0)
+    while not running.running():
+        pass
+    queued = events.publish("job", 1)
+
+    closing = threading.Thread(target=events.close)
+    closing.start()
+    with pytest.raises(CancelledError):
+        queued.result(TIMEOUT)
+    release.set()
+    closing.join(TIMEOUT)
+
+    assert running.result(TIMEOUT) == [True]
+    assert events.loop is None
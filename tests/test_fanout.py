@@ -0,0 +1,71 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+# Fan-out: one volume embedded into many hosts, the header is decrypted once.
+
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from buttertoast.Crypt.cryptomat import Cryptomat, FULL_HEADER_SIZE
+from buttertoast.Engine import engine as engine_module
+from conftest import HOST_EXTENSIONS, TC_PASSWORD, TC_VOLUME
+
+
+def read(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def test_fanout_builds_one_polyglot_per_host(engine, ui, hosts, tmp_path):
+    output_dir = tmp_path / "out"
+    created = engine.process_data_fanout(list(hosts.values()), TC_VOLUME, TC_PASSWORD, str(output_dir), workers=2)
+
+    assert sorted(created) == sorted(str(output_dir / f"host.{extension}") for extension in HOST_EXTENSIONS)
+    assert sorted(os.listdir(output_dir)) == sorted(f"host.{extension}" for extension in HOST_EXTENSIONS)
+    # Every polyglot has the salt of its host, so the headers differ
+    headers = [read(path)[:FULL_HEADER_SIZE] for path in created]
+    assert all(Cryptomat().verify_header(header, TC_PASSWORD) for header in headers)
+    assert len(set(headers)) == len(headers)
+    assert not ui.errors()
+
+
+def test_hosts_with_the_same_name_get_their_own_polyglot(engine, hosts, tmp_path):
+    other_dir = tmp_path / "other"
+    other_dir.mkdir()
+    same_name = [hosts["zip"], shutil.copy(hosts["bmp"], other_dir / "host.zip"), hosts["bmp"]]
+    output_dir = tmp_path / "out"
+
+    created = engine.process_data_fanout(same_name, TC_VOLUME, TC_PASSWORD, str(output_dir), workers=1)
+
+    # The copy of the bmp host is detected by its content, its polyglot is a bmp as well
+    assert sorted(os.listdir(output_dir)) == ["host-2.bmp", "host.bmp", "host.zip"]
+    assert len(created) == 3
+
+
+def test_failed_worker_leaves_no_output(engine, ui, hosts, tmp_path, monkeypatch):
+    def failing_pwrite_all(fd, data, offset):
+        raise OSError(28, "No space left on device")
+
+    # The workers run in threads, so they see the patched function
+    monkeypatch.setattr(engine_module, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(engine_module, "pwrite_all", failing_pwrite_all)
+    output_dir = tmp_path / "out"
+
+    assert engine.process_data_fanout([hosts["zip"]], TC_VOLUME, TC_PASSWORD, str(output_dir), workers=1) == []
+    assert os.listdir(output_dir) == []
+    assert any("No space left on device" in message for message in ui.errors())
@@ -0,0 +1,67 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+# The in-place build patches the volume file into the polyglot, undo_in_place turns it back into the volume.
+
+import os
+
+import pytest
+
+from buttertoast.Crypt.cryptomat import Cryptomat, FULL_HEADER_SIZE
+from conftest import TC_PASSWORD, TC_VOLUME
+
+IN_PLACE_EXTENSIONS = ("bmp", "html", "ico", "wav", "zip")
+
+
+def read(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+
+@pytest.mark.parametrize("extension", IN_PLACE_EXTENSIONS)
+def test_in_place_round_trip(extension, engine, hosts, tc_volume, tmp_path):
+    original = read(tc_volume)
+    output = engine.process_data_in_place(hosts[extension], tc_volume, TC_PASSWORD, str(tmp_path / "polyglot"))
+
+    assert output == str(tmp_path / f"polyglot.{extension}")
+    assert not os.path.exists(tc_volume)
+    polyglot = read(output)
+    assert polyglot[FULL_HEADER_SIZE:len(original) - 128 * 1024] == original[FULL_HEADER_SIZE:len(original) - 128 * 1024]
+    assert Cryptomat().verify_header(polyglot[:FULL_HEADER_SIZE], TC_PASSWORD)
+
+    assert engine.undo_in_place(output + ".header.bak") == tc_volume
+    assert read(tc_volume) == original
+    assert not os.path.exists(output)
+    assert not os.path.exists(output + ".header.bak")
+
+
+def test_png_is_built_by_copying(engine, hosts, tc_volume, tmp_path):
+    original = read(tc_volume)
+    output = engine.process_data_in_place(hosts["png"], tc_volume, TC_PASSWORD, str(tmp_path / "polyglot"))
+
+    assert output == str(tmp_path / "polyglot.png")
+    assert read(tc_volume) == original
+    assert not os.path.exists(output + ".header.bak")
+
+
+def test_wrong_password_leaves_the_volume(engine, ui, hosts, tc_volume, tmp_path):
+    original = read(tc_volume)
+
+    assert engine.process_data_in_place(hosts["zip"], tc_volume, "wrong", str(tmp_path / "polyglot")) is None
+    assert read(tc_volume) == original
+    assert sorted(os.listdir(tmp_path)) == ["hosts", "volume.tc"]
+    assert ui.errors()
@@ -0,0 +1,126 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+import pytest
+
+from buttertoast.Crypt.cryptomat import Cryptomat, FULL_HEADER_SIZE
+from buttertoast.Crypt.key_cache import KeyCache
+from conftest import TC_PASSWORD, TC_VOLUME
+
+PRF = "SHA-512"
+ITERATIONS = 1000
+
+
+def salt(number):
+    return number.to_bytes(64, "big")
+
+
+def key(number, length=64):
+    return bytes([number]) * length
+
+
+@pytest.fixture
+def cache():
+    cache = KeyCache(size=3)
+    cache.configure(True, size=3)
+    return cache
+
+
+def test_disabled_cache_keeps_nothing():
+    cache = KeyCache()
+    cache.put(salt(1), b"pw", PRF, ITERATIONS, key(1))
+
+    assert cache.get(salt(1), b"pw", PRF, ITERATIONS, 64) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_hit_and_miss(cache):
+    cache.put(salt(1), b"pw", PRF, ITERATIONS, key(1))
+
+    assert cache.get(salt(1), b"pw", PRF, ITERATIONS, 64) == key(1)
+    assert cache.get(salt(1), b"pw", PRF, ITERATIONS, 32) == key(1, 32)
+    assert cache.get(salt(1), b"other", PRF, ITERATIONS, 64) is None
+    assert cache.get(salt(1), b"pw", "SHA-256", ITERATIONS, 64) is None
+    assert cache.get(salt(1), b"pw", PRF, ITERATIONS + 1, 64) is None
+    assert cache.get(salt(1), b"pw", PRF, ITERATIONS, 128) is None
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 4
+
+
+def test_least_recently_used_key_is_evicted(cache):
+    for number in (1, 2, 3):
+        cache.put(salt(number), b"pw", PRF, ITERATIONS, key(number))
+    cache.get(salt(1), b"pw", PRF, ITERATIONS, 64)  # 2 is now the least recently used key
+    cache.put(salt(4), b"pw", PRF, ITERATIONS, key(4))
+
+    assert cache.get(salt(2), b"pw", PRF, ITERATIONS, 64) is None
+    for number in (1, 3, 4):
+        assert cache.get(salt(number), b"pw", PRF, ITERATIONS, 64) == key(number)
+    assert cache.stats()["entries"] == 3
+
+
+def test_evicted_and_cleared_keys_are_zeroized(cache):
+    for number in (1, 2, 3):
+        cache.put(salt(number), b"pw", PRF, ITERATIONS, key(number))
+    stored = list(cache.entries.values())
+
+    cache.put(salt(4), b"pw", PRF, ITERATIONS, key(4))
+    assert stored[0] == bytes(64)
+    assert stored[1] == key(2)
+
+    cache.configure(False)
+    assert all(buffer == bytes(64) for buffer in stored[1:])
+    assert cache.stats()["entries"] == 0
+
+
+def test_longer_key_replaces_and_zeroizes_a_shorter_one(cache):
+    cache.put(salt(1), b"pw", PRF, ITERATIONS, key(1, 32))
+    shorter = cache.entries[cache.entry_id(salt(1), b"pw", PRF, ITERATIONS)]
+    cache.put(salt(1), b"pw", PRF, ITERATIONS, key(2, 64))
+    cache.put(salt(1), b"pw", PRF, ITERATIONS, key(3, 32))
+
+    assert shorter == bytes(32)
+    assert cache.get(salt(1), b"pw", PRF, ITERATIONS, 64) == key(2)
+
+
+def test_smaller_size_trims_the_cache(cache):
+    for number in (1, 2, 3):
+        cache.put(salt(number), b"pw", PRF, ITERATIONS, key(number))
+    cache.configure(True, size=1)
+
+    assert cache.stats()["entries"] == 1
+    assert cache.get(salt(3), b"pw", PRF, ITERATIONS, 64) == key(3)
+
+
+def test_entries_do_not_contain_the_password_or_salt(cache):
+    cache.put(salt(1), b"secret password", PRF, ITERATIONS, key(1))
+    entry_id = next(iter(cache.entries))
+
+    assert b"secret password" not in entry_id and salt(1) not in entry_id
+    assert KeyCache().entry_id(salt(1), b"secret password", PRF, ITERATIONS) != entry_id
+
+
+def test_header_decryption_uses_the_cache(monkeypatch):
+    cache = KeyCache()
+    cache.configure(True)
+    monkeypatch.setattr("buttertoast.Crypt.volume_formats.key_cache", cache)
+    with open(TC_VOLUME, "rb") as file:
+        header = file.read(FULL_HEADER_SIZE)
+
+    first = Cryptomat().decrypt_header(header, TC_PASSWORD)
+    misses = cache.stats()["misses"]
+    assert Cryptomat().decrypt_header(header, TC_PASSWORD) == first
+    assert cache.stats()["hits"] >= 1 and cache.stats()["misses"] == misses
@@ -0,0 +1,146 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+# The in-memory build of a layout (materialize) against the streamed writers (write_layout, save_layout),
+# for synthetic layouts and for the layouts planned by the built-in plugins.
+
+import io
+import os
+import struct
+import zipfile
+
+import pytest
+
+from buttertoast.Engine.layout import (HostRange, Literal, VolumeRange, iter_layout, layout_size, materialize,
+                                       read_layout_head, replace_head, save_layout, split_in_place, write_layout)
+from buttertoast.Engine.plugin_Loader import PluginLoader
+from conftest import HOST_EXTENSIONS, TC_VOLUME
+
+VOLUME = bytes(range(256)) * 64
+HOST = os.urandom(5000)
+LAYOUT = [
+    Literal(b"header"),
+    VolumeRange(6, 1000),
+    HostRange(0, 100),
+    Literal(b""),
+    Literal(b"patch"),
+    HostRange(4000, 1000),
+    VolumeRange(1006, len(VOLUME) - 1006),
+    Literal(b"end"),
+]
+
+
+@pytest.fixture
+def files(tmp_path):
+    volume = tmp_path / "volume"
+    host = tmp_path / "host"
+    volume.write_bytes(VOLUME)
+    host.write_bytes(HOST)
+    with open(volume, "rb") as volume_file, open(host, "rb") as host_file:
+        yield volume_file, host_file
+
+
+def test_write_layout_matches_materialize(files, tmp_path):
+    output = tmp_path / "output"
+    fd = os.open(output, os.O_WRONLY | os.O_CREAT)
+    try:
+        written = write_layout(LAYOUT, *files, fd)
+    finally:
+        os.close(fd)
+
+    expected = materialize(LAYOUT, VOLUME, HOST)
+    assert output.read_bytes() == expected
+    assert written == layout_size(LAYOUT) == len(expected)
+
+
+def test_save_layout_matches_materialize(files, tmp_path):
+    output = tmp_path / "output"
+    save_layout(LAYOUT, *files, str(output))
+
+    assert output.read_bytes() == materialize(LAYOUT, VOLUME, HOST)
+
+
+def test_observer_sees_the_written_data(files, tmp_path):
+    observed = bytearray()
+    save_layout(LAYOUT, *files, str(tmp_path / "output"), observer=observed.extend)
+
+    assert bytes(observed) == materialize(LAYOUT, VOLUME, HOST)
+
+
+def test_iter_layout_and_head(files):
+    expected = materialize(LAYOUT, VOLUME, HOST)
+
+    assert b"".join(iter_layout(LAYOUT, *files, chunk_size=7)) == expected
+    assert read_layout_head(LAYOUT, *files, 64) == expected[:64]
+
+
+def test_replace_head():
+    head = b"H" * 20
+    layout = replace_head(LAYOUT, head)
+
+    assert materialize(layout, VOLUME, HOST) == head + materialize(LAYOUT, VOLUME, HOST)[len(head):]
+
+
+def test_split_in_place():
+    layout = [Literal(b"H" * 512), VolumeRange(512, len(VOLUME) - 512), HostRange(0, 10), Literal(b"x")]
+
+    assert split_in_place(layout, len(VOLUME)) == (b"H" * 512, [HostRange(0, 10), Literal(b"x")])
+    assert split_in_place(LAYOUT, len(VOLUME)) is None
+    assert split_in_place(layout + [VolumeRange(0, 1)], len(VOLUME)) is None
+
+
+@pytest.mark.parametrize("extension", HOST_EXTENSIONS)
+def test_plugin_plan_matches_run(extension, hosts, ui, tmp_path):
+    plugin = PluginLoader(ui=ui).load_plugin(extension)
+    with open(TC_VOLUME, "rb") as volume_file, open(hosts[extension], "rb") as host_file:
+        volume, host = volume_file.read(), host_file.read()
+        layout = plugin.plan(volume_file, host_file)
+        output = tmp_path / f"polyglot.{extension}"
+        save_layout(layout, volume_file, host_file, str(output))
+
+    assert output.read_bytes() == bytes(plugin.run(volume, host))
+
+
+@pytest.mark.parametrize("extension", HOST_EXTENSIONS)
+def test_plugin_plan_from_memory(extension, hosts, ui):
+    plugin = PluginLoader(ui=ui).load_plugin(extension)
+    with open(TC_VOLUME, "rb") as volume_file, open(hosts[extension], "rb") as host_file:
+        volume, host = volume_file.read(), host_file.read()
+        from_files = plugin.plan(volume_file, host_file)
+
+    assert plugin.plan(io.BytesIO(volume), io.BytesIO(host)) == from_files
+
+
+def test_zip_plan_uses_the_last_end_of_central_directory(ui):
+    # A stored inner archive puts a first End of Central Directory record in front of the real one
+    inner = io.BytesIO()
+    with zipfile.ZipFile(inner, "w") as archive:
+        archive.writestr("inner.txt", "inner")
+    outer = io.BytesIO()
+    with zipfile.ZipFile(outer, "w", zipfile.ZIP_STORED) as archive:
+        archive.writestr("inner.zip", inner.getvalue())
+        archive.writestr("outer.txt", "outer")
+    host = outer.getvalue()
+
+    plugin = PluginLoader(ui=ui).load_plugin("zip")
+    polyglot = materialize(plugin.plan(io.BytesIO(VOLUME), io.BytesIO(host)), VOLUME, host)
+
+    eocd = host.rfind(b"PK\x05\x06")
+    central_offset = struct.unpack("<I", host[eocd + 16:eocd + 20])[0]
+    assert struct.unpack("<I", polyglot[len(VOLUME) + eocd + 16:len(VOLUME) + eocd + 20])[0] == central_offset + len(VOLUME)
+    assert polyglot[:len(VOLUME)] == VOLUME
+    plugin.verify(io.BytesIO(polyglot))
@@ -0,0 +1,83 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+import shutil
+
+import pytest
+
+from buttertoast.Engine.magic import MagicTrie, read_head
+from buttertoast.Engine.plugin_Loader import PluginLoader
+from conftest import HOST_EXTENSIONS
+
+
+@pytest.fixture
+def trie():
+    trie = MagicTrie()
+    trie.insert(b"PK", "short")
+    trie.insert(b"PK\x03\x04", "long")
+    trie.insert((b"RIFF", 4, b"WAVE"), "wav")
+    trie.insert((b"RIFF", 4, b"AVI "), "avi")
+    trie.insert((b"RI", 2, b"XY"), "wildcard")
+    return trie
+
+
+def test_longest_match_wins(trie):
+    assert trie.match(b"PK\x03\x04rest") == "long"
+    assert trie.match(b"PK\x05\x06") == "short"
+    assert trie.match(b"PK\x03") == "short"
+
+
+def test_wildcards(trie):
+    assert trie.match(b"RIFF\x10\x00\x00\x00WAVEfmt ") == "wav"
+    assert trie.match(b"RIFF\xff\xff\xff\xffAVI LIST") == "avi"
+    assert trie.match(b"RIFF\x10\x00\x00\x00WAVX") is None
+    assert trie.match(b"RIFFXY") == "wildcard"
+
+
+def test_no_match(trie):
+    assert trie.match(b"") is None
+    assert trie.match(b"P") is None
+    assert trie.match(b"\x89PNG") is None
+    assert trie.match(b"RIFF\x10\x00") is None
+
+
+def test_first_value_is_kept_and_depth(trie):
+    trie.insert(b"PK\x03\x04", "other")
+    trie.insert(b"", "empty")
+
+    assert trie.match(b"PK\x03\x04") == "long"
+    assert trie.match(b"x") is None
+    assert trie.depth == 12
+
+
+def test_read_head(tmp_path):
+    path = tmp_path / "file"
+    path.write_bytes(b"0123456789")
+
+    assert read_head(str(path), 4) == b"0123"
+    assert read_head(str(path), 100) == b"0123456789"
+
+
+@pytest.mark.parametrize("extension", HOST_EXTENSIONS)
+def test_detect_plugin_by_content(extension, hosts, ui, tmp_path):
+    # The extension of the file does not matter, the plugin is found by the magic number
+    renamed = tmp_path / "host.bin"
+    shutil.copyfile(hosts[extension], renamed)
+    loader = PluginLoader(ui=ui)
+
+    assert loader.detect_plugin(hosts[extension]) == (extension, f"btp_{extension}")
+    assert loader.detect_plugin(str(renamed)) == (extension, f"btp_{extension}")
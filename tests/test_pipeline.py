@@ -0,0 +1,201 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+# The staged Pipeline with simple jobs: order of the stages, overlapping stages, the end of the jobs,
+# failing stages and cancellation.
+
+import json
+import threading
+import time
+
+import pytest
+
+from buttertoast.Crypt.cryptomat import Cryptomat, FULL_HEADER_SIZE
+from buttertoast.Engine.batch import run_batch_pipeline
+from buttertoast.Engine.pipeline import Pipeline
+from conftest import TC_PASSWORD, TC_VOLUME
+
+TIMEOUT = 10
+
+
+class Job:
+    def __init__(self, number):
+        self.number = number
+        self.stages = []
+        self.cancelled = False
+        self.closed = False
+        self.error = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def close(self):
+        self.closed = True
+
+
+def recording_stage(name):
+    def run(job):
+        job.stages.append(name)
+        return True
+    return run
+
+
+def test_jobs_pass_all_stages_in_order():
+    jobs = [Job(number) for number in range(20)]
+    pipeline = Pipeline([(recording_stage("read"), 1), (recording_stage("plan"), 1), (recording_stage("write"), 1)])
+
+    finished = list(pipeline.run(jobs))
+
+    # With one thread per stage the jobs keep their order
+    assert [job.number for job in finished] == list(range(20))
+    assert all(job.stages == ["read", "plan", "write"] and job.completed and job.closed for job in finished)
+
+
+def test_every_job_leaves_once_with_many_threads_per_stage():
+    jobs = [Job(number) for number in range(50)]
+    pipeline = Pipeline([(recording_stage("read"), 3), (recording_stage("encrypt"), 4), (recording_stage("write"), 2)])
+
+    finished = list(pipeline.run(jobs))
+
+    # The end of the jobs reached every thread, otherwise run() would not return
+    assert sorted(job.number for job in finished) == list(range(50))
+    assert all(job.stages == ["read", "encrypt", "write"] for job in finished)
+    assert not pipeline.active
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith("pipeline-")]
+
+
+def test_stages_overlap():
+    # The second stage of job 0 waits until the first stage works on job 1
+    second_job_read = threading.Event()
+
+    def read(job):
+        if job.number == 1:
+            second_job_read.set()
+        return True
+
+    def write(job):
+        if job.number == 0:
+            assert second_job_read.wait(TIMEOUT)
+        return True
+
+    finished = list(Pipeline([(read, 1), (write, 1)]).run([Job(0), Job(1)]))
+
+    assert [job.completed for job in finished] == [True, True]
+
+
+def test_queues_hold_back_the_jobs():
+    running = threading.Event()
+    release = threading.Event()
+    fed = []
+
+    def jobs():
+        for number in range(20):
+            fed.append(number)
+            yield Job(number)
+
+    def write(job):
+        running.set()
+        return release.wait(TIMEOUT)
+
+    pipeline = Pipeline([(recording_stage("read"), 1), (write, 1)], queue_size=1)
+    results = pipeline.run(jobs())
+    thread = threading.Thread(target=lambda: fed.append(list(results)))
+    thread.start()
+    assert running.wait(TIMEOUT)
+    time.sleep(0.2)
+
+    # One job in each stage and one in each queue, the feeder waits with the next one
+    assert len(fed) <= 5
+    release.set()
+    thread.join(TIMEOUT)
+    assert len(fed[-1]) == 20
+
+
+def test_failed_jobs_skip_the_remaining_stages():
+    def plan(job):
+        if job.number == 1:
+            raise ValueError("broken plugin")
+        return job.number != 2
+
+    jobs = [Job(number) for number in range(4)]
+    finished = {job.number: job for job in Pipeline([(plan, 1), (recording_stage("write"), 1)]).run(jobs)}
+
+    assert finished[0].completed and finished[3].completed
+    assert not finished[1].completed and isinstance(finished[1].error, ValueError)
+    assert not finished[2].completed and finished[2].error is None
+    assert finished[1].stages == finished[2].stages == []
+
+
+def test_error_of_the_jobs_is_raised_after_the_jobs_read_so_far():
+    def jobs():
+        yield Job(0)
+        yield Job(1)
+        raise OSError("manifest not readable")
+
+    finished = []
+    with pytest.raises(OSError):
+        for job in Pipeline([(recording_stage("read"), 1)]).run(jobs()):
+            finished.append(job.number)
+    assert finished == [0, 1]
+
+
+def test_cancel_stops_the_jobs():
+    pipeline = Pipeline([(recording_stage("read"), 1), (recording_stage("write"), 1)], queue_size=1)
+    results = pipeline.run(Job(number) for number in range(100))
+    first = next(results)
+    pipeline.cancel()
+    rest = list(results)
+
+    assert first.completed
+    # Every job still leaves the pipeline, only those already past the bounded queues completed
+    assert len(rest) == 99
+    assert sum(job.completed for job in rest) <= 6
+    assert all(job.cancelled for job in rest if not job.completed)
+    assert all(job.stages == [] for job in rest[10:])
+
+
+def test_caller_stopping_early_cancels_the_remaining_jobs():
+    jobs = [Job(number) for number in range(30)]
+    pipeline = Pipeline([(recording_stage("read"), 2), (recording_stage("write"), 2)])
+
+    for job in pipeline.run(jobs):
+        break
+
+    assert pipeline.cancelled
+    assert all(job.closed for job in jobs if job.stages)
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith("pipeline-")]
+
+
+def test_batch_through_the_pipeline(hosts, tmp_path):
+    manifest = tmp_path / "jobs.jsonl"
+    jobs = [{"host": hosts[extension], "volume": TC_VOLUME, "password": TC_PASSWORD,
+             "output": str(tmp_path / f"polyglot_{extension}")} for extension in ("bmp", "png", "zip")]
+    jobs.append({"host": hosts["zip"], "volume": TC_VOLUME, "password": "wrong", "output": str(tmp_path / "wrong")})
+    jobs.append({"host": hosts["zip"], "volume": TC_VOLUME})
+    manifest.write_text("\n".join(json.dumps(job) for job in jobs) + "\n")
+
+    summary = run_batch_pipeline(str(manifest), str(tmp_path / "results.jsonl"), workers=2)
+
+    assert summary == {"ok": 3, "error": 2, "cancelled": 0}
+    results = {result["id"]: result for result in map(json.loads, (tmp_path / "results.jsonl").read_text().splitlines())}
+    for number, extension in enumerate(("bmp", "png", "zip"), start=1):
+        assert results[number]["status"] == "ok"
+        assert results[number]["output"] == str(tmp_path / f"polyglot_{extension}.{extension}")
+        with open(results[number]["output"], "rb") as file:
+            assert Cryptomat().verify_header(file.read(FULL_HEADER_SIZE), TC_PASSWORD)
+    assert results[4]["status"] == "error" and not (tmp_path / "wrong.zip").exists()
+    assert results[5]["error"] == "Missing fields: password, output"
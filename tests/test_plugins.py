@@ -0,0 +1,197 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+# The pre-flight checks of the hosts and volumes (validate), the round-trip checks of the written polyglots (verify)
+# and the salts the plugins predict for the speculative key derivation (salt_for).
+
+import io
+import os
+import struct
+
+import pytest
+
+from buttertoast.Engine.layout import read_layout_head
+from buttertoast.Engine.plugin_Loader import PluginLoader
+from conftest import HOST_EXTENSIONS, TC_PASSWORD, TC_VOLUME
+
+ICO_ENTRY = struct.pack("<BBBBHHI", 16, 16, 0, 0, 1, 32, 8)
+
+INVALID_HOSTS = [
+    ("bmp", b"BM" + bytes(10)),
+    ("bmp", b"XX" + bytes(52)),
+    ("bmp", b"BM" + bytes(12) + struct.pack("<I", 12) + bytes(36)),
+    ("html", b"no tag in this file"),
+    ("ico", b"\x00\x00\x01\x00" + bytes(10)),
+    ("ico", struct.pack("<HHH", 0, 2, 1) + ICO_ENTRY + struct.pack("<I", 22) + bytes(8)),
+    ("ico", struct.pack("<HHH", 0, 1, 0) + ICO_ENTRY + struct.pack("<I", 22) + bytes(8)),
+    ("ico", struct.pack("<HHH", 0, 1, 1) + ICO_ENTRY + struct.pack("<I", 1000) + bytes(8)),
+    ("png", b"GIF89a" + bytes(40)),
+    ("png", b"\x89PNG\r\n\x1a\n" + struct.pack("!I4s", 13, b"IHDX") + bytes(30)),
+    ("wav", b"RIFX" + bytes(4) + b"WAVE" + bytes(30)),
+    ("wav", b"RIFF" + bytes(4) + b"WAVEfmt " + struct.pack("<I", 18) + bytes(20)),
+    ("zip", b"no archive" * 10),
+    ("zip", b"PK\x05\x06" + bytes(18) + bytes(0x10000)),
+]
+
+
+def load_plugin(ui, extension):
+    return PluginLoader(ui=ui).load_plugin(extension)
+
+
+def build_polyglot(plugin, host):
+    with open(TC_VOLUME, "rb") as file:
+        return bytearray(plugin.run(file.read(), host))
+
+
+@pytest.mark.parametrize("extension", HOST_EXTENSIONS)
+def test_valid_hosts_pass(extension, hosts, ui):
+    with open(hosts[extension], "rb") as host:
+        load_plugin(ui, extension).validate(host)
+
+
+@pytest.mark.parametrize("extension, host", INVALID_HOSTS)
+def test_invalid_hosts_are_rejected(extension, host, ui):
+    with pytest.raises(ValueError):
+        load_plugin(ui, extension).validate(io.BytesIO(host))
+
+
+@pytest.mark.parametrize("extension", HOST_EXTENSIONS)
+def test_polyglots_pass_verify(extension, hosts, ui):
+    plugin = load_plugin(ui, extension)
+    with open(hosts[extension], "rb") as host:
+        plugin.verify(io.BytesIO(build_polyglot(plugin, host.read())))
+
+
+# HTML hosts whose first '>' is behind the salt, or that have none in their first 64 bytes
+LONG_TAG_HTML = (b'<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
+                 b'"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd"><html><body>Hello</body></html>\n')
+LATE_TAG_HTML = b"Hello " * 20 + b"<p>world</p>\n"
+
+
+def assert_salt_predicted(plugin, volume, host):
+    with open(host, "rb") as host_file:
+        prefix = plugin.salt_for(host_file.read(64), os.path.getsize(volume))
+    if prefix is None:
+        return False
+
+    with open(volume, "rb") as volume_file, open(host, "rb") as host_file:
+        planned = read_layout_head(plugin.plan(volume_file, host_file), volume_file, host_file, 64)
+        volume_file.seek(0)
+        predicted = (bytes(prefix) + volume_file.read(64)[len(prefix):])[:64]
+    # A wrong prediction would only cost time, but the engine relies on it being right
+    assert predicted == planned
+    return True
+
+
+@pytest.mark.parametrize("extension", HOST_EXTENSIONS)
+@pytest.mark.parametrize("volume_sectors", [None, 600, 4097])
+def test_salt_for_matches_the_plan(extension, volume_sectors, hosts, ui, tmp_path):
+    volume = TC_VOLUME
+    if volume_sectors:
+        volume = str(tmp_path / "volume")
+        with open(volume, "wb") as file:
+            file.write(os.urandom(volume_sectors * 512))
+
+    assert assert_salt_predicted(load_plugin(ui, extension), volume, hosts[extension])
+
+
+@pytest.mark.parametrize("html", [LONG_TAG_HTML, LATE_TAG_HTML])
+def test_salt_for_unusual_html_hosts(html, ui, tmp_path):
+    host = tmp_path / "host.html"
+    host.write_bytes(html)
+
+    assert assert_salt_predicted(load_plugin(ui, "html"), TC_VOLUME, str(host))
+
+
+def test_salt_for_short_html_host(ui):
+    # Without a '>' in a short host nothing is known about the salt, the engine derives after the encryption
+    assert load_plugin(ui, "html").salt_for(b"<html", 600 * 512) is None
+
+
+def corrupt_bmp(polyglot, host):
+    polyglot[10:14] = struct.pack("<I", len(polyglot))
+
+
+def corrupt_html(polyglot, host):
+    offset = polyglot.find(b">")
+    polyglot[offset + 1:offset + 5] = b"<p> "
+
+
+def corrupt_ico(polyglot, host):
+    polyglot[18:22] = struct.pack("<I", 100)
+
+
+def corrupt_png(polyglot, host):
+    polyglot += b"trailing data"
+
+
+def corrupt_wav(polyglot, host):
+    polyglot += b"x"
+
+
+def corrupt_zip(polyglot, host):
+    # The central directory offset of the host, not moved behind the volume
+    eocd = len(polyglot) - len(host) + host.rfind(b"PK\x05\x06")
+    polyglot[eocd + 16:eocd + 20] = struct.pack("<I", 1)
+
+
+@pytest.mark.parametrize("extension, corrupt", [
+    ("bmp", corrupt_bmp), ("html", corrupt_html), ("ico", corrupt_ico),
+    ("png", corrupt_png), ("wav", corrupt_wav), ("zip", corrupt_zip),
+])
+def test_broken_polyglots_fail_verify(extension, corrupt, hosts, ui):
+    plugin = load_plugin(ui, extension)
+    with open(hosts[extension], "rb") as file:
+        host = file.read()
+    polyglot = build_polyglot(plugin, host)
+    corrupt(polyglot, host)
+
+    with pytest.raises(ValueError):
+        plugin.verify(io.BytesIO(bytes(polyglot)))
+
+
+def test_preflight_rejects_invalid_volumes(engine, ui, hosts, tmp_path):
+    unaligned = tmp_path / "unaligned"
+    unaligned.write_bytes(os.urandom(1000))
+    plain = tmp_path / "plain"
+    plain.write_bytes(bytes(4096))
+    short = tmp_path / "short"
+    short.write_bytes(os.urandom(100))
+
+    for volume in (unaligned, plain, short):
+        assert engine.preflight(hosts["zip"], str(volume))[1] is None
+    assert len(ui.errors()) == 3
+    assert engine.preflight(hosts["zip"], TC_VOLUME)[1] is not None
+
+
+def test_preflight_rejects_invalid_hosts(engine, ui, tmp_path):
+    host = tmp_path / "host.png"
+    host.write_bytes(INVALID_HOSTS[9][1])
+
+    assert engine.preflight(str(host), TC_VOLUME)[1] is None
+    assert ui.errors()
+
+
+def test_verify_output_checks_the_header(engine, ui, hosts, tmp_path):
+    plugin = load_plugin(ui, "zip")
+    output = engine.process_data_stream(hosts["zip"], TC_VOLUME, TC_PASSWORD, str(tmp_path / "polyglot"))
+    assert output and engine.verify_output(output, plugin, TC_PASSWORD)
+
+    with open(output, "r+b") as file:
+        file.seek(100)
+        file.write(bytes(16))
+    assert not engine.verify_output(output, plugin, TC_PASSWORD)
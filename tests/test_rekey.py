@@ -0,0 +1,77 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+# Changing the password of a polyglot re-encrypts both headers and leaves the data area alone.
+
+import pytest
+
+from buttertoast.Crypt.cryptomat import Cryptomat, FULL_HEADER_SIZE, HEADER_GROUP_SIZE
+from buttertoast.Engine.progress import Progress
+from conftest import TC_PASSWORD, TC_VOLUME
+
+NEW_PASSWORD = "new password"
+
+
+def read(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+
+@pytest.fixture
+def polyglot(engine, hosts, tmp_path):
+    return engine.process_data_stream(hosts["zip"], TC_VOLUME, TC_PASSWORD, str(tmp_path / "polyglot"))
+
+
+def test_rekey_round_trip(engine, polyglot):
+    original = read(polyglot)
+    backup_offset = len(read(TC_VOLUME)) - HEADER_GROUP_SIZE
+
+    assert engine.rekey(polyglot, TC_PASSWORD, NEW_PASSWORD)
+    rekeyed = read(polyglot)
+    header, backup_header = rekeyed[:FULL_HEADER_SIZE], rekeyed[backup_offset:backup_offset + FULL_HEADER_SIZE]
+
+    # Only the two headers changed, under their old salts
+    assert header[:64] == original[:64] and header != original[:FULL_HEADER_SIZE]
+    assert backup_header[:64] == original[backup_offset:backup_offset + 64]
+    assert backup_header != original[backup_offset:backup_offset + FULL_HEADER_SIZE]
+    assert rekeyed[FULL_HEADER_SIZE:backup_offset] == original[FULL_HEADER_SIZE:backup_offset]
+    assert rekeyed[backup_offset + FULL_HEADER_SIZE:] == original[backup_offset + FULL_HEADER_SIZE:]
+    assert Cryptomat().verify_header(header, NEW_PASSWORD)
+
+    # The encryption is deterministic for a salt, changing the password back restores the file
+    assert engine.rekey(polyglot, NEW_PASSWORD, TC_PASSWORD)
+    assert read(polyglot) == original
+
+
+def test_rekey_with_a_wrong_password(engine, ui, polyglot):
+    original = read(polyglot)
+
+    assert not engine.rekey(polyglot, "wrong", NEW_PASSWORD)
+    assert read(polyglot) == original
+    assert ui.errors()
+
+
+def test_cancelled_rekey_event(engine, ui, polyglot):
+    original = read(polyglot)
+    progress = Progress()
+    progress.cancel()
+
+    engine.on_rekey({"polyglot": polyglot, "old_password": TC_PASSWORD, "new_password": NEW_PASSWORD,
+                     "pim": None, "progress": progress})
+    assert read(polyglot) == original
+    assert ("info", "Changing the password cancelled.") in ui.messages
+    assert not ui.errors() and engine.progress is None
@@ -0,0 +1,26 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+# The CLI start must not load the modules of the other UIs or NumPy.
+
+from buttertoast.Utilities.benchmark_startup import EXPECTED_MODULES, STARTUP_PATHS, measure
+
+
+def test_cli_start_loads_no_unexpected_heavy_module():
+    _, loaded = measure(STARTUP_PATHS["cli"], 1)
+
+    assert [module for module in loaded if module not in EXPECTED_MODULES["cli"]] == []
@@ -0,0 +1,151 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+# The streamed build and its speculative key derivation: the header keys are derived for the salt the plugin
+# predicts while the polyglot is planned and written.
+
+import errno
+import os
+import threading
+from concurrent.futures import wait
+
+import pytest
+
+from buttertoast.Crypt.cryptomat import Cryptomat, FULL_HEADER_SIZE
+from buttertoast.Engine import layout
+from buttertoast.Engine.engine import Engine
+from buttertoast.Engine.progress import Progress
+from conftest import TC_PASSWORD, TC_VOLUME
+
+MISPREDICTED = "The plugin predicted another salt than it planned, deriving the header keys again."
+
+
+def record_derivations(monkeypatch, salt_for=None):
+    """Records the derivation futures of the jobs, optionally replacing the salt prediction of their plugins."""
+    futures = []
+    start_key_derivation = Engine.start_key_derivation
+
+    def recording_start_key_derivation(self, job):
+        if salt_for is not None:
+            job.plugin.salt_for = salt_for
+        start_key_derivation(self, job)
+        futures.append(job.headers)
+
+    monkeypatch.setattr(Engine, "start_key_derivation", recording_start_key_derivation)
+    return futures
+
+
+def read_header(path):
+    with open(path, "rb") as file:
+        return file.read(FULL_HEADER_SIZE)
+
+
+@pytest.mark.parametrize("extension", ["png", "html", "zip"])
+def test_speculative_derivation(extension, engine, ui, hosts, tmp_path, monkeypatch):
+    futures = record_derivations(monkeypatch)
+
+    polyglot = engine.process_data_stream(hosts[extension], TC_VOLUME, TC_PASSWORD, str(tmp_path / "polyglot"))
+    assert polyglot is not None
+    # The keys were derived for the predicted salt, and the prediction held
+    assert len(futures) == 1 and futures[0] is not None and futures[0].done()
+    assert MISPREDICTED not in [message for _, message in ui.messages]
+    assert Cryptomat().verify_header(read_header(polyglot), TC_PASSWORD)
+
+
+def test_mispredicted_salt(engine, ui, hosts, tmp_path, monkeypatch):
+    futures = record_derivations(monkeypatch, lambda host_prefix, volume_size: b"\xff" * 64)
+
+    polyglot = engine.process_data_stream(hosts["png"], TC_VOLUME, TC_PASSWORD, str(tmp_path / "polyglot"))
+    assert polyglot is not None and len(futures) == 1 and futures[0] is not None
+    # The speculative headers are dropped, the header is encrypted under the planned salt
+    assert ("verbose", MISPREDICTED) in ui.messages
+    header = read_header(polyglot)
+    assert header[:64] != b"\xff" * 64
+    assert Cryptomat().verify_header(header, TC_PASSWORD)
+
+
+def test_failed_derivation_stops_the_copy(engine, hosts, tmp_path, monkeypatch):
+    # Larger than one chunk, its content does not matter, the derivation is replaced
+    volume = tmp_path / "volume.tc"
+    volume.write_bytes(os.urandom(3 * layout.CHUNK_SIZE))
+    futures = []
+    copy_started = threading.Event()
+    start_key_derivation = Engine.start_key_derivation
+
+    def recording_start_key_derivation(self, job):
+        start_key_derivation(self, job)
+        futures.append(job.headers)
+
+    def failing_recrypt_headers(self, cryptomat, fd, *args):
+        # Fails like a wrong password, but only once the copy has started
+        os.close(fd)
+        copy_started.wait(10)
+        return None, None
+
+    class RecordingProgress(Progress):
+        written = []
+
+        def advance(self, count):
+            super().advance(count)
+            self.written.append(count)
+            copy_started.set()
+            wait(futures, timeout=10)
+
+    def no_clone_file(source_fd, fd):
+        raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+
+    # A cloned volume is not copied, the test needs the copy in chunks
+    monkeypatch.setattr(layout, "clone_file", no_clone_file)
+    monkeypatch.setattr(Engine, "start_key_derivation", recording_start_key_derivation)
+    monkeypatch.setattr(Engine, "recrypt_headers", failing_recrypt_headers)
+    engine.progress = RecordingProgress()
+
+    assert engine.process_data_stream(hosts["zip"], str(volume), TC_PASSWORD, str(tmp_path / "polyglot")) is None
+    assert len(futures) == 1
+    # The copy stopped at the first chunk boundary after the derivation had failed
+    assert RecordingProgress.written == [layout.CHUNK_SIZE]
+    assert sorted(os.listdir(tmp_path)) == ["hosts", "volume.tc"]
+
+
+@pytest.mark.parametrize("extension", ["bmp", "png", "wav", "zip"])
+def test_stream_matches_the_in_memory_build(extension, engine, hosts, tmp_path):
+    with open(hosts[extension], "rb") as host_file, open(TC_VOLUME, "rb") as volume_file:
+        host_bytes, volume_bytes = host_file.read(), volume_file.read()
+    in_memory = engine.process_data(hosts[extension], host_bytes, volume_bytes, TC_PASSWORD, str(tmp_path / "memory"))
+    streamed = engine.process_data_stream(hosts[extension], TC_VOLUME, TC_PASSWORD, str(tmp_path / "stream"))
+
+    with open(in_memory, "rb") as file:
+        expected = file.read()
+    with open(streamed, "rb") as file:
+        actual = file.read()
+    # Only the backup header differs, it gets a new random salt in both builds
+    assert len(actual) == len(expected)
+    differing = [position for position in range(0, len(actual), FULL_HEADER_SIZE)
+                 if actual[position:position + FULL_HEADER_SIZE] != expected[position:position + FULL_HEADER_SIZE]]
+    assert len(differing) <= 1
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_cli_reports_only_written_polyglots(streaming, engine, ui, hosts, tmp_path):
+    engine.config["streaming"] = streaming
+    job = {"host": hosts["zip"], "volume": TC_VOLUME, "output": str(tmp_path / "polyglot")}
+
+    engine.run_cli_job({**job, "password": "wrong"}, verbose=False)
+    assert not any(message.startswith("Processing complete") for _, message in ui.messages)
+
+    engine.run_cli_job({**job, "password": TC_PASSWORD}, verbose=False)
+    assert ("verbose", f"Processing complete. Output saved to {tmp_path / 'polyglot.zip'}") in ui.messages
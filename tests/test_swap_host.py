@@ -0,0 +1,94 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+# Swapping the host rewrites the tail behind the volume and the header, an error leaves the polyglot as it was.
+
+import os
+import struct
+import zlib
+
+import pytest
+
+from buttertoast.Crypt.cryptomat import Cryptomat, FULL_HEADER_SIZE, HEADER_GROUP_SIZE
+from buttertoast.Crypt.volume_formats import HeaderParameters, encrypt_header
+from buttertoast.Engine import engine as engine_module
+from conftest import TC_PASSWORD, TC_VOLUME
+
+
+def read(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+
+@pytest.fixture
+def polyglot(engine, hosts, tmp_path):
+    return engine.process_data_stream(hosts["zip"], TC_VOLUME, TC_PASSWORD, str(tmp_path / "polyglot"))
+
+
+@pytest.mark.parametrize("extension", ["bmp", "html", "ico", "wav", "zip"])
+def test_swap_host(extension, engine, hosts, polyglot, tmp_path):
+    original = read(polyglot)
+    volume_end = len(read(TC_VOLUME))
+
+    output = engine.swap_host(polyglot, hosts[extension], TC_PASSWORD)
+    assert output == str(tmp_path / f"polyglot.{extension}")
+    swapped = read(output)
+    assert swapped[FULL_HEADER_SIZE:volume_end] == original[FULL_HEADER_SIZE:volume_end]
+    assert Cryptomat().verify_header(swapped[:FULL_HEADER_SIZE], TC_PASSWORD)
+    assert sorted(os.listdir(tmp_path)) == ["hosts", f"polyglot.{extension}"]
+
+    # The zip plugin keeps the salt of the volume, swapping back restores everything except the header
+    assert engine.swap_host(output, hosts["zip"], TC_PASSWORD) == polyglot
+    swapped_back = read(polyglot)
+    assert swapped_back[FULL_HEADER_SIZE:] == original[FULL_HEADER_SIZE:]
+    assert Cryptomat().verify_header(swapped_back[:FULL_HEADER_SIZE], TC_PASSWORD)
+
+
+def test_failed_write_restores_the_polyglot(engine, ui, hosts, polyglot, tmp_path, monkeypatch):
+    original = read(polyglot)
+    write_layout = engine_module.write_layout
+    calls = []
+
+    def failing_write_layout(layout, volume, host, fd, *args, **kwargs):
+        # The first call copies the old tail, the second one writes the new tail
+        calls.append(layout)
+        if len(calls) == 2:
+            raise OSError(28, "No space left on device")
+        return write_layout(layout, volume, host, fd, *args, **kwargs)
+
+    monkeypatch.setattr(engine_module, "write_layout", failing_write_layout)
+    assert engine.swap_host(polyglot, hosts["bmp"], TC_PASSWORD) is None
+    assert read(polyglot) == original
+    assert sorted(os.listdir(tmp_path)) == ["hosts", "polyglot.zip"]
+    assert ui.errors()
+
+
+def test_header_without_volume_size_is_rejected(engine, ui, hosts, tmp_path):
+    # TrueCrypt before 6.0 stored neither the size of the volume nor its encrypted area
+    keys = os.urandom(256)
+    fields = b"TRUE" + struct.pack(">HH", 3, 0x0500) + struct.pack(">I", zlib.crc32(keys)) + bytes(16)
+    fields += struct.pack(">QQQQI", 0, 0, 0, 0, 0) + struct.pack(">I", 512)
+    fields += bytes(188 - len(fields))
+    header = encrypt_header(HeaderParameters("TrueCrypt", "SHA-512", 1000, "AES"), os.urandom(64),
+                            fields + struct.pack(">I", zlib.crc32(fields)) + keys, TC_PASSWORD.encode())
+    polyglot = tmp_path / "old.zip"
+    polyglot.write_bytes(header + os.urandom(2 * HEADER_GROUP_SIZE) + read(hosts["zip"]))
+    original = polyglot.read_bytes()
+
+    assert engine.swap_host(str(polyglot), hosts["bmp"], TC_PASSWORD) is None
+    assert polyglot.read_bytes() == original
+    assert any("does not describe the size" in message for message in ui.errors())
@@ -0,0 +1,104 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+# Detection of the header parameters. A small PIM makes the VeraCrypt combinations cheap, but still expensive
+# enough to be tried on the derivation pool.
+
+import os
+import struct
+import time
+import zlib
+
+import pytest
+
+from buttertoast.Crypt import volume_formats
+from buttertoast.Crypt.volume_formats import (HeaderParameters, block_ciphers, crypt_header_unit, detect_header,
+                                              encrypt_header, veracrypt_iterations)
+from buttertoast.Crypt.xts_engine import crypt_sectors
+from buttertoast.Engine.progress import Cancelled, Progress
+
+PIM = 1
+PASSWORD = b"pw"
+
+
+def plain_header(magic):
+    keys = os.urandom(256)
+    fields = magic + struct.pack(">HH", 5, 0x010b) + struct.pack(">I", zlib.crc32(keys)) + bytes(16)
+    fields += struct.pack(">QQQQI", 0, 1 << 20, 131072, 1 << 20, 0) + struct.pack(">I", 512)
+    fields += bytes(188 - len(fields))
+    return fields + struct.pack(">I", zlib.crc32(fields)) + keys
+
+
+@pytest.fixture(autouse=True)
+def no_recent_parameters(monkeypatch):
+    # Recently found parameters are tried in the calling process, the tests want the pool
+    monkeypatch.setattr(volume_formats, "recent_parameters", [])
+
+
+@pytest.mark.parametrize("prf", ["SHA-512", "SHA-256"])
+def test_detect_veracrypt_header_on_the_pool(prf):
+    parameters = HeaderParameters("VeraCrypt", prf, veracrypt_iterations(PIM), "AES")
+    decrypted_header = plain_header(b"VERA")
+    header = encrypt_header(parameters, os.urandom(64), decrypted_header, PASSWORD)
+
+    assert detect_header(header, PASSWORD, pim=PIM, workers=2) == (parameters, decrypted_header)
+    assert volume_formats.derivation_pool is not None
+
+
+def test_pool_is_kept_and_searches_are_released():
+    header = encrypt_header(HeaderParameters("VeraCrypt", "SHA-256", veracrypt_iterations(PIM), "AES"),
+                            os.urandom(64), plain_header(b"VERA"), PASSWORD)
+    detect_header(header, PASSWORD, pim=PIM, workers=2)
+    pool = volume_formats.derivation_pool
+
+    assert detect_header(header, b"wrong", pim=PIM, workers=2) is None
+    assert detect_header(header, PASSWORD, pim=PIM, workers=2) is not None
+    assert volume_formats.derivation_pool is pool
+
+    # The flags of the stopped searches are given back once their combinations have left the pool
+    deadline = time.monotonic() + 30
+    while len(volume_formats.free_search_slots) < volume_formats.MAX_SEARCHES and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert len(volume_formats.free_search_slots) == volume_formats.MAX_SEARCHES
+
+
+def test_cancelled_search():
+    header = os.urandom(512)
+    progress = Progress()
+    progress.cancel()
+
+    with pytest.raises(Cancelled):
+        detect_header(header, PASSWORD, pim=PIM, workers=2, progress=progress)
+
+
+def test_truecrypt_header_in_the_calling_process():
+    parameters = HeaderParameters("TrueCrypt", "SHA-512", 1000, "AES")
+    decrypted_header = plain_header(b"TRUE")
+    header = encrypt_header(parameters, os.urandom(64), decrypted_header, PASSWORD)
+
+    assert detect_header(header, PASSWORD, workers=1) == (parameters, decrypted_header)
+
+
+@pytest.mark.parametrize("cipher", sorted(block_ciphers()))
+def test_header_unit_matches_the_xts_engine(cipher):
+    key, data = os.urandom(64), os.urandom(448)
+    expected = bytearray(data)
+    crypt_sectors(key, expected, 0, True, block_ciphers()[cipher])
+
+    encrypted = crypt_header_unit(block_ciphers()[cipher], key, data, True)
+    assert encrypted == bytes(expected)
+    assert crypt_header_unit(block_ciphers()[cipher], key, encrypted, False) == data
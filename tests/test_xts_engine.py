@@ -0,0 +1,129 @@
+# Buttertoast Copyright (C) 2024 Matthias Ferstl, Fabian Kozlowski, Stefan Leippe, Malte Muthesius
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# For more information, contact: mail@matthias-ferstl.de
+
+# The vectorized XTS engine against one cryptography XTS cipher per data unit.
+
+import os
+import zlib
+
+import pytest
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from buttertoast.Crypt.cryptomat import Cryptomat, FULL_HEADER_SIZE
+from buttertoast.Crypt.xts_engine import (SECTOR_SIZE, crypt_sectors, data_area_from_header, process_data_area,
+                                          sector_tweak)
+from conftest import TC_PASSWORD, TC_VOLUME
+
+KEY = bytes(range(64))
+OTHER_KEY = bytes(range(64, 128))
+
+
+def reference(key, data, first_sector, encrypt):
+    """One XTS cipher per data unit, the tweak is the unit number."""
+    result = bytearray()
+    for index in range(0, len(data), SECTOR_SIZE):
+        cipher = Cipher(algorithms.AES(key), modes.XTS(sector_tweak(first_sector + index // SECTOR_SIZE)))
+        context = cipher.encryptor() if encrypt else cipher.decryptor()
+        result += context.update(bytes(data[index:index + SECTOR_SIZE])) + context.finalize()
+    return bytes(result)
+
+
+@pytest.mark.parametrize("first_sector", [0, 256, 2 ** 40 + 5])
+@pytest.mark.parametrize("encrypt", [True, False])
+def test_crypt_sectors_matches_reference(first_sector, encrypt):
+    data = bytearray(os.urandom(37 * SECTOR_SIZE))
+    expected = reference(KEY, data, first_sector, encrypt)
+
+    crypt_sectors(KEY, data, first_sector, encrypt)
+    assert bytes(data) == expected
+
+
+def test_short_last_unit():
+    data = bytearray(os.urandom(3 * SECTOR_SIZE + 448))
+    expected = reference(KEY, data, 7, True)
+
+    crypt_sectors(KEY, data, 7, True)
+    assert bytes(data) == expected
+
+
+def test_round_trip_in_a_memoryview():
+    plaintext = os.urandom(8 * SECTOR_SIZE)
+    buffer = bytearray(plaintext)
+    view = memoryview(buffer)[SECTOR_SIZE:]
+
+    crypt_sectors(KEY, view, 1, True)
+    assert buffer[:SECTOR_SIZE] == plaintext[:SECTOR_SIZE]
+    assert bytes(view) == reference(KEY, plaintext[SECTOR_SIZE:], 1, True)
+    crypt_sectors(KEY, view, 1, False)
+    assert bytes(buffer) == plaintext
+
+
+@pytest.fixture
+def area_file(tmp_path):
+    path = tmp_path / "area"
+    path.write_bytes(os.urandom(SECTOR_SIZE) + os.urandom(40 * SECTOR_SIZE) + os.urandom(SECTOR_SIZE))
+    return str(path)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_process_data_area(area_file, workers):
+    with open(area_file, "rb") as file:
+        original = file.read()
+    area = original[SECTOR_SIZE:-SECTOR_SIZE]
+
+    process_data_area(area_file, "encrypt", (KEY,), SECTOR_SIZE, len(area), workers=workers, range_size=8 * SECTOR_SIZE)
+    with open(area_file, "rb") as file:
+        encrypted = file.read()
+    assert encrypted[:SECTOR_SIZE] == original[:SECTOR_SIZE] and encrypted[-SECTOR_SIZE:] == original[-SECTOR_SIZE:]
+    assert encrypted[SECTOR_SIZE:-SECTOR_SIZE] == reference(KEY, area, 1, True)
+
+    checksums = process_data_area(area_file, "checksum", (KEY,), SECTOR_SIZE, len(area), workers=workers,
+                                  range_size=8 * SECTOR_SIZE)
+    assert len(checksums) == 5 and sum(length for _, length, _ in checksums) == len(area)
+    assert all(crc == zlib.crc32(original[offset:offset + length]) for offset, length, crc in checksums)
+
+    process_data_area(area_file, "rekey", (KEY, OTHER_KEY), SECTOR_SIZE, len(area), workers=workers)
+    with open(area_file, "rb") as file:
+        assert file.read()[SECTOR_SIZE:-SECTOR_SIZE] == reference(OTHER_KEY, area, 1, True)
+
+    process_data_area(area_file, "decrypt", (OTHER_KEY,), SECTOR_SIZE, len(area), workers=workers)
+    with open(area_file, "rb") as file:
+        assert file.read() == original
+
+
+@pytest.mark.parametrize("operation, keys, offset, length", [
+    ("shred", (KEY,), 0, SECTOR_SIZE),
+    ("rekey", (KEY,), 0, SECTOR_SIZE),
+    ("encrypt", (KEY[:32],), 0, SECTOR_SIZE),
+    ("encrypt", (KEY,), 100, SECTOR_SIZE),
+    ("encrypt", (KEY,), 0, 100 * SECTOR_SIZE),
+])
+def test_process_data_area_rejects(area_file, operation, keys, offset, length):
+    with pytest.raises(ValueError):
+        process_data_area(area_file, operation, keys, offset, length)
+
+
+def test_data_area_of_the_test_volume():
+    with open(TC_VOLUME, "rb") as file:
+        volume = file.read()
+    key, data_offset, data_length = data_area_from_header(Cryptomat().decrypt_header(volume[:FULL_HEADER_SIZE], TC_PASSWORD))
+    assert data_offset + data_length + 128 * 1024 == len(volume)
+
+    boot_sector = bytearray(volume[data_offset:data_offset + SECTOR_SIZE])
+    crypt_sectors(key, boot_sector, data_offset // SECTOR_SIZE, False)
+    assert bytes(boot_sector) == reference(key, volume[data_offset:data_offset + SECTOR_SIZE], data_offset // SECTOR_SIZE, False)
+    assert boot_sector[510:512] == b"\x55\xaa"  # The FAT file system inside the volume